@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""The administrative hierarchy index
+DESCRIPTION:
+------------
+This file contains the in-memory index of the administrative hierarchy
+(the "province", "district", "sector", "cell" and "village" tables, about 17k nodes).
+The tree is read once and stored in compact numpy arrays, its nodes numbered in depth-first (pre)order:
+    - ids, levels and names of the nodes,
+    - parents (node of each node's parent) and children (CSR offsets + nodes) lookup tables,
+    - ancestors matrix (node of each node's ancestor at every level, itself included),
+    - subtree ends (a node's subtree is the contiguous range of nodes [node, subtree_end)).
+Resolving an id to its node is a dictionary lookup, so ancestors and subtrees are resolved in O(1);
+batches of village ids are resolved at once with a binary search over the sorted village ids.
+The index is built on first use, rebuilt after this worker writes to one of the five tables,
+and rebuilt by the other workers once it is ADMIN_HIERARCHY_TTL seconds old.
+"""
+
+import threading
+import time
+import numpy as np
+import config
+import db_helpers
+
+# Levels of the hierarchy, from the root down (they are also the names of their tables)
+LEVELS = ["province", "district", "sector", "cell", "village"]
+
+# Column holding the id of the parent node, per level
+PARENT_COLUMNS = {"district": "province_id", "sector": "district_id", "cell": "sector_id", "village": "cell_id"}
+
+# Number of seconds an index is used before being rebuilt
+INDEX_TTL = config.cfg["ADMIN_HIERARCHY_TTL"]
+
+# Current index and the time it was built at
+_index = None
+_built_at = 0.0
+_index_lock = threading.Lock()
+
+class HierarchyIndex:
+    """
+    Array-backed index of the administrative hierarchy tree.
+
+    Args:
+        tables (dict): The rows of each level's table (dictionaries with "id", "name" and the parent column),
+                       indexed by level name.
+    """
+
+    def __init__(self, tables):
+        # Read the nodes of every level, keyed by (level, id)
+        keys, names, parent_keys = [], [], []
+        for level, level_name in enumerate(LEVELS):
+            for row in tables[level_name]:
+                keys.append((level, row["id"]))
+                names.append(row["name"])
+                parent_keys.append((level - 1, row[PARENT_COLUMNS[level_name]])
+                                   if level_name in PARENT_COLUMNS else None)
+        position_by_key = {key: position for position, key in enumerate(keys)}
+
+        # Link every node to its parent (nodes whose parent cannot be found become roots)
+        children_lists = [[] for _ in keys]
+        roots = []
+        for position, parent_key in enumerate(parent_keys):
+            parent_position = position_by_key.get(parent_key)
+            if parent_position is None:
+                roots.append(position)
+            else:
+                children_lists[parent_position].append(position)
+
+        # Number the nodes in depth-first preorder, children sorted by id
+        order = []
+        stack = sorted(roots, key=lambda position: keys[position], reverse=True)
+        while stack:
+            position = stack.pop()
+            order.append(position)
+            stack.extend(sorted(children_lists[position], key=lambda child: keys[child], reverse=True))
+        node_by_position = np.empty(len(keys), dtype=np.int32)
+        node_by_position[order] = np.arange(len(order), dtype=np.int32)
+
+        size = len(order)
+        self.ids = np.array([keys[position][1] for position in order], dtype=np.int64)
+        self.levels = np.array([keys[position][0] for position in order], dtype=np.int8)
+        self.names = np.array([names[position] for position in order], dtype=object)
+        self.parents = np.full(size, -1, dtype=np.int32)
+        self.children_offsets = np.zeros(size + 1, dtype=np.int32)
+        children = []
+        for node, position in enumerate(order):
+            node_children = sorted(node_by_position[children_lists[position]].tolist())
+            self.parents[node_children] = node
+            children.extend(node_children)
+            self.children_offsets[node + 1] = len(children)
+        self.children = np.array(children, dtype=np.int32)
+
+        # Ancestors matrix: a node's row is its parent's row plus itself at its own level
+        self.ancestors = np.full((size, len(LEVELS)), -1, dtype=np.int32)
+        for node in range(size):
+            if self.parents[node] >= 0:
+                self.ancestors[node] = self.ancestors[self.parents[node]]
+            self.ancestors[node, self.levels[node]] = node
+
+        # Subtree ends: a subtree ends where the next node that is not a descendant starts
+        self.subtree_ends = np.empty(size, dtype=np.int32)
+        for node in range(size - 1, -1, -1):
+            last_child = self.children[self.children_offsets[node + 1] - 1] \
+                if self.children_offsets[node + 1] > self.children_offsets[node] else None
+            self.subtree_ends[node] = node + 1 if last_child is None else self.subtree_ends[last_child]
+
+        # Id lookups, per level: a dictionary (single ids) and the sorted ids with their nodes (batches)
+        self.node_by_id = [{} for _ in LEVELS]
+        for node in range(size):
+            self.node_by_id[self.levels[node]][int(self.ids[node])] = node
+        self.sorted_ids, self.sorted_nodes = [], []
+        for level in range(len(LEVELS)):
+            level_nodes = np.flatnonzero(self.levels == level)
+            level_order = np.argsort(self.ids[level_nodes], kind="stable")
+            self.sorted_ids.append(self.ids[level_nodes][level_order])
+            self.sorted_nodes.append(level_nodes[level_order].astype(np.int32))
+
+    def node(self, level_name, node_id):
+        """
+        Find the node of an id.
+
+        Args:
+            level_name (str): The level of the id ("province", ..., "village").
+            node_id (int): The id.
+
+        Returns:
+            int: The node, or None if the id does not exist at this level.
+        """
+        return self.node_by_id[LEVELS.index(level_name)].get(int(node_id))
+
+    def ancestor_ids(self, level_name, node_id):
+        """
+        Resolve the ids of an id's ancestors.
+
+        Args:
+            level_name (str): The level of the id ("province", ..., "village").
+            node_id (int): The id.
+
+        Returns:
+            dict: The id at every level from the root down to the given one (itself included),
+                  indexed by level name, or None if the id does not exist.
+        """
+        node = self.node(level_name, node_id)
+        if node is None:
+            return None
+        return {LEVELS[level]: int(self.ids[ancestor])
+                for level, ancestor in enumerate(self.ancestors[node]) if ancestor >= 0}
+
+    def children_ids(self, level_name, node_id):
+        """
+        List the ids of an id's children.
+
+        Args:
+            level_name (str): The level of the id ("province", ..., "cell").
+            node_id (int): The id.
+
+        Returns:
+            numpy.ndarray: The ids of the children (empty if the id does not exist).
+        """
+        node = self.node(level_name, node_id)
+        if node is None:
+            return np.empty(0, dtype=np.int64)
+        return self.ids[self.children[self.children_offsets[node]:self.children_offsets[node + 1]]]
+
+    def subtree_range(self, level_name, node_id):
+        """
+        Find the range of nodes of an id's subtree.
+
+        Args:
+            level_name (str): The level of the id ("province", ..., "village").
+            node_id (int): The id.
+
+        Returns:
+            tuple: The first node of the subtree (the id's own node) and the node following its last one,
+                   or None if the id does not exist.
+        """
+        node = self.node(level_name, node_id)
+        if node is None:
+            return None
+        return node, int(self.subtree_ends[node])
+
+    def subtree_ids(self, level_name, node_id, descendant_level_name="village"):
+        """
+        List the ids of an id's descendants at a given level.
+
+        Args:
+            level_name (str): The level of the id ("province", ..., "village").
+            node_id (int): The id.
+            descendant_level_name (str, optional): The level of the descendants. Defaults to "village".
+
+        Returns:
+            numpy.ndarray: The sorted ids of the descendants (empty if the id does not exist).
+        """
+        subtree_range = self.subtree_range(level_name, node_id)
+        if subtree_range is None:
+            return np.empty(0, dtype=np.int64)
+        start, end = subtree_range
+        levels = self.levels[start:end]
+        return np.sort(self.ids[start:end][levels == LEVELS.index(descendant_level_name)])
+
+    def village_id_ranges(self, region_filters):
+        """
+        Compile region filters into the fewest ranges of village ids selecting exactly their villages.
+        Village ids are numbered after their ancestors' ids, so a region's villages usually form a single
+        range of the sorted village ids; villages that do not follow the numbering split it into a few more.
+
+        Args:
+            region_filters (dict): The ids of the regions the villages must lie in, indexed by level name
+                                   ("province", "district", "sector" or "cell").
+
+        Returns:
+            list: The (first, last) village ids of the ranges, both inclusive (empty if no village matches).
+        """
+        sorted_ids, sorted_nodes = self.sorted_ids[-1], self.sorted_nodes[-1]
+
+        # Mark the villages lying in every requested region
+        matches = np.ones(len(sorted_ids), dtype=bool)
+        for level_name, region_id in region_filters.items():
+            node = self.node(level_name, region_id)
+            if node is None:
+                return []
+            matches &= self.ancestors[sorted_nodes, LEVELS.index(level_name)] == node
+
+        # Turn the runs of consecutive matching villages into ranges
+        edges = np.diff(np.concatenate([[0], matches.astype(np.int8), [0]]))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+        return [(int(sorted_ids[start]), int(sorted_ids[end])) for start, end in zip(starts, ends)]
+
+    def village_ancestors(self, village_ids):
+        """
+        Resolve the ancestors of a batch of villages at once.
+
+        Args:
+            village_ids (array-like): The village ids (None or unknown ids are allowed).
+
+        Returns:
+            numpy.ndarray: The matrix of the ancestors' nodes, one row per village and one column per level
+                           (-1 where the village is unknown).
+        """
+        village_ids = np.array([-1 if i is None or i != i else i for i in village_ids], dtype=np.int64)
+        sorted_ids, sorted_nodes = self.sorted_ids[-1], self.sorted_nodes[-1]
+        positions = np.minimum(np.searchsorted(sorted_ids, village_ids), max(len(sorted_ids) - 1, 0))
+        found = (sorted_ids[positions] == village_ids) if len(sorted_ids) else np.zeros(len(village_ids), bool)
+        ancestors = np.full((len(village_ids), len(LEVELS)), -1, dtype=np.int32)
+        ancestors[found] = self.ancestors[sorted_nodes[positions[found]]]
+        return ancestors
+
+    def region_names(self, village_ids):
+        """
+        Resolve the names of the regions of a batch of villages at once.
+
+        Args:
+            village_ids (array-like): The village ids (None or unknown ids are allowed).
+
+        Returns:
+            dict: The names at every level (None where unknown), as lists indexed by "<level>_name".
+        """
+        ancestors = self.village_ancestors(village_ids)
+        names = np.append(self.names, None)
+        return {f"{level_name}_name": names[ancestors[:, level]].tolist()
+                for level, level_name in enumerate(LEVELS)}
+
+def get_index():
+    """
+    Get the hierarchy index, building it if it does not exist yet, was invalidated or has expired.
+
+    Returns:
+        HierarchyIndex: The index.
+    """
+    global _index, _built_at
+    index = _index
+    if index is not None and time.monotonic() - _built_at < INDEX_TTL:
+        return index
+    with _index_lock:
+        if _index is None or time.monotonic() - _built_at >= INDEX_TTL:
+            _index = HierarchyIndex({level_name: [dict(i) for i in db_helpers.table_querying(level_name)]
+                                     for level_name in LEVELS})
+            _built_at = time.monotonic()
+        return _index
+
+def invalidate():
+    """
+    Forget the hierarchy index (called when one of the hierarchy tables is written to), it is rebuilt on next use.
+
+    Returns:
+        None
+    """
+    global _index
+    with _index_lock:
+        _index = None
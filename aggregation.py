@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""The aggregation query compiler
+DESCRIPTION:
+------------
+This file contains the compiler of the aggregation endpoint's requests into a single GROUP BY query,
+so that counts and rates are computed by the database and only the aggregated rows are sent back.
+A request names the dimensions to group by and the metrics to compute:
+    - dimensions: gender, malaria_status, parasite_type, health_center_id,
+                  an administrative level (province, district, sector, cell, village)
+                  and a date bucket (day, week, month, year),
+    - metrics: count, distinct_patients, positive_rate.
+Each one is only available on the tables having the columns it is computed from, and never on a column
+the user's role is not allowed to read. Administrative levels above the village are read by joining up
+the hierarchy from "village_id" (village, cell, sector, district), as the rollup does.
+Requests on "case_cache" are answered from the "case_rollup" table (see rollup.py) whenever all their
+dimensions and metrics are kept in it and their date range (if any) is made of whole days.
+"""
+
+import datetime
+
+# Dimensions read as-is from a column of the table
+COLUMN_DIMENSIONS = ["gender", "malaria_status", "parasite_type", "health_center_id"]
+
+# Joins up the administrative hierarchy from "village_id", from the village to the district
+HIERARCHY_JOINS = ["left join village on village.id = {table}.village_id",
+                   "left join cell on cell.id = village.cell_id",
+                   "left join sector on sector.id = cell.sector_id",
+                   "left join district on district.id = sector.district_id"]
+
+# Administrative levels derived from "village_id", with their expression and the number of joins it needs
+ADMINISTRATIVE_LEVELS = {"province": ("district.province_id", 4),
+                         "district": ("sector.district_id", 3),
+                         "sector": ("cell.sector_id", 2),
+                         "cell": ("village.cell_id", 1),
+                         "village": ("{table}.village_id", 0)}
+
+# Date buckets, per dialect, as SQL templates formatting the "date" column as an ISO date string
+DATE_BUCKETS = {
+    "postgresql": {"day": "to_char(date_trunc('day', {column}), 'YYYY-MM-DD')",
+                   "week": "to_char(date_trunc('week', {column}), 'YYYY-MM-DD')",
+                   "month": "to_char(date_trunc('month', {column}), 'YYYY-MM-DD')",
+                   "year": "to_char(date_trunc('year', {column}), 'YYYY-MM-DD')"},
+    "sqlite": {"day": "date({column})",
+               "week": "date({column}, '-6 days', 'weekday 1')",
+               "month": "date({column}, 'start of month')",
+               "year": "date({column}, 'start of year')"},
+    "mysql": {"day": "date_format({column}, '%Y-%m-%d')",
+              "week": "date_format(date_sub({column}, interval weekday({column}) day), '%Y-%m-%d')",
+              "month": "date_format({column}, '%Y-%m-01')",
+              "year": "date_format({column}, '%Y-01-01')"},
+}
+
+# Metrics, with the columns they are computed from and their SQL template
+METRICS = {
+    "count": {"columns": [], "sql": "count(*)"},
+    "distinct_patients": {"columns": ["patient_id"], "sql": "count(distinct {table}.patient_id)"},
+    "positive_rate": {"columns": ["malaria_status"],
+                      "sql": "cast(avg(case when {table}.malaria_status = 'positive' then 1.0 else 0.0 end) as float)"},
+}
+
+def compile_query(table_name, table_columns, group_by, metrics, columns_to_drop, dialect):
+    """
+    Compile the dimensions and metrics of an aggregation request into the parts of a GROUP BY query.
+
+    Args:
+        table_name (str): The name of the table to aggregate.
+        table_columns (list): The names of the table's columns.
+        group_by (list): The names of the dimensions to group by.
+        metrics (list): The names of the metrics to compute.
+        columns_to_drop (list): The columns the user's role is not allowed to read.
+        dialect (str): The name of the database dialect (e.g. "postgresql", "sqlite").
+
+    Returns:
+        dict: The "select" expressions (with their aliases), the "group_by" expressions
+              and the "joins" of the query.
+
+    Raises:
+        ValueError: If a dimension or a metric is unknown, repeated, or not available on this table.
+    """
+    readable_columns = set(table_columns) - set(columns_to_drop)
+    if table_name == "patient":
+        # Patients are their own patient_id
+        readable_columns.add("patient_id")
+
+    if not isinstance(group_by, list) or not isinstance(metrics, list) or not metrics:
+        raise ValueError("group_by must be a list and metrics a non-empty list")
+    if len(set(group_by)) != len(group_by) or len(set(metrics)) != len(metrics):
+        raise ValueError("dimensions and metrics can only be requested once")
+
+    select, grouped, joins = [], [], []
+    for dimension in group_by:
+        if dimension in COLUMN_DIMENSIONS and dimension in readable_columns:
+            expression = f"{table_name}.{dimension}"
+        elif dimension in ADMINISTRATIVE_LEVELS and "village_id" in readable_columns:
+            expression, depth = ADMINISTRATIVE_LEVELS[dimension]
+            expression = expression.format(table=table_name)
+            # Each join is only added once, however many levels need it
+            joins += [join.format(table=table_name) for join in HIERARCHY_JOINS[len(joins):depth]]
+        elif dimension in DATE_BUCKETS.get(dialect, {}) and "date" in readable_columns:
+            expression = DATE_BUCKETS[dialect][dimension].format(column=f"{table_name}.date")
+        else:
+            raise ValueError(f"dimension {dimension} is not available on {table_name}")
+        select.append(f"{expression} as {dimension}")
+        grouped.append(expression)
+
+    for metric in metrics:
+        if metric not in METRICS or not set(METRICS[metric]["columns"]) <= readable_columns:
+            raise ValueError(f"metric {metric} is not available on {table_name}")
+        sql = METRICS[metric]["sql"]
+        if table_name == "patient":
+            sql = sql.replace("{table}.patient_id", "{table}.id")
+        select.append(f"{sql.format(table=table_name)} as {metric}")
+
+    return {"select": select, "group_by": grouped, "joins": joins}
+
+# Dimensions the rollup keeps, with their expression on the "case_rollup" table
+ROLLUP_DIMENSIONS = {"gender": "nullif(case_rollup.gender, '')",
+                     "malaria_status": "nullif(case_rollup.malaria_status, '')",
+                     "parasite_type": "nullif(case_rollup.parasite_type, '')",
+                     "province": "case_rollup.province_id",
+                     "district": "case_rollup.district_id",
+                     "sector": "case_rollup.sector_id",
+                     "cell": "case_rollup.cell_id",
+                     "village": "nullif(case_rollup.village_id, 0)"}
+
+# Day under which the rollup keeps the cases without a date (no date range reaches it)
+ROLLUP_UNDATED_DAY = datetime.date(1000, 1, 1)
+
+# Metrics the rollup can compute, with their SQL
+ROLLUP_METRICS = {"count": "sum(case_rollup.count)",
+                  "positive_rate": "cast(sum(case when case_rollup.malaria_status = 'positive' "
+                                   "then case_rollup.count else 0 end) as float) / sum(case_rollup.count)"}
+
+def is_day_aligned(early_date, late_date):
+    """
+    Tell whether a date range is made of whole days (or absent), so that the rollup's days cover it exactly.
+
+    Args:
+        early_date (str): The inclusive lower bound of the date range, or None.
+        late_date (str): The exclusive upper bound of the date range, or None.
+
+    Returns:
+        bool: True if both bounds are absent or at midnight.
+    """
+    try:
+        return all(datetime.datetime.fromisoformat(str(date)).time() == datetime.time()
+                   for date in [early_date, late_date] if date is not None)
+    except ValueError:
+        return False
+
+def day_str(date):
+    """
+    Format a date as the ISO string of its day, as compared with the rollup's days.
+
+    Args:
+        date (str): The date, or None.
+
+    Returns:
+        str: The day, as "YYYY-MM-DD", or None.
+    """
+    return None if date is None else datetime.datetime.fromisoformat(str(date)).date().isoformat()
+
+def rollup_day_range(early_date, late_date):
+    """
+    Get the days bounding a date range on the rollup, starting after its undated day
+    so that, as on "case_cache", the cases without a date are never within a date range.
+
+    Args:
+        early_date (str): The inclusive lower bound of the date range, or None.
+        late_date (str): The exclusive upper bound of the date range, or None.
+
+    Returns:
+        tuple: The inclusive lower and exclusive upper days, as "YYYY-MM-DD" (or None, None without a range).
+    """
+    if early_date is None:
+        return None, None
+    first_dated_day = ROLLUP_UNDATED_DAY + datetime.timedelta(days=1)
+    return max(day_str(early_date), first_dated_day.isoformat()), day_str(late_date)
+
+def compile_rollup_query(group_by, metrics, dialect):
+    """
+    Compile the dimensions and metrics of a "case_cache" aggregation request into the parts of a GROUP BY query
+    on the "case_rollup" table, if the rollup can answer it.
+
+    Args:
+        group_by (list): The names of the dimensions to group by.
+        metrics (list): The names of the metrics to compute.
+        dialect (str): The name of the database dialect (e.g. "postgresql", "sqlite").
+
+    Returns:
+        dict: The "select" expressions (with their aliases), the "group_by" expressions and the "having" condition
+              of the query, or None if a dimension or a metric is not kept in the rollup.
+    """
+    if not isinstance(group_by, list) or not isinstance(metrics, list):
+        return None
+    rollup_dimensions = dict(ROLLUP_DIMENSIONS)
+    # The undated cases fall in no date bucket
+    undated_day = ROLLUP_UNDATED_DAY.isoformat()
+    rollup_dimensions.update({bucket: template.format(column=f"nullif(case_rollup.day, '{undated_day}')")
+                              for bucket, template in DATE_BUCKETS.get(dialect, {}).items()})
+    if not set(group_by) <= set(rollup_dimensions) or not set(metrics) <= set(ROLLUP_METRICS):
+        return None
+
+    select = [f"{rollup_dimensions[dimension]} as {dimension}" for dimension in group_by]
+    select += [f"{ROLLUP_METRICS[metric]} as {metric}" for metric in metrics]
+    return {"select": select,
+            "group_by": [rollup_dimensions[dimension] for dimension in group_by],
+            "having": "sum(case_rollup.count) > 0"}
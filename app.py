@@ -4,12 +4,285 @@ DESCRIPTION:
 ------------
 This file contains routes to the server side."""
 
-from flask import request, jsonify
+from flask import request, jsonify, json, Response, stream_with_context
+import hmac
 from controllers import *
 from config import cfg
 from db_models import *
-from authentication import authentication_function
+from authentication import authentication_function, credentials_cache, user_snapshot, verify_password, issue_token
 import request_log
+import columnar_export
+import admin_hierarchy
+import result_cache
+import response_compression
+import metrics
+
+# Time jsonify's JSON encoding as the "serialize" phase of the requests
+app.json_encoder = metrics.TimedJSONEncoder
+
+@app.before_first_request
+def load_admin_hierarchy():
+    """
+    Load the administrative hierarchy index when the server starts serving requests.
+
+    Returns:
+        None
+    """
+    admin_hierarchy.get_index()
+
+def parse_region_filters(params):
+    """
+    Read the region filters ("province", "district", "sector" and "cell" ids) of a request.
+
+    Args:
+        params (dict): The request's query parameters or JSON data.
+
+    Returns:
+        dict: The ids of the requested regions, indexed by level name.
+
+    Raises:
+        ValueError: If a region id is not an integer.
+    """
+    region_filters = {}
+    for level_name in ["province", "district", "sector", "cell"]:
+        if params.get(level_name) is not None:
+            if not str(params[level_name]).isdigit():
+                raise ValueError(f"{level_name} must be an integer")
+            region_filters[level_name] = int(params[level_name])
+    return region_filters
+
+def parse_columns(value):
+    """
+    Read the "columns" selector of a request (a comma-separated string, or a list of column names in JSON data).
+
+    Args:
+        value (str or list): The selector, or None.
+
+    Returns:
+        list: The names of the requested columns, or None if the selector is not provided.
+
+    Raises:
+        ValueError: If the selector is neither a string nor a list of strings.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    if not isinstance(value, list) or not all(isinstance(column, str) for column in value):
+        raise ValueError("columns must be a comma-separated string or a list of column names")
+    return [column.strip() for column in value if column.strip()]
+
+def response_etag(table_name, columns_to_drop, params):
+    """
+    Compute the strong ETag of a read response, from the write versions of the tables it is read from,
+    the role projection and the request's parameters.
+
+    Args:
+        table_name (str): The name of the queried table.
+        columns_to_drop (list): The columns removed from the response for the user's role.
+        params (dict): The parameters (filters, options, format) the response depends on.
+
+    Returns:
+        str: The ETag (unquoted).
+    """
+    # Responses resolving regions also depend on the administrative hierarchy
+    table_names = [table_name]
+    if params.get("regions") or params.get("region_filters"):
+        table_names += [level_name for level_name in admin_hierarchy.LEVELS if level_name != table_name]
+    return result_cache.response_tag(table_names, columns_to_drop, params)
+
+def representation_etag(etag, encoding):
+    """
+    Derive the ETag of a compressed representation of a response (each content-coding has its own strong ETag).
+
+    Args:
+        etag (str): The ETag of the uncompressed response (unquoted).
+        encoding (str): The name of the content-coding, or None.
+
+    Returns:
+        str: The ETag of the representation (unquoted).
+    """
+    return etag if encoding is None else f"{etag}-{encoding}"
+
+def is_not_modified(etag):
+    """
+    Check whether the "If-None-Match" header of the request matches the current ETag of the representation
+    negotiated for this request: the one of the content-coding picked from its "Accept-Encoding" header,
+    or the uncompressed one (sent whenever the response is smaller than COMPRESSION_MIN_BYTES).
+
+    Args:
+        etag (str): The current ETag of the requested response.
+
+    Returns:
+        bool: True if the client's copy is current.
+    """
+    encoding = response_compression.negotiate(request.accept_encodings)
+    return request.if_none_match.star_tag or any(
+        request.if_none_match.contains(representation_etag(etag, i)) for i in [None, encoding])
+
+def not_modified(etag):
+    """
+    Build the "304 Not Modified" response of a conditional request, carrying the ETag the client sent.
+
+    Args:
+        etag (str): The current ETag of the requested response.
+
+    Returns:
+        flask.Response: The response, without a body.
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    encoding = response_compression.negotiate(request.accept_encodings)
+    if encoding is not None and request.if_none_match.contains(representation_etag(etag, encoding)):
+        response.set_etag(representation_etag(etag, encoding))
+    response.vary.add("Accept-Encoding")
+    return response
+
+def tagged(response, etag):
+    """
+    Set the ETag of a response.
+
+    Args:
+        response (flask.Response): The response.
+        etag (str): The ETag (unquoted).
+
+    Returns:
+        flask.Response: The response.
+    """
+    response.set_etag(etag)
+    return response
+
+@metrics.timed("serialize")
+def json_body(document):
+    """
+    Turn a JSON document encoded by the controllers into a response body (ended by a newline, like jsonify's).
+
+    Args:
+        document (str): The JSON document.
+
+    Returns:
+        bytes: The response body.
+    """
+    return (document + "\n").encode()
+
+def cached_json_response(etag, build):
+    """
+    Serve a JSON response from the result cache, or build, serialize and cache it.
+    The response is compressed with the content-coding negotiated with the client (unless it is small),
+    and the cache keeps the compressed bytes, under the ETag of the compressed representation.
+
+    Args:
+        etag (str): The ETag of the response (also its cache key).
+        build (callable): The function building the response's JSON document when it is not cached.
+
+    Returns:
+        flask.Response: The JSON response, with its ETag.
+    """
+    # Serve the compressed representation if it is cached
+    encoding = response_compression.negotiate(request.accept_encodings)
+    if encoding is not None:
+        body = result_cache.get(representation_etag(etag, encoding))
+        if body is not None:
+            return encoded(Response(body, mimetype="application/json"), etag, encoding)
+
+    # Build the uncompressed response, unless it is cached
+    body = result_cache.get(etag)
+    if body is None:
+        body = json_body(build())
+        if encoding is None or len(body) < response_compression.MIN_BYTES:
+            result_cache.put(etag, body)
+
+    # Compress and cache the response for this content-coding
+    if encoding is not None and len(body) >= response_compression.MIN_BYTES:
+        body = response_compression.compress(body, encoding)
+        result_cache.put(representation_etag(etag, encoding), body)
+    else:
+        if encoding is not None:
+            response_compression.count_below_min_bytes()
+        encoding = None
+    return encoded(Response(body, mimetype="application/json"), etag, encoding)
+
+def encoded(response, etag, encoding):
+    """
+    Set the ETag and content-coding headers of a response whose body was compressed (or not) already.
+
+    Args:
+        response (flask.Response): The response.
+        etag (str): The ETag of the uncompressed response (unquoted).
+        encoding (str): The name of the content-coding of the body, or None.
+
+    Returns:
+        flask.Response: The response.
+    """
+    response.set_etag(representation_etag(etag, encoding))
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+@app.before_request
+def start_request_metrics():
+    """
+    Start measuring the phases of the request (see metrics.py).
+
+    Returns:
+        None
+    """
+    metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    """
+    Record the measures of the request once its response is sent, and add its "Server-Timing" header
+    if SERVER_TIMING is enabled. Registered before compress_response, it runs after it
+    and measures the response as it is sent.
+
+    Args:
+        response (flask.Response): The response.
+
+    Returns:
+        flask.Response: The response.
+    """
+    return metrics.finish_request(response)
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress the successful responses of the read endpoints with the content-coding negotiated with the client
+    (responses served from the result cache are compressed already). Streamed responses are compressed
+    as they are produced; responses smaller than COMPRESSION_MIN_BYTES are sent as they are.
+
+    Args:
+        response (flask.Response): The response.
+
+    Returns:
+        flask.Response: The response, compressed if it is worth it.
+    """
+    if response.status_code != 200 or response.mimetype not in response_compression.COMPRESSIBLE_MIMETYPES \
+            or "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = response_compression.negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    # Compress the body, incrementally if it is streamed
+    if response.is_streamed:
+        encoding, response.response = response_compression.compress_stream(response.response, encoding)
+    elif len(response.get_data()) < response_compression.MIN_BYTES:
+        response_compression.count_below_min_bytes()
+        encoding = None
+    else:
+        response.set_data(response_compression.compress(response.get_data(), encoding))
+    if encoding is None:
+        return response
+
+    # Give the compressed representation its own ETag
+    etag = response.get_etag()[0]
+    if etag is not None:
+        response.set_etag(representation_etag(etag, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
 
 @app.route("/", methods=['GET'])
 def hello_world():
@@ -25,16 +298,64 @@ def hello_world():
     for Malaria Awareness in Rwanda!  <!-- Display a descriptive welcome message -->
     """
 
+@app.route("/login", methods=['POST'])
+def login():
+    """
+    Verify a user's email and password once and issue a short-lived signed session token.
+    The token is then sent as "Authorization: Bearer <token>" instead of the credentials.
+
+    Returns:
+        tuple: A tuple containing a JSON response and a status code.
+               The JSON response contains the token, its type and lifetime (in seconds), or an error message.
+    """
+    # Check if the content type is JSON
+    if request.content_type == 'application/json':
+        try:
+            # Access the JSON data from the request body
+            json_data = request.get_json()
+
+            # Verify the credentials against the stored password hash
+            user_details = User.query.filter_by(email=json_data["email"]).first()
+            if user_details is None or not verify_password(user_details, json_data["password"]):
+                return jsonify({"error": True, "response": "bad email or password"}), 400
+
+            # Log user activity and request details
+            request_log.log(vars(user_snapshot(user_details)).copy(), request, [])
+
+            return jsonify({"token": issue_token(user_details),
+                            "token_type": "Bearer",
+                            "expires_in": cfg["TOKEN_TTL"]}), 200
+
+        except Exception:
+            # If there is an error parsing the JSON data, return an error response
+            return jsonify({'error': 'Invalid JSON data'}), 400
+
+    # If the content type is not JSON, return an error response
+    return jsonify({'error': 'Invalid content type. Expected JSON data.'}), 400
+
 @app.route("/tables/<table_name>", methods=['GET'])
 def table_retrival(table_name):
     """
     Retrieve data from a specified table based on user authentication and role.
+    Clients sending "Accept: application/x-ndjson" receive a streamed response with one JSON record per line,
+    and clients accepting "application/vnd.apache.arrow.stream" or "application/vnd.apache.parquet"
+    receive the table in that columnar format (requires pyarrow on the server).
+    The "limit" and "after_id" query parameters return a single page of records ordered by id,
+    along with the "next_after_id" to send for the following page.
+    The "regions=true" query parameter adds the names of the records' province, district, sector, cell
+    and village to the JSON and NDJSON responses of the "patient" and "case_cache" tables,
+    and the "province", "district", "sector" and "cell" query parameters only return their records lying in these regions.
+    The "columns" query parameter (comma-separated column names) only returns these columns of the records;
+    only the selected columns the user's role may read are queried from the database.
+    Responses carry a strong ETag, changing when the table is written to; requests whose "If-None-Match"
+    header matches it are answered with "304 Not Modified" without querying the database.
+    Responses are compressed with gzip or zstd when the client's "Accept-Encoding" header allows it.
 
     Args:
         table_name (str): The name of the table to retrieve data from.
 
     Returns:
-        tuple: A tuple containing a JSON response and a status code.
+        tuple: A tuple containing a JSON (or streamed NDJSON) response and a status code.
                The JSON response contains the retrieved data as a dictionary or an error message.
     """
     # Authenticate user and handle authentication errors
@@ -59,12 +380,88 @@ def table_retrival(table_name):
     else:
         columns_to_drop = []
 
+    # Check if the names of the records' regions are requested
+    regions = table_name in ["patient", "case_cache"] and request.args.get("regions", "").lower() in ["true", "1"]
+
+    # Check the optional region filters
+    try:
+        region_filters = parse_region_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if region_filters and table_name not in ["patient", "case_cache"]:
+        return jsonify({"error": "region filters are only available on the patient and case_cache tables"}), 400
+
+    # Check the optional column selector against the table's model and the user's role
+    try:
+        columns = projection(table_name, parse_columns(request.args.get("columns")), columns_to_drop)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Check the optional keyset pagination parameters
+    if "limit" in request.args or "after_id" in request.args:
+        limit = request.args.get("limit", type=int) if "limit" in request.args else 1000
+        after_id = request.args.get("after_id", type=int)
+        if limit is None or not 0 < limit <= cfg["PAGE_SIZE_MAX"]:
+            return jsonify({"error": f"limit must be an integer between 1 and {cfg['PAGE_SIZE_MAX']}"}), 400
+        if "after_id" in request.args and after_id is None:
+            return jsonify({"error": "after_id must be an integer"}), 400
+
+        # Log user activity and request details
+        request_log.log(user_details_dict, request, columns_to_drop)
+
+        # Answer conditional requests before touching the database
+        etag = response_etag(table_name, columns_to_drop, {"regions": regions, "region_filters": region_filters,
+                                                           "columns": columns, "limit": limit, "after_id": after_id})
+        if is_not_modified(etag):
+            return not_modified(etag)
+
+        # Retrieve and return the requested page and the cursor of the next page as JSON
+        results = table_paging(table_name=table_name, columns_to_drop=columns_to_drop,
+                               limit=limit, after_id=after_id, regions=regions,
+                               region_filters=region_filters, columns=columns)
+        return tagged(Response(json_body(results), mimetype="application/json"), etag), 200
+
+    # Negotiate the format of the response
+    response_format = request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson",
+         columnar_export.ARROW_MIMETYPE, columnar_export.PARQUET_MIMETYPE])
+    if response_format in [columnar_export.ARROW_MIMETYPE, columnar_export.PARQUET_MIMETYPE] \
+            and not columnar_export.is_available():
+        return jsonify({"error": "columnar formats are not available on this server"}), 406
+
     # Log user activity and request details
     request_log.log(user_details_dict, request, columns_to_drop)
 
-    # Retrieve and return the queried table data as JSON
-    return jsonify(
-        table_querying(table_name=table_name, columns_to_drop=columns_to_drop).to_dict("index")
+    # Answer conditional requests before touching the database
+    etag = response_etag(table_name, columns_to_drop, {"regions": regions, "region_filters": region_filters,
+                                                       "columns": columns, "format": response_format})
+    if is_not_modified(etag):
+        return not_modified(etag)
+
+    # Export the table as an Arrow IPC stream or a Parquet file if the client asked for it
+    if response_format in [columnar_export.ARROW_MIMETYPE, columnar_export.PARQUET_MIMETYPE]:
+        return tagged(Response(stream_with_context(table_exporting(table_name=table_name,
+                                                                   columns_to_drop=columns_to_drop,
+                                                                   export_format=response_format,
+                                                                   chunk_size=cfg["STREAM_CHUNK_SIZE"],
+                                                                   region_filters=region_filters,
+                                                                   columns=columns)),
+                               mimetype=response_format), etag), 200
+
+    # Stream the table as newline-delimited JSON (one record per line) if the client asked for it
+    if response_format == "application/x-ndjson":
+        def generate_ndjson():
+            for records in table_streaming(table_name=table_name, columns_to_drop=columns_to_drop,
+                                           chunk_size=cfg["STREAM_CHUNK_SIZE"], regions=regions,
+                                           region_filters=region_filters, columns=columns):
+                yield "".join([json.dumps(record) + "\n" for record in records])
+        return tagged(Response(stream_with_context(generate_ndjson()), mimetype="application/x-ndjson"), etag), 200
+
+    # Retrieve and return the queried table data as JSON (from the result cache if it is there)
+    return cached_json_response(
+        etag,
+        lambda: table_querying(table_name=table_name, columns_to_drop=columns_to_drop, regions=regions,
+                               region_filters=region_filters, columns=columns)
     ), 200
 
 
@@ -72,6 +469,12 @@ def table_retrival(table_name):
 def table_retrival_timefilter(table_name):
     """
     Retrieve data from a specified table based on user authentication, role, and time filters.
+    Clients accepting "application/vnd.apache.arrow.stream" or "application/vnd.apache.parquet"
+    receive the records in that columnar format (requires pyarrow on the server).
+    The optional "province", "district", "sector" and "cell" keys of the "case_cache" requests
+    only return the records lying in these regions, and the optional "columns" key (a list of column names)
+    only returns these columns of the records.
+    Responses carry a strong ETag, and matching "If-None-Match" requests are answered with "304 Not Modified".
 
     Args:
         table_name (str): The name of the table to retrieve data from.
@@ -99,23 +502,69 @@ def table_retrival_timefilter(table_name):
     else:
         columns_to_drop = []
 
+    # Negotiate the format of the response (JSON for the clients not sending an "Accept" header)
+    response_format = request.accept_mimetypes.best_match(
+        ["application/json", columnar_export.ARROW_MIMETYPE, columnar_export.PARQUET_MIMETYPE],
+        default="application/json")
+    if response_format in [columnar_export.ARROW_MIMETYPE, columnar_export.PARQUET_MIMETYPE] \
+            and not columnar_export.is_available():
+        return jsonify({"error": "columnar formats are not available on this server"}), 406
+
     # Check the content type of the request
     if request.content_type == 'application/json':
         try:
             # Access the JSON data from the request body
             json_data = request.get_json()
 
+            # Check the optional region filters
+            try:
+                region_filters = parse_region_filters(json_data)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if region_filters and table_name != "case_cache":
+                return jsonify({"error": "region filters are only available on the case_cache table"}), 400
+
+            # Check the optional column selector against the table's model and the user's role
+            try:
+                columns = projection(table_name, parse_columns(json_data.get("columns")), columns_to_drop)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
             # Log user activity and request details
             request_log.log(user_details_dict, request, columns_to_drop)
 
+            # Answer conditional requests before touching the database
+            etag = response_etag(table_name, columns_to_drop,
+                                 {"early_date": json_data["early_date"], "late_date": json_data["late_date"],
+                                  "region_filters": region_filters, "columns": columns,
+                                  "format": response_format})
+            if is_not_modified(etag):
+                return not_modified(etag)
+
+            # Export the filtered records as an Arrow IPC stream or a Parquet file if the client asked for it
+            if response_format in [columnar_export.ARROW_MIMETYPE, columnar_export.PARQUET_MIMETYPE]:
+                return tagged(Response(stream_with_context(table_exporting(table_name=table_name,
+                                                                           columns_to_drop=columns_to_drop,
+                                                                           export_format=response_format,
+                                                                           chunk_size=cfg["STREAM_CHUNK_SIZE"],
+                                                                           early_date=json_data["early_date"],
+                                                                           late_date=json_data["late_date"],
+                                                                           region_filters=region_filters,
+                                                                           columns=columns)),
+                                       mimetype=response_format), etag), 200
+
             # Retrieve and return the queried table data with datetime filters as JSON
-            return jsonify(
-                table_querying_with_datetime_filters(
+            # (from the result cache if it is there)
+            return cached_json_response(
+                etag,
+                lambda: table_querying_with_datetime_filters(
                     early_date=json_data["early_date"],
                     late_date=json_data["late_date"],
                     table_name=table_name,
-                    columns_to_drop=columns_to_drop
-                ).to_dict("index")
+                    columns_to_drop=columns_to_drop,
+                    region_filters=region_filters,
+                    columns=columns
+                )
             ), 200
         except Exception as e:
             # If there is an error parsing the JSON data, return an error response
@@ -124,11 +573,83 @@ def table_retrival_timefilter(table_name):
     # If the content type is not JSON, return an error response
     return jsonify({'error': 'Invalid content type. Expected JSON data.'}), 400
 
+@app.route("/tables/<table_name>/aggregate", methods=['GET', 'POST'])
+def table_aggregation(table_name):
+    """
+    Retrieve counts and rates of a specified table grouped by the requested dimensions,
+    computed by the database, based on user authentication, role, and request data
+    ("group_by", "metrics" and optionally "early_date" and "late_date").
+
+    Args:
+        table_name (str): The name of the table to aggregate.
+
+    Returns:
+        tuple: A tuple containing a JSON response and a status code.
+               The JSON response contains one row per group as a dictionary or an error message.
+    """
+    # Authenticate user and handle authentication errors
+    auth_results = authentication_function()
+    if auth_results["error"]:
+        return jsonify(auth_results), 400
+
+    # Extract user details from authentication results
+    user_details = auth_results["response"]
+    user_details_dict = vars(user_details).copy()
+
+    # Check if the specified table name is valid for this endpoint
+    if table_name not in ["patient", "case_cache", "malaria_results", "blood_test"]:
+        return jsonify({"error": "table cannot be found on this endpoint"}), 404
+
+    # Determine columns to drop based on user role
+    if user_details.role not in ["health_worker", "sys_admin"]:
+        columns_to_drop = ["name"]
+    else:
+        columns_to_drop = []
+
+    # Check the content type of the request
+    if request.content_type != 'application/json':
+        return jsonify({'error': 'Invalid content type. Expected JSON data.'}), 400
+
+    # Access the JSON data from the request body
+    json_data = request.get_json(silent=True)
+    if not isinstance(json_data, dict):
+        return jsonify({'error': 'Invalid JSON data'}), 400
+
+    try:
+        # Aggregate the table in the database
+        response_df = table_aggregating(table_name=table_name,
+                                         group_by=json_data.get("group_by", []),
+                                         metrics=json_data.get("metrics", ["count"]),
+                                         columns_to_drop=columns_to_drop,
+                                         early_date=json_data.get("early_date"),
+                                         late_date=json_data.get("late_date"))
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f'Invalid aggregation, {e}'}), 400
+
+    # Log user activity and request details
+    request_log.log(user_details_dict, request, columns_to_drop)
+
+    # Return the groups as JSON
+    metrics.count_rows(len(response_df))
+    with metrics.phase("serialize"):
+        groups = response_df.to_dict("index")
+    return jsonify(groups), 200
+
 
 @app.route("/tables/<table_name>/sampling", methods=['GET'])
 def online_querying_api(table_name):
     """
     Retrieve data from a specified table using online querying with batch processing and user authentication.
+    Sending "previous_indexes" keeps the legacy client-side bookkeeping; otherwise a server-side
+    sampling session is opened (optionally with a "seed") and each response carries the "cursor"
+    to send back for the next batch.
+    A new session samples the whole table uniformly ("mode": "uniform", the default), draws a uniform
+    sample of "sample_size" records ("mode": "reservoir"), or draws a stratified sample ("mode": "stratified")
+    by "strata" (gender, health_center_id, province, district, sector, cell or village) with "proportional"
+    ("sample_size" records in total) or "fixed" ("quota" records per stratum) "allocation".
+    Opening a reservoir or stratified session costs a scan of the table in the database (a seeded hash
+    of every id, ranked per stratum) and only sends the sampled ids back; its batches cost O(batch_size).
+    The optional "columns" key (a list of column names) only returns these columns of the records.
 
     Args:
         table_name (str): The name of the table to retrieve data from.
@@ -165,17 +686,43 @@ def online_querying_api(table_name):
             # Access the JSON data from the request body
             json_data = request.get_json()
 
-            # Perform online querying with batch processing
-            results = online_querying(
-                table_name=table_name,
-                batch_size=json_data["batch_size"],
-                previous_indexes=json_data["previous_indexes"],
-                columns_to_drop=columns_to_drop
-            )
+            # Check the optional column selector against the table's model and the user's role
+            try:
+                columns = projection(table_name, parse_columns(json_data.get("columns")), columns_to_drop)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+            if "previous_indexes" in json_data:
+                # Perform online querying with batch processing (client-side list of previous indexes)
+                results = online_querying(
+                    table_name=table_name,
+                    batch_size=json_data["batch_size"],
+                    previous_indexes=json_data["previous_indexes"],
+                    columns_to_drop=columns_to_drop,
+                    columns=columns
+                )
+            else:
+                # Perform online querying with batch processing (server-side sampling session)
+                results = session_querying(
+                    table_name=table_name,
+                    batch_size=json_data["batch_size"],
+                    cursor=json_data.get("cursor"),
+                    seed=json_data.get("seed"),
+                    user_id=user_details.id,
+                    columns_to_drop=columns_to_drop,
+                    mode=json_data.get("mode", "uniform"),
+                    strata=json_data.get("strata"),
+                    allocation=json_data.get("allocation", "proportional"),
+                    sample_size=json_data.get("sample_size"),
+                    quota=json_data.get("quota"),
+                    columns=columns
+                )
 
             # If the status code is 200, format the data dictionary
             if results["status"] == 200:
-                results["data"] = results["data"].to_dict("index")
+                metrics.count_rows(results["number_of_samples"])
+                with metrics.phase("serialize"):
+                    results["data"] = results["data"].to_dict("index")
 
             # Log user activity and request details
             request_log.log(user_details_dict, request, columns_to_drop)
@@ -194,6 +741,8 @@ def online_querying_api(table_name):
 def entry_retrival(table_name, column_name, key):
     """
     Retrieve entries from a specified table based on user authentication, role, and key.
+    The "columns" query parameter (comma-separated column names) only returns these columns of the entries.
+    Responses carry a strong ETag, and matching "If-None-Match" requests are answered with "304 Not Modified".
 
     Args:
         table_name (str): The name of the table to retrieve entries from.
@@ -224,13 +773,25 @@ def entry_retrival(table_name, column_name, key):
                           "district", "province"]:
         return jsonify({"error": "table not found"}), 404
 
+    # Check the optional column selector against the table's model
+    try:
+        columns = projection(table_name, parse_columns(request.args.get("columns")), [])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     # Log user activity and request details
     request_log.log(user_details_dict, request, [])
 
+    # Answer conditional requests before touching the database
+    etag = response_etag(table_name, [], {"column_name": column_name, "key": key, "columns": columns})
+    if is_not_modified(etag):
+        return not_modified(etag)
+
     # Retrieve and return the queried entries as JSON
-    return jsonify(
-        entries_querying(key=key, table_name=table_name, key_column=column_name).to_dict("index")
-    ), 200
+    return tagged(Response(
+        json_body(entries_querying(key=key, table_name=table_name, key_column=column_name, columns=columns)),
+        mimetype="application/json"
+    ), etag), 200
 
 @app.route("/tables/<table_name>/create", methods=['POST'])
 def create_resource_endpoint(table_name):
@@ -282,6 +843,62 @@ def create_resource_endpoint(table_name):
     # If the content type is not JSON, return an error response
     return jsonify({'error': 'Invalid content type. Expected JSON data.'}), 400
 
+@app.route("/tables/<table_name>/bulk_create", methods=['POST'])
+def bulk_create_resources_endpoint(table_name):
+    """
+    Create several resources in a specified table, all or none of them,
+    based on user authentication, role, and request data (a JSON array of records).
+
+    Args:
+        table_name (str): The name of the table to create the resources in.
+
+    Returns:
+        tuple: A tuple containing a JSON response and a status code.
+               The JSON response lists the ids of the created resources, or the errors of the invalid records.
+    """
+    # Authenticate user and handle authentication errors
+    auth_results = authentication_function()
+    if auth_results["error"]:
+        return jsonify(auth_results), 400
+
+    # Extract user details from authentication results
+    user_details = auth_results["response"]
+    user_details_dict = vars(user_details).copy()
+
+    # Check if the user has appropriate role for this operation
+    if user_details.role not in ["health_worker", "sys_admin"]:
+        return jsonify({"response": "unauthorized"}), 401
+
+    # Check if the user's role and the table name are compatible
+    if user_details.role == "health_worker" and table_name not in ["patient", "blood_test", "malaria_results"]:
+        return jsonify({"response": "unauthorized"}), 401
+
+    # Check if the content type is JSON
+    if request.content_type != 'application/json':
+        return jsonify({'error': 'Invalid content type. Expected JSON data.'}), 400
+
+    # Access the JSON array of records from the request body
+    json_data = request.get_json(silent=True)
+    if not isinstance(json_data, list):
+        return jsonify({'error': 'Invalid JSON data, expected an array of records'}), 400
+    if len(json_data) > cfg["BULK_CREATE_MAX_RECORDS"]:
+        return jsonify({'error': f'Too many records, at most {cfg["BULK_CREATE_MAX_RECORDS"]} are accepted'}), 400
+
+    try:
+        # Create the resources using specified details
+        results = bulk_create_resources(resource_table_name=table_name, records=json_data)
+    except Exception as e:
+        return jsonify({'error': f'Invalid JSON data, {e}'}), 400
+
+    # Report the invalid records, none of the records was created
+    if "errors" in results:
+        return jsonify({"error": "invalid records, none was created", "errors": results["errors"]}), 400
+
+    # Log user activity and request details
+    request_log.log(user_details_dict, request, [])
+
+    return jsonify({"response": "resources created", "ids": results["ids"]}), 201
+
 @app.route("/tables/<table_name>/update/<id>", methods=['PUT','PATCH'])
 def update_resource_endpoint(table_name, id):
     """
@@ -367,5 +984,46 @@ def delete_resource_endpoint(table_name, id):
 
     return jsonify({"response": "resource deleted"}), 200
 
+@app.route("/stats", methods=['GET'])
+def stats_retrival():
+    """
+    Retrieve the counters of the server's in-process caches, response compression and request logger,
+    based on user authentication and role.
+
+    Returns:
+        tuple: A tuple containing a JSON response and a status code.
+               The JSON response contains the counters of each cache or an error message.
+    """
+    # Authenticate user and handle authentication errors
+    auth_results = authentication_function()
+    if auth_results["error"]:
+        return jsonify(auth_results), 400
+
+    # Check if the user has appropriate role for this operation
+    if auth_results["response"].role not in ["sys_admin"]:
+        return jsonify({"response": "unauthorized"}), 401
+
+    return jsonify({"auth_cache": credentials_cache.stats(),
+                    "result_cache": result_cache.response_cache.stats(),
+                    "compression": response_compression.stats(),
+                    "request_log": request_log.stats()}), 200
+
+@app.route("/metrics", methods=['GET'])
+def metrics_retrival():
+    """
+    Retrieve the request metrics (phase timings, durations, rows and response bytes per endpoint and table)
+    in the Prometheus text format. When METRICS_TOKEN is set, the request must carry it
+    as a "Bearer" token in its "Authorization" header.
+
+    Returns:
+        tuple: A tuple containing a text response and a status code.
+    """
+    # Check the token of the scraper if one is configured
+    if cfg["METRICS_TOKEN"] and not hmac.compare_digest(request.headers.get("Authorization") or "",
+                                                        f"Bearer {cfg['METRICS_TOKEN']}"):
+        return jsonify({"response": "unauthorized"}), 401
+
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4"), 200
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=cfg["SERVER_PORT"])
\ No newline at end of file
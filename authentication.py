@@ -2,15 +2,212 @@
 """The Authentication function source code
 DESCRIPTION:
 ------------
-This file contains the authentication function source code."""
+This file contains the authentication function source code.
+Passwords are stored as salted PBKDF2 hashes (plaintext passwords left by older versions are
+re-hashed on their first successful check). The /login endpoint verifies them once and issues a
+short-lived HMAC-signed token carrying the user's id, role, health center and token version, so requests
+sent with "Authorization: Bearer <token>" are authorized with CPU work and a cached lookup of the user's
+token version: updating a user increments it and deleting a user removes it, which revokes the tokens issued before.
+Requests authenticated with the legacy JSON credentials header go through the User lookup.
+Successful authentications are kept in a bounded in-process cache (LRU + TTL) indexed by a hash
+of the credentials, so repeated calls with the same credentials skip the User lookup.
+The cache and the token versions are cleared whenever the "user" table is updated or deleted from by this worker;
+other workers pick such changes up when their entries expire (AUTH_CACHE_TTL seconds).
+"""
 
 from flask import request, jsonify
 from db_models import *
+from config import cfg
+from types import SimpleNamespace
+from werkzeug.security import generate_password_hash, check_password_hash
+import cache
+import metrics
+import base64
+import hashlib
+import hmac
 import json
+import secrets
+import time
 
+# Cache of the recently authenticated users, indexed by a hash of their credentials
+credentials_cache = cache.LRUCache(max_entries=cfg["AUTH_CACHE_SIZE"], ttl=cfg["AUTH_CACHE_TTL"])
+
+# Cache of the users' current token versions (-1 for deleted users), indexed by user id
+token_versions_cache = cache.LRUCache(max_entries=cfg["AUTH_CACHE_SIZE"], ttl=cfg["AUTH_CACHE_TTL"])
+
+# Key used to sign the session tokens (a random key only suits a single worker: set TOKEN_SECRET)
+TOKEN_SECRET = (cfg["TOKEN_SECRET"] or secrets.token_hex(32)).encode()
+
+def hash_password(password):
+    """
+    Hash a password with a salted, deliberately slow key derivation function.
+
+    Args:
+        password (str): The password in clear.
+
+    Returns:
+        str: The password hash, as stored in the "password" column of the "user" table.
+    """
+    return generate_password_hash(str(password))
+
+def is_password_hash(stored_password):
+    """
+    Tell whether a stored password is a hash (rather than a plaintext password left by an older version).
+
+    Args:
+        stored_password (str): The value of the "password" column.
+
+    Returns:
+        bool: True if the value is a password hash.
+    """
+    return str(stored_password).startswith("pbkdf2:") and str(stored_password).count("$") == 2
+
+@metrics.timed("auth")
+def verify_password(user_details, password):
+    """
+    Check a password against a user's stored password, upgrading a plaintext stored password to a hash.
+
+    Args:
+        user_details (User): The user loaded from the database.
+        password (str): The password in clear.
+
+    Returns:
+        bool: True if the password is correct.
+    """
+    if is_password_hash(user_details.password):
+        return check_password_hash(user_details.password, str(password))
+    if user_details.password is None or not hmac.compare_digest(str(user_details.password), str(password)):
+        return False
+    user_details.password = hash_password(password)
+    db.session.commit()
+    return True
+
+def _b64encode(data):
+    """
+    Encode bytes as unpadded base64url text.
+
+    Args:
+        data (bytes): The bytes to encode.
+
+    Returns:
+        str: The encoded text.
+    """
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data):
+    """
+    Decode unpadded base64url text.
+
+    Args:
+        data (str): The text to decode.
+
+    Returns:
+        bytes: The decoded bytes.
+    """
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def issue_token(user_details):
+    """
+    Issue a signed session token for an authenticated user.
+
+    Args:
+        user_details: The authenticated user (a User or its snapshot).
+
+    Returns:
+        str: The token, made of the base64url-encoded claims and their HMAC-SHA256 signature.
+    """
+    claims = {"id": user_details.id,
+              "role": user_details.role,
+              "health_center_id": user_details.health_center_id,
+              "ver": user_details.token_version or 0,
+              "exp": int(time.time() + cfg["TOKEN_TTL"])}
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    signature = _b64encode(hmac.new(TOKEN_SECRET, payload.encode(), hashlib.sha256).digest())
+    return f"{payload}.{signature}"
+
+def current_token_version(user_id):
+    """
+    Read the current token version of a user, from the cache or the database.
+
+    Args:
+        user_id (int): The id of the user.
+
+    Returns:
+        int: The user's token version, or -1 if the user does not exist (anymore).
+    """
+    version = token_versions_cache.get(user_id)
+    if version is None:
+        user_details = User.query.with_entities(User.token_version).filter_by(id=user_id).first()
+        version = -1 if user_details is None else user_details.token_version or 0
+        token_versions_cache.set(user_id, version)
+    return version
+
+def verify_token(token):
+    """
+    Verify a session token's signature, expiry and version (tokens issued before the user
+    was updated or deleted are rejected).
+
+    Args:
+        token (str): The token sent by the client.
+
+    Returns:
+        types.SimpleNamespace: The user's id, role and health_center_id, or None if the token is invalid, expired
+                               or revoked.
+    """
+    try:
+        payload, signature = token.split(".")
+        expected_signature = _b64encode(hmac.new(TOKEN_SECRET, payload.encode(), hashlib.sha256).digest())
+        if not hmac.compare_digest(signature, expected_signature):
+            return None
+        claims = json.loads(_b64decode(payload))
+        if claims["exp"] <= time.time():
+            return None
+        if claims.get("ver", 0) != current_token_version(claims["id"]):
+            return None
+        return SimpleNamespace(id=claims["id"], role=claims["role"], health_center_id=claims["health_center_id"])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+def credentials_key(creds_dict):
+    """
+    Hash credentials into a cache key, so that no password is kept in memory in clear.
+
+    Args:
+        creds_dict (dict): The credentials, with "email" and "password" keys.
+
+    Returns:
+        str: The SHA-256 hex digest of the credentials.
+    """
+    return hashlib.sha256(json.dumps([str(creds_dict["email"]), str(creds_dict["password"])]).encode()).hexdigest()
+
+def user_snapshot(user_details):
+    """
+    Copy the column values of a User into a plain object that outlives the database session.
+
+    Args:
+        user_details (User): The user loaded from the database.
+
+    Returns:
+        types.SimpleNamespace: The user's column values, as attributes.
+    """
+    return SimpleNamespace(**{column.name: getattr(user_details, column.name)
+                              for column in User.__table__.columns})
+
+def invalidate_credentials_cache():
+    """
+    Forget every cached authentication and token version (called when the "user" table is written to).
+
+    Returns:
+        None
+    """
+    credentials_cache.clear()
+    token_versions_cache.clear()
+
+@metrics.timed("auth")
 def authentication_function():
     """
-    Authenticate a user based on provided credentials in the request headers.
+    Authenticate a user based on provided credentials in the request headers,
+    either a "Bearer" session token or the JSON-encoded email and password.
 
     Returns:
         dict: A dictionary containing authentication response and error status.
@@ -18,17 +215,29 @@ def authentication_function():
               If authentication fails due to bad/no credentials, bad email, or incorrect password,
               sets "error" to True and provides an appropriate response.
     """
+    authorization = request.headers.get('Authorization') or ""
+    if authorization.startswith("Bearer "):
+        user_details = verify_token(authorization[len("Bearer "):])
+        if user_details is None:
+            return ({"error": True, "response":"invalid or expired token"})
+        return {"response": user_details, "error": False}
     try:
-        creds_dict = json.loads(request.headers.get('Authorization'))
+        creds_dict = json.loads(authorization)
+        cache_key = credentials_key(creds_dict)
     except:
         return ({"error": True, "response":"bad/no auth credentials"})
+    user_details = credentials_cache.get(cache_key)
+    if user_details is not None:
+        return {"response": user_details, "error": False}
     try:
         user_details = User.query.filter_by(email=creds_dict["email"]).first()
     except:
         return ({"error": True, "response":"bad email or password"})
     try:
-        assert creds_dict["password"] == user_details.password
+        assert verify_password(user_details, creds_dict["password"])
     except:
         return ({"error": True, "response":"bad email or password"})
-    
-    return {"response": user_details, "error": False}
\ No newline at end of file
+
+    user_details = user_snapshot(user_details)
+    credentials_cache.set(cache_key, user_details)
+    return {"response": user_details, "error": False}
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""The aggregation benchmark
+DESCRIPTION:
+------------
+This file compares the two ways the aggregation endpoint answers a "case_cache" request:
+    - scan: the GROUP BY query on "case_cache" (aggregation.compile_query),
+    - rollup: the GROUP BY query on the pre-aggregated "case_rollup" table (aggregation.compile_rollup_query),
+and checks that both return the same groups, for each dimension (and a few combinations), with and without
+a date range. The check is run on the rollup as rebuilt from "case_cache", then with --undated cases without
+a date (copies of existing cases) added through the incremental updates, rebuilt again, and removed.
+It runs against the database configured in the .env file: the undated cases are removed at the end,
+and the rollup is left rebuilt.
+
+USAGE:
+------
+python benchmarks/bench_aggregation.py --undated 100 --early-date 2020-01-01 --late-date 2030-01-01
+"""
+
+import argparse
+import math
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from db_models import db
+import db_models
+import controllers
+import id_allocation
+import rollup
+
+# Requests compared, as (dimensions, metrics)
+REQUESTS = [
+    ([], ["count", "positive_rate"]),
+    (["gender"], ["count", "positive_rate"]),
+    (["malaria_status", "parasite_type"], ["count"]),
+    (["province"], ["count", "positive_rate"]),
+    (["district"], ["count"]),
+    (["sector"], ["count"]),
+    (["cell"], ["count"]),
+    (["village"], ["count"]),
+    (["day"], ["count"]),
+    (["week"], ["count"]),
+    (["month"], ["count", "positive_rate"]),
+    (["year"], ["count"]),
+    (["province", "month", "gender"], ["count", "positive_rate"]),
+]
+
+def timed(function, repeats):
+    """
+    Run a function several times and measure its median duration.
+
+    Args:
+        function (callable): The function to run.
+        repeats (int): The number of runs.
+
+    Returns:
+        tuple: The median duration in milliseconds and the function's last result.
+    """
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations), result
+
+def normalized(response_df):
+    """
+    Turn the groups of an aggregation into a sorted list, comparable whatever the path and the database driver.
+
+    Args:
+        response_df (pandas.DataFrame): The groups.
+
+    Returns:
+        list: The groups, as tuples (numbers as rounded floats, missing values as None).
+    """
+    def value(item):
+        if item is None or (isinstance(item, float) and math.isnan(item)):
+            return None
+        if isinstance(item, str):
+            return item
+        return round(float(item), 9)
+    return sorted([tuple(value(item) for item in row) for row in response_df.itertuples(index=False)], key=repr)
+
+def compare(label, date_ranges, repeats):
+    """
+    Answer every request through both paths and check that they agree.
+
+    Args:
+        label (str): The state of the rollup, printed with the results.
+        date_ranges (list): The (early_date, late_date) ranges of the requests ((None, None) for no range).
+        repeats (int): The number of runs of each query.
+
+    Returns:
+        int: The number of requests on which the two paths disagree.
+    """
+    mismatches = 0
+    for early_date, late_date in date_ranges:
+        for group_by, metrics in REQUESTS:
+            durations, results = [], []
+            for use_rollup in [False, True]:
+                duration, response_df = timed(
+                    lambda: controllers.table_aggregating("case_cache", group_by=group_by, metrics=metrics,
+                                                          columns_to_drop=[], early_date=early_date,
+                                                          late_date=late_date, use_rollup=use_rollup), repeats)
+                durations.append(duration)
+                results.append(normalized(response_df))
+            agree = results[0] == results[1]
+            mismatches += not agree
+            date_range = f"{early_date}..{late_date}" if early_date is not None else "all"
+            print(f"{label:>20} | {date_range:>22} | {'+'.join(group_by) or '-':>28} | {len(results[0]):>6} | "
+                  f"{durations[0]:>9.1f} | {durations[1]:>11.1f} | {'ok' if agree else 'MISMATCH':>8}")
+    return mismatches
+
+def add_undated_cases(count):
+    """
+    Add copies of existing cases without a date to "case_cache", updating the rollup incrementally.
+
+    Args:
+        count (int): The number of cases.
+
+    Returns:
+        list: The added cases, as dictionaries of their columns.
+    """
+    table = db_models.Case_cache.__table__
+    rows = db.session.execute(table.select().order_by(table.c.id).limit(count)).fetchall()
+    cases = []
+    for new_id, row in zip(id_allocation.allocate_ids("case_cache", len(rows)), rows):
+        cases.append(dict(row, id=new_id, date=None))
+    if cases:
+        db.session.execute(table.insert(), cases)
+        rollup.record_cases(added=cases)
+    db.session.commit()
+    return cases
+
+def remove_cases(cases):
+    """
+    Remove cases from "case_cache", updating the rollup incrementally.
+
+    Args:
+        cases (list): The cases, as dictionaries of their columns.
+
+    Returns:
+        None
+    """
+    if cases:
+        table = db_models.Case_cache.__table__
+        db.session.execute(table.delete().where(table.c.id.in_([case["id"] for case in cases])))
+        rollup.record_cases(removed=cases)
+    db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the aggregation paths (case_cache scan vs rollup).")
+    parser.add_argument("--undated", type=int, default=100, help="cases without a date added for the check")
+    parser.add_argument("--early-date", default="2020-01-01")
+    parser.add_argument("--late-date", default="2030-01-01")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    date_ranges = [(None, None), (args.early_date, args.late_date)]
+    print(f"{'rollup':>20} | {'date range':>22} | {'group by':>28} | {'groups':>6} | "
+          f"{'scan (ms)':>9} | {'rollup (ms)':>11} | {'check':>8}")
+    mismatches = 0
+    with app.app_context():
+        rollup.rebuild()
+        mismatches += compare("rebuilt", date_ranges, args.repeats)
+        cases = add_undated_cases(args.undated)
+        try:
+            mismatches += compare(f"+{len(cases)} undated", date_ranges, args.repeats)
+            rollup.rebuild()
+            mismatches += compare(f"rebuilt, {len(cases)} undated", date_ranges, args.repeats)
+        finally:
+            remove_cases(cases)
+        mismatches += compare("undated removed", date_ranges, args.repeats)
+
+    if mismatches:
+        print(f"{mismatches} requests answered differently by the scan and the rollup")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
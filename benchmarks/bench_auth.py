@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""The authentication benchmark
+DESCRIPTION:
+------------
+This file measures the throughput of the ways a request can be authenticated:
+    - lookup: the pre-token path (User lookup by email, then a plaintext comparison),
+    - credentials (cold): the JSON credentials header with an empty cache (User lookup + password hash check),
+    - credentials (cached): the JSON credentials header served by the in-process credentials cache,
+    - token: a "Bearer" session token issued by /login (signature and expiry check, no database access).
+It runs against the database configured in the .env file, which must contain the given user.
+
+USAGE:
+------
+python benchmarks/bench_auth.py --email 1000@gmail.com --password qwert2000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from db_models import User
+import authentication
+
+def throughput(function, iterations):
+    """
+    Call a function repeatedly and measure its throughput.
+
+    Args:
+        function (callable): The function to call.
+        iterations (int): The number of calls.
+
+    Returns:
+        tuple: The number of calls per second and the mean duration of a call in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    duration = time.perf_counter() - start
+    return iterations / duration, duration / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the authentication paths.")
+    parser.add_argument("--email", default="1000@gmail.com")
+    parser.add_argument("--password", default="qwert2000")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--cold-iterations", type=int, default=20,
+                        help="iterations of the cold credentials path (each one derives a password hash)")
+    args = parser.parse_args()
+
+    credentials_header = json.dumps({"email": args.email, "password": args.password})
+    with app.test_request_context(headers={"Authorization": credentials_header}):
+        user_details = User.query.filter_by(email=args.email).first()
+        token = authentication.issue_token(user_details)
+
+        def lookup():
+            user = User.query.filter_by(email=args.email).first()
+            return user.password == args.password
+
+        def credentials_cold():
+            authentication.invalidate_credentials_cache()
+            assert not authentication.authentication_function()["error"]
+
+        def credentials_cached():
+            assert not authentication.authentication_function()["error"]
+
+        results = [("lookup", throughput(lookup, args.iterations)),
+                   ("credentials (cold)", throughput(credentials_cold, args.cold_iterations)),
+                   ("credentials (cached)", throughput(credentials_cached, args.iterations))]
+
+    with app.test_request_context(headers={"Authorization": f"Bearer {token}"}):
+        def token_path():
+            assert not authentication.authentication_function()["error"]
+
+        results.append(("token", throughput(token_path, args.iterations)))
+
+    print(f"{'path':>22} | {'calls/s':>10} | {'us/call':>10}")
+    for name, (calls_per_second, microseconds) in results:
+        print(f"{name:>22} | {calls_per_second:>10.0f} | {microseconds:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+"""The endpoints benchmark
+DESCRIPTION:
+------------
+This file load-tests every route of app.py over HTTP: the server runs in its own process (threaded, without
+the debugger), and a configurable number of concurrent clients send each scenario's requests in turn
+(full table, paging, region filter and column selector, NDJSON stream, time filter with and without an "Accept"
+header, aggregation, sampling, entry lookup, create, bulk create, update, delete, login, stats).
+For each scenario it records the throughput,
+the p50/p95/p99 latencies and the errors, along with the peak RSS of the server, into a JSON report.
+With --baseline, the report is compared with a previous one, and the scenarios whose throughput fell or
+whose p95 latency grew by more than --tolerance are reported as regressions (exit status 1).
+For each of the --scales (number of blood tests, results and cases; half as many patients), the DEVELOPMENT
+database configured in the .env file is reloaded with a synthetic dataset (synthetic_data.py, migrate.py),
+which drops its current data; --no-seed runs a single pass against the database as it is.
+
+USAGE:
+------
+python benchmarks/bench_endpoints.py --scales 10000 100000 --clients 8 --requests 200 --report bench_report.json
+python benchmarks/bench_endpoints.py --scales 10000 100000 --baseline bench_report.json
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_PATH)
+
+from config import cfg
+import synthetic_data
+
+# Command starting the server (threaded, without the debugger and its reloader)
+SERVER_COMMAND = "from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"
+
+class Server:
+    """
+    The server, running app.py in its own process.
+
+    Args:
+        port (int): The port the server listens on.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.process = subprocess.Popen([sys.executable, "-c", SERVER_COMMAND.format(port=port)],
+                                        cwd=REPOSITORY_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # Wait for the server to answer
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                request(port, "GET", "/")
+                return
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("the server did not start")
+                time.sleep(0.2)
+
+    def peak_rss_mb(self):
+        """
+        Read the peak resident set size of the server process (Linux only).
+
+        Returns:
+            float: The peak RSS in megabytes, or None if it cannot be read.
+        """
+        try:
+            with open(f"/proc/{self.process.pid}/status") as status_file:
+                for line in status_file:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            return None
+        return None
+
+    def stop(self):
+        """
+        Stop the server process.
+
+        Returns:
+            None
+        """
+        self.process.terminate()
+        self.process.wait()
+
+def free_port():
+    """
+    Find a free local port.
+
+    Returns:
+        int: The port.
+    """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def request(port, method, path, body=None, headers={}):
+    """
+    Send one request to the server and read its whole response.
+
+    Args:
+        port (int): The port of the server.
+        method (str): The HTTP method.
+        path (str): The path (with its query string).
+        body (optional): The JSON data of the request. Defaults to None.
+        headers (dict, optional): The headers of the request. Defaults to {}.
+
+    Returns:
+        tuple: The status code and the body of the response.
+    """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    try:
+        headers = dict(headers)
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        connection.request(method, path, body=data, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+def scenarios(port, headers, early_date, late_date):
+    """
+    Build the scenarios of the benchmark: for each route, a function building the i-th request.
+
+    Args:
+        port (int): The port of the server.
+        headers (dict): The headers of the requests (authentication, content negotiation).
+        early_date (str): The start of the time filter's range.
+        late_date (str): The end of the time filter's range.
+
+    Returns:
+        list: The (name, function of i returning the (method, path, body, headers) of a request) scenarios, in order.
+    """
+    json_headers = dict(headers, Accept="application/json")
+
+    # Find an existing patient, to copy its village and health center into the created ones
+    status, body = request(port, "GET", "/tables/patient?limit=1", headers=headers)
+    patient = json.loads(body)["data"]["0"]
+    new_patient = {"name": "BENCHMARK", "date_of_birth": "2000-01-01T00:00:00", "gender": "female",
+                   "village_id": patient["village_id"], "health_center_id": patient["health_center_id"]}
+    created_ids = []
+    created_ids_lock = threading.Lock()
+
+    def bulk_create(i):
+        return "POST", "/tables/patient/bulk_create", [new_patient] * 10, headers
+
+    def created_id(i):
+        with created_ids_lock:
+            return created_ids[i % len(created_ids)]
+
+    return [
+        ("index", lambda i: ("GET", "/", None, {})),
+        ("login", lambda i: ("POST", "/login", {"email": "1000@gmail.com", "password": "qwert2000"}, {})),
+        ("table_full", lambda i: ("GET", "/tables/case_cache", None, json_headers)),
+        ("table_page", lambda i: ("GET", f"/tables/case_cache?limit=1000&after_id={i * 1000 - 1}", None, headers)),
+        ("table_region_columns", lambda i: ("GET", f"/tables/case_cache?province={i % 5 + 1}"
+                                                   f"&columns=id,date,malaria_status", None, json_headers)),
+        ("table_ndjson", lambda i: ("GET", "/tables/patient", None, dict(headers, Accept="application/x-ndjson"))),
+        ("timefilter", lambda i: ("GET", "/tables/case_cache/timefilter",
+                                  {"early_date": early_date, "late_date": late_date}, json_headers)),
+        ("timefilter_no_accept", lambda i: ("GET", "/tables/case_cache/timefilter",
+                                            {"early_date": early_date, "late_date": late_date}, headers)),
+        ("aggregate", lambda i: ("POST", "/tables/case_cache/aggregate",
+                                 {"group_by": ["district", "malaria_status"], "metrics": ["count"]}, headers)),
+        ("sampling", lambda i: ("GET", "/tables/patient/sampling", {"batch_size": 100, "seed": i}, headers)),
+        ("entry", lambda i: ("GET", f"/tables/patient/id/{i}", None, headers)),
+        ("create", lambda i: ("POST", "/tables/patient/create", new_patient, headers)),
+        ("bulk_create", bulk_create),
+        ("update", lambda i: ("PATCH", f"/tables/patient/update/{created_id(i)}", {"name": "UPDATED"}, headers)),
+        ("delete", lambda i: ("DELETE", f"/tables/patient/delete/{created_id(i)}", None, headers)),
+        ("stats", lambda i: ("GET", "/stats", None, headers)),
+    ], created_ids
+
+def run_scenario(port, build_request, requests_count, clients, on_response=None):
+    """
+    Send a scenario's requests from concurrent clients and measure them.
+
+    Args:
+        port (int): The port of the server.
+        build_request (callable): The function building the i-th request.
+        requests_count (int): The number of requests.
+        clients (int): The number of concurrent clients.
+        on_response (callable, optional): A function called with each successful response's body. Defaults to None.
+
+    Returns:
+        dict: The number of requests and errors, the throughput (requests/s), and the mean, p50, p95 and p99
+              latencies (in milliseconds).
+    """
+    latencies = []
+    errors = [0]
+    counter = iter(range(requests_count))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            method, path, body, headers = build_request(i)
+            started_at = time.perf_counter()
+            try:
+                status, response_body = request(port, method, path, body, headers)
+            except OSError:
+                status, response_body = None, None
+            latency = (time.perf_counter() - started_at) * 1000
+            with lock:
+                latencies.append(latency)
+                if status is None or status >= 400:
+                    errors[0] += 1
+            if status is not None and status < 400 and on_response is not None:
+                on_response(response_body)
+
+    started_at = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started_at
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {"requests": len(latencies),
+            "errors": errors[0],
+            "throughput": round(len(latencies) / duration, 2),
+            "mean_ms": round(statistics.fmean(latencies), 2),
+            "p50_ms": round(percentiles[49], 2),
+            "p95_ms": round(percentiles[94], 2),
+            "p99_ms": round(percentiles[98], 2)}
+
+def seed_database(scale, seed):
+    """
+    Reload the development database with a synthetic dataset.
+
+    Args:
+        scale (int): The number of blood tests, results and cases (half as many patients).
+        seed (int): The seed of the dataset.
+
+    Returns:
+        None
+    """
+    with tempfile.TemporaryDirectory() as datasets_path:
+        synthetic_data.generate(datasets_path, patients=max(scale // 2, 1), blood_tests=scale, seed=seed)
+        subprocess.run([sys.executable, "migrate.py", "--datasets", datasets_path], cwd=REPOSITORY_PATH,
+                       stdout=subprocess.DEVNULL, check=True)
+
+def benchmark(args):
+    """
+    Run every scenario against a freshly started server.
+
+    Args:
+        args (argparse.Namespace): The options of the benchmark.
+
+    Returns:
+        dict: The peak RSS of the server ("peak_rss_mb") and the measures of each scenario ("scenarios").
+    """
+    port = free_port()
+    server = Server(port)
+    try:
+        status, body = request(port, "POST", "/login", {"email": args.email, "password": args.password})
+        headers = {"Authorization": f"Bearer {json.loads(body)['token']}"}
+        if args.accept_encoding:
+            headers["Accept-Encoding"] = args.accept_encoding
+        scenario_list, created_ids = scenarios(port, headers, args.early_date, args.late_date)
+
+        results = {}
+        for name, build_request in scenario_list:
+            # Skip the scenarios working on created resources when bulk_create created none
+            if name in ["update", "delete"] and not created_ids:
+                results[name] = {"skipped": "no resource was created by bulk_create"}
+                print(f"  {name:<22} skipped: {results[name]['skipped']}")
+                continue
+            on_response = None
+            if name == "bulk_create":
+                on_response = lambda body: created_ids.extend(json.loads(body)["ids"])
+            results[name] = run_scenario(port, build_request, args.requests, args.clients, on_response)
+            print(f"  {name:<22} {results[name]['throughput']:>9.1f} req/s  p50 {results[name]['p50_ms']:>8.1f} ms  "
+                  f"p95 {results[name]['p95_ms']:>8.1f} ms  p99 {results[name]['p99_ms']:>8.1f} ms  "
+                  f"errors {results[name]['errors']}")
+        return {"peak_rss_mb": server.peak_rss_mb(), "scenarios": results}
+    finally:
+        server.stop()
+
+def compare(report, baseline, tolerance):
+    """
+    Compare a report with a baseline report.
+
+    Args:
+        report (dict): The report of this run.
+        baseline (dict): The baseline report.
+        tolerance (float): The relative change (e.g. 0.2 for 20%) above which a change is a regression.
+
+    Returns:
+        list: The regressions found, as strings.
+    """
+    regressions = []
+    for scale, scale_results in report["scales"].items():
+        baseline_results = baseline["scales"].get(scale)
+        if baseline_results is None:
+            continue
+        print(f"scale {scale} vs baseline:")
+        for name, measures in scale_results["scenarios"].items():
+            reference = baseline_results["scenarios"].get(name)
+            if reference is None or "skipped" in measures or "skipped" in reference:
+                continue
+            throughput_change = measures["throughput"] / max(reference["throughput"], 1e-9) - 1
+            p95_change = measures["p95_ms"] / max(reference["p95_ms"], 1e-9) - 1
+            regressed = throughput_change < -tolerance or p95_change > tolerance
+            print(f"  {name:<22} throughput {throughput_change:>+7.1%}  p95 {p95_change:>+7.1%}"
+                  f"{'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append(f"{scale}/{name}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the endpoints of the server.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000],
+                        help="numbers of blood tests, results and cases of the synthetic datasets")
+    parser.add_argument("--no-seed", action="store_true", help="run once against the database as it is")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic datasets")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--email", default="1000@gmail.com", help="email of a sys_admin user")
+    parser.add_argument("--password", default="qwert2000")
+    parser.add_argument("--early-date", default="2019-01-01", help="start of the time filter's range")
+    parser.add_argument("--late-date", default="2019-02-01", help="end of the time filter's range")
+    parser.add_argument("--accept-encoding", default=None, help="Accept-Encoding header of the requests")
+    parser.add_argument("--report", default="bench_report.json", help="path of the JSON report")
+    parser.add_argument("--baseline", default=None, help="path of a previous JSON report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change reported as a regression")
+    args = parser.parse_args()
+
+    if not args.no_seed and cfg["APP_ENVIRONMENT"] != "DEVELOPMENT":
+        parser.error("seeding reloads the database, it is only done in the DEVELOPMENT environment (see --no-seed)")
+
+    report = {"created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+              "options": {"clients": args.clients, "requests": args.requests, "seed": args.seed,
+                          "accept_encoding": args.accept_encoding},
+              "scales": {}}
+    for scale in ["current"] if args.no_seed else args.scales:
+        if scale != "current":
+            print(f"seeding {scale} blood tests...")
+            seed_database(scale, args.seed)
+        print(f"scale {scale}:")
+        report["scales"][str(scale)] = benchmark(args)
+        print(f"  peak RSS of the server: {report['scales'][str(scale)]['peak_rss_mb']} MB")
+
+    with open(args.report, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"report written to {args.report}")
+
+    # Compare with the baseline, failing on regressions
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""The serialization benchmark
+DESCRIPTION:
+------------
+This file compares the two ways of encoding the records of a read endpoint as JSON:
+    - pandas: the former path (DataFrame of the rows, column drop, to_dict("index"), jsonify),
+    - serializer: serializers.encode_records (rows encoded straight into JSON with per-table column encoders).
+The rows are synthetic "case_cache" records, read back from a scratch in-memory SQLite database through a typed
+select (so the dates are datetimes, as returned by the PostgreSQL driver), and both outputs are checked to be equal.
+Like the server, it reads the .env file.
+
+USAGE:
+------
+python benchmarks/bench_serialization.py --rows 10000 100000
+"""
+
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import time
+import pandas as pd
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app
+from flask import jsonify
+import db_models
+import serializers
+
+def build_rows(rows):
+    """
+    Create synthetic "case_cache" records in a scratch in-memory database and read them back.
+
+    Args:
+        rows (int): The number of records.
+
+    Returns:
+        list: The rows, as returned by the database driver.
+    """
+    engine = sa.create_engine("sqlite://")
+    table = db_models.Case_cache.__table__
+    table.create(engine)
+    generator = random.Random(0)
+    start = datetime.datetime(2020, 1, 1)
+    with engine.begin() as connection:
+        connection.execute(table.insert(), [
+            {"id": i, "patient_id": generator.randrange(10000), "blood_test_id": i,
+             "date": start + datetime.timedelta(minutes=generator.randrange(2000000)),
+             "name": "".join(generator.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ") for _ in range(10)),
+             "date_of_birth": start - datetime.timedelta(days=generator.randrange(30000)),
+             "gender": generator.choice(["male", "female"]),
+             "village_id": generator.choice([11010101, 24100303, 34110309, 52120405]),
+             "health_center_id": generator.randrange(300),
+             "malaria_status": generator.choice(["positive", "negative"]),
+             "parasite_type": generator.choice(["falciparum", "vivax", None])}
+            for i in range(rows)
+        ])
+    with engine.connect() as connection:
+        return connection.execute(table.select().order_by(table.c.id)).fetchall()
+
+def pandas_path(rows, columns_to_drop):
+    """
+    Encode records through the former DataFrame path.
+
+    Args:
+        rows (list): The rows.
+        columns_to_drop (list): The columns to leave out.
+
+    Returns:
+        bytes: The response body.
+    """
+    response_df = pd.DataFrame([i for i in rows])
+    response_df = response_df.drop(columns=list(set(response_df.columns) & set(columns_to_drop)))
+    return jsonify(response_df.to_dict("index")).get_data()
+
+def serializer_path(rows, columns_to_drop):
+    """
+    Encode records through the serializer.
+
+    Args:
+        rows (list): The rows.
+        columns_to_drop (list): The columns to leave out.
+
+    Returns:
+        bytes: The response body.
+    """
+    return (serializers.encode_records(rows, "case_cache", columns_to_drop=columns_to_drop) + "\n").encode()
+
+def timed(function, repeats):
+    """
+    Run a function several times and measure its median duration.
+
+    Args:
+        function (callable): The function to run.
+        repeats (int): The number of runs.
+
+    Returns:
+        tuple: The median duration in milliseconds and the function's last result.
+    """
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations), result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the JSON encoding of the read endpoints.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} | {'projection':>10} | {'pandas (ms)':>11} | {'serializer (ms)':>15} | {'speedup':>7} | {'MB':>6}")
+    with app.app_context():
+        for rows in args.rows:
+            records = build_rows(rows)
+            for projection, columns_to_drop in [("all", []), ("no name", ["name"])]:
+                pandas_ms, pandas_body = timed(lambda: pandas_path(records, columns_to_drop), args.repeats)
+                serializer_ms, serializer_body = timed(lambda: serializer_path(records, columns_to_drop), args.repeats)
+                assert pandas_body == serializer_body, "the two paths disagree"
+                print(f"{rows:>8} | {projection:>10} | {pandas_ms:>11.1f} | {serializer_ms:>15.1f} | "
+                      f"{pandas_ms / serializer_ms:>6.1f}x | {len(serializer_body) / 1e6:>6.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""The Bulk loader
+DESCRIPTION:
+------------
+This file contains the loader of the CSV datasets into the database (used by migrate.py).
+Each CSV file is read in chunks of BULK_LOAD_CHUNK_SIZE rows (only one chunk is held in memory at a time)
+and written through the dialect's native bulk path:
+    - on PostgreSQL (psycopg2), each chunk is sent with "COPY ... FROM STDIN" (CSV format),
+    - on the other dialects, each chunk is inserted with one batched "executemany", its values converted
+      to the types of the table's model.
+A table is loaded in a single transaction. Tables are loaded by BULK_LOAD_WORKERS threads, each table as soon as
+the tables it references (its foreign keys: province -> ... -> village -> patient -> blood_test ->
+malaria_results -> case_cache) are loaded; SQLite allows a single writer, so its tables are loaded one by one.
+The secondary indexes of the loaded tables are dropped during the load and built once at the end.
+"""
+
+import concurrent.futures
+import csv
+import datetime
+import io
+import time
+from config import cfg
+from db_models import db
+
+def _parser(column_type):
+    """
+    Choose the function converting a CSV field to the value of a column, from the column's type.
+
+    Args:
+        column_type (sqlalchemy.types.TypeEngine): The type of the column.
+
+    Returns:
+        callable: The function converting a (non-empty) CSV field.
+    """
+    if isinstance(column_type, db.Integer):
+        return int
+    if isinstance(column_type, db.Float):
+        return float
+    if isinstance(column_type, db.DateTime):
+        return datetime.datetime.fromisoformat
+    if isinstance(column_type, db.Date):
+        return lambda value: datetime.date.fromisoformat(value[:10])
+    return str
+
+def read_chunks(path, chunk_size, transform=None):
+    """
+    Read a CSV file chunk by chunk.
+
+    Args:
+        path (str): The path of the CSV file (with a header line).
+        chunk_size (int): The number of rows per chunk.
+        transform (callable, optional): A function applied to each record (a dictionary of the row's fields,
+                                        indexed by column name), returning the record to load. Defaults to None.
+
+    Yields:
+        tuple: The columns of the file (from its header) and the next chunk of at most chunk_size rows (lists of fields).
+    """
+    with open(path, newline="", encoding="utf-8") as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+        while True:
+            rows = [row for _, row in zip(range(chunk_size), reader)]
+            if not rows:
+                break
+            if transform is not None:
+                rows = [[record[column] for column in columns]
+                        for record in (transform(dict(zip(columns, row))) for row in rows)]
+            yield columns, rows
+
+def _copy_chunks(table, chunks):
+    """
+    Load chunks of rows into a table with PostgreSQL's "COPY ... FROM STDIN", in a single transaction.
+
+    Args:
+        table (sqlalchemy.Table): The table.
+        chunks (iterable): The (columns, rows) chunks, as yielded by read_chunks.
+
+    Returns:
+        int: The number of loaded rows.
+    """
+    count = 0
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for columns, rows in chunks:
+            # Write the chunk back as CSV (empty fields are loaded as NULL)
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
+            cursor.copy_expert(f"copy {table.name} ({', '.join(columns)}) from stdin with (format csv)", buffer)
+            count += len(rows)
+        connection.commit()
+    finally:
+        connection.close()
+    return count
+
+def _insert_chunks(table, chunks):
+    """
+    Load chunks of rows into a table with batched inserts ("executemany"), in a single transaction.
+
+    Args:
+        table (sqlalchemy.Table): The table.
+        chunks (iterable): The (columns, rows) chunks, as yielded by read_chunks.
+
+    Returns:
+        int: The number of loaded rows.
+    """
+    count = 0
+    with db.engine.begin() as connection:
+        for columns, rows in chunks:
+            # Convert the fields to the types of the table's columns (empty fields are loaded as NULL)
+            parsers = [_parser(table.columns[column].type) for column in columns]
+            records = [{column: None if field == "" else parse(field)
+                        for column, parse, field in zip(columns, parsers, row)}
+                       for row in rows]
+            connection.execute(table.insert(), records)
+            count += len(records)
+    return count
+
+def load_table(table_name, path, chunk_size=None, transform=None):
+    """
+    Load a CSV file into a table, through the dialect's native bulk path.
+
+    Args:
+        table_name (str): The name of the table.
+        path (str): The path of the CSV file, whose header names columns of the table.
+        chunk_size (int, optional): The number of rows per chunk. Defaults to None (BULK_LOAD_CHUNK_SIZE).
+        transform (callable, optional): A function applied to each record before it is loaded. Defaults to None.
+
+    Returns:
+        dict: The number of loaded rows, the duration of the load (in seconds) and its throughput (rows/s).
+
+    Raises:
+        ValueError: If the CSV file has columns that the table does not have.
+    """
+    table = db.metadata.tables[table_name]
+    with open(path, newline="", encoding="utf-8") as csv_file:
+        unknown_columns = [column for column in next(csv.reader(csv_file)) if column not in table.columns]
+    if unknown_columns:
+        raise ValueError(f"{path}: unknown columns of {table_name}: {', '.join(unknown_columns)}")
+
+    started_at = time.perf_counter()
+    chunks = read_chunks(path, chunk_size or cfg["BULK_LOAD_CHUNK_SIZE"], transform=transform)
+    if db.engine.dialect.name == "postgresql" and db.engine.dialect.driver == "psycopg2":
+        count = _copy_chunks(table, chunks)
+    else:
+        count = _insert_chunks(table, chunks)
+    duration = time.perf_counter() - started_at
+    return {"rows": count, "seconds": round(duration, 3), "rows_per_second": round(count / max(duration, 1e-9))}
+
+def load_order(table_names):
+    """
+    Find the tables each table has to wait for, from the foreign keys between the loaded tables.
+
+    Args:
+        table_names (list): The names of the loaded tables.
+
+    Returns:
+        dict: The names of the loaded tables each table references, indexed by table name.
+    """
+    return {table_name: {foreign_key.column.table.name
+                         for foreign_key in db.metadata.tables[table_name].foreign_keys
+                         if foreign_key.column.table.name in table_names and foreign_key.column.table.name != table_name}
+            for table_name in table_names}
+
+def load_datasets(datasets, workers=None, transforms={}):
+    """
+    Load CSV files into their tables, independent tables in parallel, in the order of their foreign keys,
+    with the tables' secondary indexes built once the data is loaded.
+
+    Args:
+        datasets (dict): The paths of the CSV files, indexed by table name.
+        workers (int, optional): The number of tables loaded at once. Defaults to None (BULK_LOAD_WORKERS,
+                                 or 1 on SQLite).
+        transforms (dict, optional): The functions applied to the records of some tables, indexed by table name.
+                                     Defaults to {}.
+
+    Returns:
+        dict: The report of each table's load (see load_table), indexed by table name,
+              along with the time spent building the indexes ("indexes").
+    """
+    if workers is None:
+        workers = 1 if db.engine.dialect.name == "sqlite" else cfg["BULK_LOAD_WORKERS"]
+
+    # Drop the secondary indexes of the loaded tables, they are built after the load
+    indexes = [index for table_name in datasets for index in db.metadata.tables[table_name].indexes]
+    for index in indexes:
+        index.drop(bind=db.engine, checkfirst=True)
+
+    # Load each table once the tables it references are loaded
+    report = {}
+    waiting_for = load_order(list(datasets))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while waiting_for or running:
+            for table_name in [table_name for table_name, references in waiting_for.items() if not references]:
+                del waiting_for[table_name]
+                running[executor.submit(load_table, table_name, datasets[table_name],
+                                        transform=transforms.get(table_name))] = table_name
+            if not running:
+                raise ValueError(f"circular foreign keys between {', '.join(waiting_for)}")
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                table_name = running.pop(future)
+                report[table_name] = future.result()
+                for references in waiting_for.values():
+                    references.discard(table_name)
+
+    # Build the secondary indexes
+    started_at = time.perf_counter()
+    for index in indexes:
+        index.create(bind=db.engine, checkfirst=True)
+    report["indexes"] = {"count": len(indexes), "seconds": round(time.perf_counter() - started_at, 3)}
+    return report
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""The In-process cache
+DESCRIPTION:
+------------
+This file contains the bounded LRU cache (with optional TTL) used by the server's in-process caches.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    A thread-safe cache bounded by its number of entries and/or the total size of its values,
+    evicting the least recently used entries first and expiring entries older than its TTL.
+
+    Args:
+        max_entries (int, optional): The maximum number of entries. Defaults to None (unbounded).
+        max_size (int, optional): The maximum total size of the values. Defaults to None (unbounded).
+        ttl (float, optional): The number of seconds an entry stays valid. Defaults to None (no expiry).
+    """
+
+    def __init__(self, max_entries=None, max_size=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        """
+        Remove an entry. The caller must hold the lock.
+
+        Args:
+            key: The key of the entry.
+
+        Returns:
+            None
+        """
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, key):
+        """
+        Retrieve a value and mark its entry as the most recently used.
+
+        Args:
+            key: The key of the entry.
+
+        Returns:
+            The cached value, or None if the key is absent or its entry expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=1):
+        """
+        Store a value, evicting the least recently used entries if a bound is exceeded.
+        Values larger than max_size are not stored.
+
+        Args:
+            key: The key of the entry.
+            value: The value to store.
+            size (int, optional): The size accounted for the value. Defaults to 1.
+
+        Returns:
+            None
+        """
+        if self.max_size is not None and size > self.max_size:
+            return
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires_at)
+            self._size += size
+            while (self.max_entries is not None and len(self._entries) > self.max_entries) \
+                    or (self.max_size is not None and self._size > self.max_size):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove every entry.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Report the cache's counters.
+
+        Returns:
+            dict: The number of hits, misses, evictions and entries, and the total size of the values.
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._entries),
+                    "size": self._size}
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""The Columnar export
+DESCRIPTION:
+------------
+This file contains the Arrow IPC stream and Parquet encoders used by the table and time filter endpoints.
+Record batches are built column-wise from the chunks read by the database cursor (no row dictionaries),
+against a schema derived from the database models from which role-restricted columns have been dropped.
+The encoders require the optional pyarrow package (pip install pyarrow).
+"""
+
+import io
+import db_models
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Media types served by the columnar encoders
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MIMETYPE = "application/vnd.apache.parquet"
+
+# Minimum number of rows written per Parquet row group
+PARQUET_ROW_GROUP_SIZE = 65536
+
+def is_available():
+    """
+    Tell whether the optional pyarrow package is installed.
+
+    Returns:
+        bool: True if the columnar encoders can be used.
+    """
+    return pa is not None
+
+def _arrow_type(column_type):
+    """
+    Map a SQLAlchemy column type to the corresponding Arrow data type.
+
+    Args:
+        column_type (sqlalchemy.types.TypeEngine): The type of a model column.
+
+    Returns:
+        pyarrow.DataType: The Arrow data type of the column.
+    """
+    if isinstance(column_type, db_models.db.Integer):
+        return pa.int64()
+    if isinstance(column_type, db_models.db.DateTime):
+        return pa.timestamp("us")
+    if isinstance(column_type, db_models.db.Date):
+        return pa.date32()
+    if isinstance(column_type, db_models.db.Float):
+        return pa.float64()
+    return pa.string()
+
+def table_schema(table_name, columns_to_drop=["name"], columns=None):
+    """
+    Build the Arrow schema of a table from its database model, without the dropped columns.
+
+    Args:
+        table_name (str): The name of the table.
+        columns_to_drop (list, optional): A list of column names left out of the schema. Defaults to ["name"].
+        columns (list, optional): The columns kept in the schema. Defaults to None (all the columns that are not dropped).
+
+    Returns:
+        pyarrow.Schema: The schema of the exported table (its field names are the columns to select).
+    """
+    db_model = getattr(db_models, str.capitalize(table_name))
+    return pa.schema([pa.field(column.name, _arrow_type(column.type))
+                      for column in db_model.__table__.columns
+                      if column.name not in columns_to_drop and (columns is None or column.name in columns)])
+
+def _record_batch(rows, schema):
+    """
+    Transpose a chunk of rows into columns and build an Arrow record batch from them.
+
+    Args:
+        rows (list): A chunk of rows whose values follow the order of the schema's fields.
+        schema (pyarrow.Schema): The schema of the record batch.
+
+    Returns:
+        pyarrow.RecordBatch: The record batch holding the chunk.
+    """
+    arrays = []
+    for values, field in zip(zip(*rows), schema):
+        try:
+            arrays.append(pa.array(values, type=field.type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Some drivers (e.g. SQLite) return datetimes as strings, which Arrow can parse
+            arrays.append(pa.array(values).cast(field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def arrow_stream(chunks, schema):
+    """
+    Encode chunks of rows as an Arrow IPC stream, yielding the bytes of each record batch as soon as it is built.
+
+    Args:
+        chunks (iterable): The chunks of rows read from the database, in the schema's column order.
+        schema (pyarrow.Schema): The schema of the exported table.
+
+    Yields:
+        bytes: The next part of the Arrow IPC stream.
+    """
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for rows in chunks:
+            writer.write_batch(_record_batch(rows, schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+def parquet_bytes(chunks, schema):
+    """
+    Encode chunks of rows as a Parquet file (Parquet needs its footer, so the file is built in memory).
+
+    Args:
+        chunks (iterable): The chunks of rows read from the database, in the schema's column order.
+        schema (pyarrow.Schema): The schema of the exported table.
+
+    Returns:
+        bytes: The Parquet file.
+    """
+    sink = io.BytesIO()
+    with pq.ParquetWriter(sink, schema) as writer:
+        pending_batches = []
+        pending_rows = 0
+        for rows in chunks:
+            pending_batches.append(_record_batch(rows, schema))
+            pending_rows += len(rows)
+            if pending_rows >= PARQUET_ROW_GROUP_SIZE:
+                writer.write_table(pa.Table.from_batches(pending_batches, schema=schema))
+                pending_batches = []
+                pending_rows = 0
+        if pending_batches:
+            writer.write_table(pa.Table.from_batches(pending_batches, schema=schema))
+    return sink.getvalue()
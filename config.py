@@ -22,6 +22,36 @@ if os.environ["APP_ENVIRONMENT"] == "DEVELOPMENT":
         "DB_NAME": os.environ["DB_NAME_DEV"],
         "SERVER_PORT": os.environ["SERVER_PORT_DEV"],
         "REQUEST_LOGS_PATH": os.environ["REQUEST_LOGS_PATH_DEV"],
+        "REQUEST_LOGS_ARCHIVE_PATH": os.environ.get("REQUEST_LOGS_ARCHIVE_PATH_DEV",
+                                                    os.path.join(os.environ["REQUEST_LOGS_PATH_DEV"], "archive")),
+        "REQUEST_LOGS_RETENTION_DAYS": int(os.environ["REQUEST_LOGS_RETENTION_DAYS_DEV"])
+                                       if os.environ.get("REQUEST_LOGS_RETENTION_DAYS_DEV") else None,
+        "SAMPLING_SESSION_TTL": float(os.environ.get("SAMPLING_SESSION_TTL_DEV", 1800)),
+        "STREAM_CHUNK_SIZE": int(os.environ.get("STREAM_CHUNK_SIZE_DEV", 1000)),
+        "PAGE_SIZE_MAX": int(os.environ.get("PAGE_SIZE_MAX_DEV", 10000)),
+        "BULK_CREATE_MAX_RECORDS": int(os.environ.get("BULK_CREATE_MAX_RECORDS_DEV", 10000)),
+        "BULK_LOAD_CHUNK_SIZE": int(os.environ.get("BULK_LOAD_CHUNK_SIZE_DEV", 10000)),
+        "BULK_LOAD_WORKERS": int(os.environ.get("BULK_LOAD_WORKERS_DEV", 4)),
+        "ID_BLOCK_SIZE": int(os.environ.get("ID_BLOCK_SIZE_DEV", 100)),
+        "ADMIN_HIERARCHY_TTL": float(os.environ.get("ADMIN_HIERARCHY_TTL_DEV", 3600)),
+        "AUTH_CACHE_SIZE": int(os.environ.get("AUTH_CACHE_SIZE_DEV", 1024)),
+        "AUTH_CACHE_TTL": float(os.environ.get("AUTH_CACHE_TTL_DEV", 300)),
+        "RESULT_CACHE_MAX_BYTES": int(os.environ.get("RESULT_CACHE_MAX_BYTES_DEV", 64 * 1024 * 1024)),
+        "TABLE_VERSION_TTL": float(os.environ.get("TABLE_VERSION_TTL_DEV", 1.0)),
+        "COMPRESSION_MIN_BYTES": int(os.environ.get("COMPRESSION_MIN_BYTES_DEV", 1024)),
+        "GZIP_LEVEL": int(os.environ.get("GZIP_LEVEL_DEV", 6)),
+        "ZSTD_LEVEL": int(os.environ.get("ZSTD_LEVEL_DEV", 3)),
+        "TOKEN_SECRET": os.environ.get("TOKEN_SECRET_DEV"),
+        "TOKEN_TTL": float(os.environ.get("TOKEN_TTL_DEV", 3600)),
+        "REQUEST_LOG_QUEUE_SIZE": int(os.environ.get("REQUEST_LOG_QUEUE_SIZE_DEV", 10000)),
+        "REQUEST_LOG_BATCH_SIZE": int(os.environ.get("REQUEST_LOG_BATCH_SIZE_DEV", 500)),
+        "REQUEST_LOG_FLUSH_INTERVAL": float(os.environ.get("REQUEST_LOG_FLUSH_INTERVAL_DEV", 1.0)),
+        "REQUEST_LOG_SEGMENT_MAX_BYTES": int(os.environ.get("REQUEST_LOG_SEGMENT_MAX_BYTES_DEV", 64 * 1024 * 1024)),
+        "REQUEST_LOG_SEGMENT_MAX_SECONDS": float(os.environ.get("REQUEST_LOG_SEGMENT_MAX_SECONDS_DEV", 3600)),
+        "REQUEST_LOG_OVERFLOW_POLICY": os.environ.get("REQUEST_LOG_OVERFLOW_POLICY_DEV", "drop"),
+        "REQUEST_LOG_BLOCK_TIMEOUT": float(os.environ.get("REQUEST_LOG_BLOCK_TIMEOUT_DEV", 1.0)),
+        "SERVER_TIMING": os.environ.get("SERVER_TIMING_DEV", "false").lower() == "true",
+        "METRICS_TOKEN": os.environ.get("METRICS_TOKEN_DEV"),
     }
 
 # Configuration for the Production Environment
@@ -36,4 +66,34 @@ if os.environ["APP_ENVIRONMENT"] == "PRODUCTION":
         "DB_NAME": os.environ["DB_NAME_PROD"],
         "SERVER_PORT": os.environ["SERVER_PORT_PROD"],
         "REQUEST_LOGS_PATH": os.environ["REQUEST_LOGS_PATH_PROD"],
+        "REQUEST_LOGS_ARCHIVE_PATH": os.environ.get("REQUEST_LOGS_ARCHIVE_PATH_PROD",
+                                                    os.path.join(os.environ["REQUEST_LOGS_PATH_PROD"], "archive")),
+        "REQUEST_LOGS_RETENTION_DAYS": int(os.environ["REQUEST_LOGS_RETENTION_DAYS_PROD"])
+                                       if os.environ.get("REQUEST_LOGS_RETENTION_DAYS_PROD") else None,
+        "SAMPLING_SESSION_TTL": float(os.environ.get("SAMPLING_SESSION_TTL_PROD", 1800)),
+        "STREAM_CHUNK_SIZE": int(os.environ.get("STREAM_CHUNK_SIZE_PROD", 1000)),
+        "PAGE_SIZE_MAX": int(os.environ.get("PAGE_SIZE_MAX_PROD", 10000)),
+        "BULK_CREATE_MAX_RECORDS": int(os.environ.get("BULK_CREATE_MAX_RECORDS_PROD", 10000)),
+        "BULK_LOAD_CHUNK_SIZE": int(os.environ.get("BULK_LOAD_CHUNK_SIZE_PROD", 10000)),
+        "BULK_LOAD_WORKERS": int(os.environ.get("BULK_LOAD_WORKERS_PROD", 4)),
+        "ID_BLOCK_SIZE": int(os.environ.get("ID_BLOCK_SIZE_PROD", 100)),
+        "ADMIN_HIERARCHY_TTL": float(os.environ.get("ADMIN_HIERARCHY_TTL_PROD", 3600)),
+        "AUTH_CACHE_SIZE": int(os.environ.get("AUTH_CACHE_SIZE_PROD", 1024)),
+        "AUTH_CACHE_TTL": float(os.environ.get("AUTH_CACHE_TTL_PROD", 300)),
+        "RESULT_CACHE_MAX_BYTES": int(os.environ.get("RESULT_CACHE_MAX_BYTES_PROD", 64 * 1024 * 1024)),
+        "TABLE_VERSION_TTL": float(os.environ.get("TABLE_VERSION_TTL_PROD", 1.0)),
+        "COMPRESSION_MIN_BYTES": int(os.environ.get("COMPRESSION_MIN_BYTES_PROD", 1024)),
+        "GZIP_LEVEL": int(os.environ.get("GZIP_LEVEL_PROD", 6)),
+        "ZSTD_LEVEL": int(os.environ.get("ZSTD_LEVEL_PROD", 3)),
+        "TOKEN_SECRET": os.environ.get("TOKEN_SECRET_PROD"),
+        "TOKEN_TTL": float(os.environ.get("TOKEN_TTL_PROD", 3600)),
+        "REQUEST_LOG_QUEUE_SIZE": int(os.environ.get("REQUEST_LOG_QUEUE_SIZE_PROD", 10000)),
+        "REQUEST_LOG_BATCH_SIZE": int(os.environ.get("REQUEST_LOG_BATCH_SIZE_PROD", 500)),
+        "REQUEST_LOG_FLUSH_INTERVAL": float(os.environ.get("REQUEST_LOG_FLUSH_INTERVAL_PROD", 1.0)),
+        "REQUEST_LOG_SEGMENT_MAX_BYTES": int(os.environ.get("REQUEST_LOG_SEGMENT_MAX_BYTES_PROD", 64 * 1024 * 1024)),
+        "REQUEST_LOG_SEGMENT_MAX_SECONDS": float(os.environ.get("REQUEST_LOG_SEGMENT_MAX_SECONDS_PROD", 3600)),
+        "REQUEST_LOG_OVERFLOW_POLICY": os.environ.get("REQUEST_LOG_OVERFLOW_POLICY_PROD", "drop"),
+        "REQUEST_LOG_BLOCK_TIMEOUT": float(os.environ.get("REQUEST_LOG_BLOCK_TIMEOUT_PROD", 1.0)),
+        "SERVER_TIMING": os.environ.get("SERVER_TIMING_PROD", "false").lower() == "true",
+        "METRICS_TOKEN": os.environ.get("METRICS_TOKEN_PROD"),
     }
@@ -8,111 +8,389 @@ Controllers are defined as the functions that interact directly with the databas
 
 import db_models
 import pandas as pd
-import numpy as np
 import db_helpers
+import sampling_sessions
+import columnar_export
+import aggregation
+import rollup
+import admin_hierarchy
+import authentication
+import id_allocation
+import result_cache
+import serializers
+import metrics
 import datetime
+import random
 
+def projection(table_name, columns=None, columns_to_drop=["name"]):
+    """
+    Resolve the columns selected from a table: the requested columns (all of them by default), checked against
+    the table's model, without the columns the user's role is not allowed to read.
+
+    Args:
+        table_name (str): The name of the table.
+        columns (list, optional): The names of the requested columns. Defaults to None (all columns).
+        columns_to_drop (list, optional): The columns the user's role is not allowed to read. Defaults to ["name"].
+
+    Returns:
+        list: The selected columns, in the table's order.
+
+    Raises:
+        ValueError: If no column is requested, or a requested column does not exist or is not readable.
+    """
+    readable_columns = [column.name for column in db_models.db.metadata.tables[table_name].columns
+                        if column.name not in columns_to_drop]
+    if columns is None:
+        return readable_columns
+    if not columns:
+        raise ValueError("no column requested")
+    unavailable_columns = [column for column in columns if column not in readable_columns]
+    if unavailable_columns:
+        raise ValueError(f"unknown or restricted columns: {', '.join(unavailable_columns)}")
+    return [column for column in readable_columns if column in columns]
+
+def query_columns(table_name, columns, required_columns):
+    """
+    Add the columns a controller needs (e.g. "id" for paging, "village_id" for region names) to the selected
+    columns of its query, without returning them to the client.
+
+    Args:
+        table_name (str): The name of the table.
+        columns (list): The selected columns.
+        required_columns (list): The columns the controller needs (those missing from the table are ignored).
+
+    Returns:
+        tuple: The columns of the query, and the hidden columns to leave out of the response.
+    """
+    table_columns = db_models.db.metadata.tables[table_name].columns
+    hidden_columns = [column for column in required_columns if column not in columns and column in table_columns]
+    return columns + hidden_columns, hidden_columns
+
+def region_name_columns(rows):
+    """
+    Resolve the names of the regions (province to village) of the records' villages, in memory.
+
+    Args:
+        rows (list): The records, with a "village_id" column.
+
+    Returns:
+        dict: The "<level>_name" columns to add to the records (None if there is no "village_id" column).
+    """
+    if not rows or "village_id" not in rows[0].keys():
+        return None
+    return admin_hierarchy.get_index().region_names([row["village_id"] for row in rows])
+
+def region_village_ranges(region_filters):
+    """
+    Compile region filters into ranges of village ids, using the administrative hierarchy index.
+
+    Args:
+        region_filters (dict): The ids of the regions the records' villages must lie in, indexed by level name.
+
+    Returns:
+        list: The (first, last) village ids of the ranges, or None if there is no filter.
+    """
+    if not region_filters:
+        return None
+    return admin_hierarchy.get_index().village_id_ranges(region_filters)
+
+@metrics.timed("controller")
 def table_querying(table_name="case_cache",
                    columns_to_drop=["name"],
+                   regions=False,
+                   region_filters=None,
+                   columns=None,
                    ):
     """
-    Retrieve records from the specified table, convert them to a DataFrame,
-    and drop specified columns from the resulting DataFrame.
+    Retrieve records from the specified table and encode them as JSON, without the specified columns
+    (only the selected columns are read from the database).
 
     Args:
         table_name (str, optional): The name of the table to query. Defaults to "case_cache".
-        columns_to_drop (list, optional): A list of column names to drop from the DataFrame. Defaults to ["name"].
+        columns_to_drop (list, optional): A list of column names left out of the records. Defaults to ["name"].
+        regions (bool, optional): Whether to add the names of the records' regions. Defaults to False.
+        region_filters (dict, optional): The ids of the regions ("province", "district", "sector", "cell")
+                                         the records' villages must lie in. Defaults to None (no filter).
+        columns (list, optional): The requested columns. Defaults to None (all columns).
 
     Returns:
-        pandas.DataFrame: A DataFrame containing the queried records with specified columns dropped.
+        str: The JSON object of the queried records, indexed by position, with specified columns dropped.
     """
+    # Select the requested columns, and the village of the records if the names of their regions are requested
+    sql_columns, hidden_columns = query_columns(table_name, projection(table_name, columns, columns_to_drop),
+                                                ["village_id"] if regions else [])
+
     # Query the specified table using db_helpers.table_querying function
-    response = db_helpers.table_querying(table_name)
-    
-    # Convert the query response into a DataFrame
-    response_df = pd.DataFrame([i for i in response])
-    
-    # Determine which columns to drop from the DataFrame
-    columns_to_drop = list(set(response_df.columns) & set(columns_to_drop))
-    
-    # Drop the specified columns from the DataFrame
-    response_df = response_df.drop(columns=columns_to_drop)
-    
-    # Return the resulting DataFrame
-    return response_df
+    rows = db_helpers.table_querying(table_name, village_ranges=region_village_ranges(region_filters),
+                                     columns=sql_columns).fetchall()
+
+    # Encode the records, with the names of their regions if requested
+    return serializers.encode_records(rows, table_name, columns_to_drop=hidden_columns,
+                                      extra_columns=region_name_columns(rows) if regions else None)
+
+@metrics.timed("controller")
+def table_streaming(table_name="case_cache",
+                    columns_to_drop=["name"],
+                    chunk_size=1000,
+                    regions=False,
+                    region_filters=None,
+                    columns=None,
+                    ):
+    """
+    Stream records from the specified table in fixed-size chunks, without the specified columns
+    (only the selected columns are read from the database).
+    Only one chunk is held in memory at a time.
+
+    Args:
+        table_name (str, optional): The name of the table to query. Defaults to "case_cache".
+        columns_to_drop (list, optional): A list of column names left out of each record. Defaults to ["name"].
+        chunk_size (int, optional): The number of records read from the database per chunk. Defaults to 1000.
+        regions (bool, optional): Whether to add the names of the records' regions. Defaults to False.
+        region_filters (dict, optional): The ids of the regions ("province", "district", "sector", "cell")
+                                         the records' villages must lie in. Defaults to None (no filter).
+        columns (list, optional): The requested columns. Defaults to None (all columns).
+
+    Yields:
+        list: The next chunk of records, as dictionaries with specified columns dropped.
+    """
+    # Select the requested columns, and the village of the records if the names of their regions are requested
+    sql_columns, hidden_columns = query_columns(table_name, projection(table_name, columns, columns_to_drop),
+                                                ["village_id"] if regions else [])
+
+    for rows in db_helpers.table_streaming(table_name, chunk_size=chunk_size, columns=sql_columns,
+                                           village_ranges=region_village_ranges(region_filters)):
+        records = [dict(row) for row in rows]
+
+        # Add the names of the records' regions if requested
+        if regions and records and "village_id" in records[0]:
+            region_names = admin_hierarchy.get_index().region_names([record["village_id"] for record in records])
+            for position, record in enumerate(records):
+                record.update({key: names[position] for key, names in region_names.items()})
+
+        # Leave out the columns only read for the controller's needs
+        for record in records:
+            for column in hidden_columns:
+                del record[column]
+        yield records
+
+@metrics.timed("controller")
+def table_exporting(table_name="case_cache",
+                    columns_to_drop=["name"],
+                    export_format=columnar_export.ARROW_MIMETYPE,
+                    chunk_size=1000,
+                    early_date=None,
+                    late_date=None,
+                    region_filters=None,
+                    columns=None,
+                    ):
+    """
+    Export records from the specified table in a columnar binary format (Arrow IPC stream or Parquet).
+    Only the columns that are not dropped are selected, and record batches are built straight from the cursor's chunks.
+
+    Args:
+        table_name (str, optional): The name of the table to query. Defaults to "case_cache".
+        columns_to_drop (list, optional): A list of column names left out of the export. Defaults to ["name"].
+        export_format (str, optional): The media type of the export, columnar_export.ARROW_MIMETYPE
+                                       or columnar_export.PARQUET_MIMETYPE. Defaults to ARROW_MIMETYPE.
+        chunk_size (int, optional): The number of records read from the database per chunk. Defaults to 1000.
+        early_date (str, optional): If provided with late_date, only the records dated within
+                                    [early_date, late_date) are exported. Defaults to None.
+        late_date (str, optional): The exclusive upper bound of the datetime range. Defaults to None.
+        region_filters (dict, optional): The ids of the regions ("province", "district", "sector", "cell")
+                                         the records' villages must lie in. Defaults to None (no filter).
+        columns (list, optional): The requested columns. Defaults to None (all columns).
+
+    Returns:
+        iterable: The successive parts (bytes) of the exported file.
+    """
+    # Build the export schema from the table's model, with the selected columns only
+    schema = columnar_export.table_schema(table_name, columns_to_drop=columns_to_drop,
+                                          columns=projection(table_name, columns, columns_to_drop))
+
+    # Read the selected columns chunk by chunk through a server-side cursor
+    chunks = db_helpers.table_streaming(table_name, chunk_size=chunk_size, columns=schema.names,
+                                        early_date=early_date, late_date=late_date,
+                                        village_ranges=region_village_ranges(region_filters))
+
+    # Encode the chunks in the requested format
+    if export_format == columnar_export.PARQUET_MIMETYPE:
+        return [columnar_export.parquet_bytes(chunks, schema)]
+    return columnar_export.arrow_stream(chunks, schema)
+
+@metrics.timed("controller")
+def table_paging(table_name="case_cache",
+                 columns_to_drop=["name"],
+                 limit=1000,
+                 after_id=None,
+                 regions=False,
+                 region_filters=None,
+                 columns=None,
+                 ):
+    """
+    Retrieve one page of records from the specified table (keyset pagination on the primary key)
+    and encode it as JSON, without the specified columns (only the selected columns are read from the database).
+
+    Args:
+        table_name (str, optional): The name of the table to query. Defaults to "case_cache".
+        columns_to_drop (list, optional): A list of column names to drop from the records. Defaults to ["name"].
+        limit (int, optional): The maximum number of records in the page. Defaults to 1000.
+        after_id (int, optional): The id after which the page starts. Defaults to None (first page).
+        regions (bool, optional): Whether to add the names of the records' regions. Defaults to False.
+        region_filters (dict, optional): The ids of the regions ("province", "district", "sector", "cell")
+                                         the records' villages must lie in. Defaults to None (no filter).
+        columns (list, optional): The requested columns. Defaults to None (all columns).
+
+    Returns:
+        str: The JSON object holding the page's records ("data", indexed by position, with specified columns dropped)
+             and the "next_after_id" cursor of the following page (None once the table is exhausted).
+    """
+    # Select the requested columns, the id of the records (cursor of the next page)
+    # and their village if the names of their regions are requested
+    sql_columns, hidden_columns = query_columns(table_name, projection(table_name, columns, columns_to_drop),
+                                                ["id", "village_id"] if regions else ["id"])
+
+    # Query the page of records following after_id using db_helpers.table_page function
+    rows = db_helpers.table_page(table_name, after_id=after_id, limit=limit,
+                                 village_ranges=region_village_ranges(region_filters), columns=sql_columns).fetchall()
+
+    # Encode the page and the cursor of the next page (a short page is the last one)
+    data = serializers.encode_records(rows, table_name, columns_to_drop=hidden_columns,
+                                      extra_columns=region_name_columns(rows) if regions else None)
+    next_after_id = rows[-1]["id"] if len(rows) == limit else None
+    return '{"data":' + data + ',"next_after_id":' + serializers.encode_value(next_after_id) + "}"
 
+@metrics.timed("controller")
 def table_querying_with_datetime_filters(early_date, late_date,
                                          table_name="case_cache",
-                                         columns_to_drop=["name"]
+                                         columns_to_drop=["name"],
+                                         region_filters=None,
+                                         columns=None,
                                          ):
     """
-    Retrieve records from the specified table within a given datetime range, convert them to a DataFrame,
-    and drop specified columns from the resulting DataFrame.
+    Retrieve records from the specified table within a given datetime range and encode them as JSON,
+    without the specified columns (only the selected columns are read from the database).
 
     Args:
-        early_date (str): The start of the datetime range for querying records.
-        late_date (str): The end of the datetime range for querying records.
+        early_date (str): The start of the datetime range for querying records (inclusive).
+        late_date (str): The end of the datetime range for querying records (exclusive).
         table_name (str, optional): The name of the table to query. Defaults to "case_cache".
-        columns_to_drop (list, optional): A list of column names to drop from the DataFrame. Defaults to ["name"].
+        columns_to_drop (list, optional): A list of column names to drop from the records. Defaults to ["name"].
+        region_filters (dict, optional): The ids of the regions ("province", "district", "sector", "cell")
+                                         the records' villages must lie in. Defaults to None (no filter).
+        columns (list, optional): The requested columns. Defaults to None (all columns).
 
     Returns:
-        pandas.DataFrame: A DataFrame containing the queried records within the specified datetime range
-                          with specified columns dropped.
+        str: The JSON object of the queried records within the specified datetime range, indexed by position,
+             with specified columns dropped.
     """
     
-    # Determine the index corresponding to the early and late dates
-    early_date_id = db_helpers.datetime_index_detector(early_date)
-    late_date_id = db_helpers.datetime_index_detector(late_date)
-    
-    # Generate a list of indexes within the specified datetime range
-    indexes = range(early_date_id, late_date_id)
-    
-    # Create a SQL string to use in filtering based on indexes
-    indexes_sql_str = " or id=".join([str(i) for i in indexes])
-            
-    # Query the specified table with index filtering using db_helpers.table_column_filter function
-    response = db_helpers.table_column_filter(key=indexes_sql_str,
+    # Query the selected columns of the specified table with a range scan on its indexed date column
+    rows = db_helpers.table_date_range_filter(early_date=early_date,
+                                              late_date=late_date,
                                               table_name=table_name,
-                                              key_column="id", is_num=True)
+                                              village_ranges=region_village_ranges(region_filters),
+                                              columns=projection(table_name, columns, columns_to_drop)).fetchall()
 
-    # Convert the query response into a DataFrame
-    response_df = pd.DataFrame([i for i in response])
-    
-    # Determine which columns to drop from the DataFrame
-    columns_to_drop = list(set(response_df.columns) & set(columns_to_drop))
-    
-    # Drop the specified columns from the DataFrame
-    response_df = response_df.drop(columns=columns_to_drop)
-    
-    # Return the resulting DataFrame
-    return response_df
+    # Encode the records
+    return serializers.encode_records(rows, table_name)
 
-def entries_querying(key, table_name="patient", key_column="name"):
+@metrics.timed("controller")
+def table_aggregating(table_name="case_cache",
+                      group_by=[],
+                      metrics=["count"],
+                      columns_to_drop=["name"],
+                      early_date=None,
+                      late_date=None,
+                      use_rollup=True,
+                      ):
     """
-    Query records from the specified table based on a provided key value, convert them to a DataFrame.
+    Aggregate the records of the specified table with a single GROUP BY query computed by the database.
+
+    Args:
+        table_name (str, optional): The name of the table to aggregate. Defaults to "case_cache".
+        group_by (list, optional): The dimensions to group by (see aggregation.py). Defaults to [] (one overall row).
+        metrics (list, optional): The metrics to compute for each group (see aggregation.py). Defaults to ["count"].
+        columns_to_drop (list, optional): The columns the user's role is not allowed to read. Defaults to ["name"].
+        early_date (str, optional): If provided with late_date, only the records dated within
+                                    [early_date, late_date) are aggregated. Defaults to None.
+        late_date (str, optional): The exclusive upper bound of the datetime range. Defaults to None.
+        use_rollup (bool, optional): Whether "case_cache" requests can be answered from the rollup. Defaults to True.
+
+    Returns:
+        pandas.DataFrame: A DataFrame containing one row per group, with its dimensions and metrics.
+
+    Raises:
+        ValueError: If a dimension, a metric or the date range is not available on this table.
+    """
+    # Get the columns of the specified table
+    table_columns = db_models.db.metadata.tables[table_name].columns.keys()
+
+    # Check the date range
+    if (early_date is None) != (late_date is None):
+        raise ValueError("early_date and late_date must be provided together")
+    if early_date is not None and "date" not in table_columns:
+        raise ValueError(f"{table_name} cannot be filtered by date")
+
+    # Compile the requested dimensions and metrics into the parts of a GROUP BY query
+    dialect = db_models.db.engine.dialect.name
+    query = aggregation.compile_query(table_name, table_columns,
+                                      group_by=group_by,
+                                      metrics=metrics,
+                                      columns_to_drop=columns_to_drop,
+                                      dialect=dialect)
+
+    # Answer from the pre-aggregated rollup when it keeps everything the request needs
+    if use_rollup and table_name == "case_cache" and aggregation.is_day_aligned(early_date, late_date):
+        rollup_query = aggregation.compile_rollup_query(group_by=group_by, metrics=metrics, dialect=dialect)
+        if rollup_query is not None:
+            early_day, late_day = aggregation.rollup_day_range(early_date, late_date)
+            response = db_helpers.table_aggregating("case_rollup",
+                                                    select=rollup_query["select"],
+                                                    group_by=rollup_query["group_by"],
+                                                    having=rollup_query["having"],
+                                                    early_date=early_day,
+                                                    late_date=late_day,
+                                                    date_column="day")
+            return pd.DataFrame([dict(i) for i in response], columns=group_by + metrics)
+
+    # Run the aggregation in the database
+    response = db_helpers.table_aggregating(table_name,
+                                            select=query["select"],
+                                            group_by=query["group_by"],
+                                            joins=query["joins"],
+                                            early_date=early_date,
+                                            late_date=late_date)
+
+    # Return the groups as a DataFrame
+    return pd.DataFrame([dict(i) for i in response], columns=group_by + metrics)
+
+@metrics.timed("controller")
+def entries_querying(key, table_name="patient", key_column="name", columns=None):
+    """
+    Query records from the specified table based on a provided key value and encode them as JSON.
 
     Args:
         key: The value to use for querying records in the specified column.
         table_name (str, optional): The name of the table to query. Defaults to "patient".
         key_column (str, optional): The name of the column to use for querying. Defaults to "name".
+        columns (list, optional): The requested columns. Defaults to None (all columns).
 
     Returns:
-        pandas.DataFrame: A DataFrame containing the queried records based on the provided key value.
+        str: The JSON object of the queried records based on the provided key value, indexed by position.
     """
-    # Query the specified table using db_helpers.table_column_filter function
-    response = db_helpers.table_column_filter(key=key,
-                                              table_name=table_name,
-                                              key_column=key_column
-                                              )
+    # Query the selected columns of the specified table using db_helpers.table_column_filter function
+    rows = db_helpers.table_column_filter(key=key,
+                                          table_name=table_name,
+                                          key_column=key_column,
+                                          columns=projection(table_name, columns, [])
+                                          ).fetchall()
 
-    # Convert the query response into a DataFrame
-    response_df = pd.DataFrame([i for i in response])
-    
-    # Return the resulting DataFrame
-    return response_df
+    # Encode the records
+    return serializers.encode_records(rows, table_name)
 
+@metrics.timed("controller")
 def online_querying(table_name="patient", batch_size=1000,
-                    previous_indexes=[], columns_to_drop=["name"]):
+                    previous_indexes=[], columns_to_drop=["name"], columns=None):
     """
     Perform online querying of records from the specified table, considering batch processing,
     previously queried indexes, and optionally dropping specified columns.
@@ -122,6 +400,7 @@ def online_querying(table_name="patient", batch_size=1000,
         batch_size (int, optional): The number of records to retrieve in each batch. Defaults to 1000.
         previous_indexes (list, optional): List of indexes already queried. Defaults to an empty list.
         columns_to_drop (list, optional): A list of column names to drop from the DataFrame. Defaults to ["name"].
+        columns (list, optional): The requested columns. Defaults to None (all columns).
 
     Returns:
         dict: A dictionary containing query response details including the DataFrame of queried records,
@@ -138,41 +417,254 @@ def online_querying(table_name="patient", batch_size=1000,
 
     # Get the last ID in the specified table
     last_id = db_helpers.table_last_id(table_name)
-    
-    # Generate a list of possible indexes based on previously queried indexes
-    possible_indexes = list(set(range(last_id+1)) - set(previous_indexes))
-    
-    # Randomly sample indexes based on batch size and available possible indexes
-    indexes = np.random.choice(possible_indexes, size=len(possible_indexes), replace=False)
-    
-    # Create a SQL string to use for filtering based on the sampled indexes
-    if (batch_size >= len(indexes)):
-        indexes_sql_str = " or id=".join([str(i) for i in indexes])
-    else:
-        indexes_sql_str = " or id=".join([str(i) for i in indexes[:batch_size]])
-    
-    # Query the specified table with index filtering using db_helpers.table_column_filter function
-    response = db_helpers.table_column_filter(key=indexes_sql_str,
-                                              table_name=table_name,
-                                              key_column="id", is_num=True)
-    
+    domain_size = 0 if last_id is None else last_id + 1
+
+    # Select the requested columns and the id of the records
+    sql_columns, hidden_columns = query_columns(table_name, projection(table_name, columns, columns_to_drop), ["id"])
+
+    # Walk a fresh random permutation of the id range until the batch is full, skipping the previously
+    # queried indexes and the ids that were deleted (the whole id range is never materialized)
+    round_keys = sampling_sessions.draw_round_keys(sampling_sessions.draw_seed())
+    previous_indexes = set(previous_indexes)
+    rows, position = [], 0
+    while len(rows) < batch_size and position < domain_size:
+        ids = []
+        while len(ids) < batch_size - len(rows) and position < domain_size:
+            index = sampling_sessions.permuted_index(position, domain_size, round_keys)
+            position += 1
+            if index not in previous_indexes:
+                ids.append(index)
+        order = {index: rank for rank, index in enumerate(ids)}
+        rows += sorted(db_helpers.table_ids_filter(ids, table_name=table_name, columns=sql_columns),
+                       key=lambda row: order[row["id"]])
+
     # Convert the query response into a DataFrame
-    response_df = pd.DataFrame([i for i in response])
+    response_df = pd.DataFrame(rows)
     
     # Determine which columns to drop from the DataFrame
-    columns_to_drop = list(set(response_df.columns) & set(columns_to_drop))
+    columns_to_drop = list(set(response_df.columns) & set(hidden_columns))
     
-    # Drop the specified columns from the DataFrame
+    # Drop the columns only read for the sampling from the DataFrame
     response_df = response_df.drop(columns=columns_to_drop)
 
     # Return a dictionary containing query response details
     return {"data": response_df,
             "original_table_length": table_size,
             "number_of_samples": len(response_df),
-            "returned_indexes": response_df["id"].tolist(),
+            "returned_indexes": [row["id"] for row in rows],
             "status": 200
             }
 
+# Strata of the stratified sampling, with the column they are read from
+SAMPLING_STRATA = {"gender": "gender", "health_center_id": "health_center_id",
+                   "province": "village_id", "district": "village_id", "sector": "village_id",
+                   "cell": "village_id", "village": "village_id"}
+
+def sampling_stratum(table_name, strata):
+    """
+    Compile the strata of a stratified sample into the SQL expression of a record's stratum.
+    Administrative levels above the village are read by joining up the hierarchy from "village_id",
+    as for the aggregations.
+
+    Args:
+        table_name (str): The name of the table to sample.
+        strata (str): The name of the strata (a key of SAMPLING_STRATA).
+
+    Returns:
+        tuple: The SQL expression of the stratum and the SQL join clauses it needs.
+    """
+    if strata not in ["province", "district", "sector", "cell"]:
+        return f"{table_name}.{SAMPLING_STRATA[strata]}", []
+    expression, depth = aggregation.ADMINISTRATIVE_LEVELS[strata]
+    return expression, [join.format(table=table_name) for join in aggregation.HIERARCHY_JOINS[:depth]]
+
+def draw_sample(table_name, mode, seed, strata=None, allocation="proportional", sample_size=None, quota=None):
+    """
+    Draw a reservoir or stratified sample of the ids of the specified table in the database: the records of
+    every stratum are ranked by a hash of their id seeded by the sample's seed, and the first ones are kept.
+    Drawing costs a scan of the table (and a sort per stratum) in the database, plus a GROUP BY for a
+    proportional sample; only the sampled ids are sent back.
+
+    Args:
+        table_name (str): The name of the table to sample.
+        mode (str): "reservoir" (uniform sample of sample_size records) or "stratified".
+        seed (int): The seed of the sample.
+        strata (str, optional): The name of the strata of a stratified sample (a key of SAMPLING_STRATA).
+                                Defaults to None.
+        allocation (str, optional): How a stratified sample is shared between strata: "proportional"
+                                    (sample_size records in proportion to their populations) or "fixed"
+                                    (quota records per stratum). Defaults to "proportional".
+        sample_size (int, optional): The size of a reservoir or proportional sample. Defaults to None.
+        quota (int or dict, optional): The number of records of every stratum, or of each stratum
+                                       (indexed by stratum, as strings), of a fixed sample. Defaults to None.
+
+    Returns:
+        tuple: The sampled ids (strata interleaved) and the description of the strata (None for a reservoir sample).
+
+    Raises:
+        ValueError: If the sampling parameters are invalid.
+    """
+    table_columns = db_models.db.metadata.tables[table_name].columns.keys()
+    if mode == "reservoir":
+        stratum, joins = None, []
+    elif mode == "stratified":
+        if strata not in SAMPLING_STRATA or SAMPLING_STRATA[strata] not in table_columns:
+            raise ValueError(f"strata must be one of the available strata of {table_name}")
+        stratum, joins = sampling_stratum(table_name, strata)
+    else:
+        raise ValueError("mode must be uniform, reservoir or stratified")
+
+    # Decide the size of the sample of every stratum
+    if mode == "reservoir" or allocation == "proportional":
+        if not isinstance(sample_size, int) or isinstance(sample_size, bool) or sample_size <= 0:
+            raise ValueError("sample_size must be a positive integer")
+    if mode == "reservoir":
+        quotas = {None: sample_size}
+    elif allocation == "proportional":
+        # Count the populations of the strata in the database (one GROUP BY)
+        populations = {i[0]: i[1] for i in db_helpers.table_aggregating(table_name,
+                                                                         select=[f"{stratum} as stratum",
+                                                                                 "count(*) as population"],
+                                                                         group_by=[stratum],
+                                                                         joins=joins)}
+        quotas = sampling_sessions.proportional_quotas(populations, sample_size)
+    elif allocation == "fixed":
+        if isinstance(quota, dict):
+            if not all(isinstance(i, int) and not isinstance(i, bool) and i >= 0 for i in quota.values()):
+                raise ValueError("quota must map strata to non-negative integers")
+            quotas = dict(quota)
+        elif isinstance(quota, int) and not isinstance(quota, bool) and quota > 0:
+            quotas = None
+        else:
+            raise ValueError("quota must be a positive integer or a dictionary of strata quotas")
+    else:
+        raise ValueError("allocation must be proportional or fixed")
+
+    def stratum_quota(stratum_value):
+        if quotas is None:
+            return quota
+        if mode == "stratified" and allocation == "fixed":
+            return quotas.get(str(stratum_value), 0)
+        return quotas.get(stratum_value, 0)
+
+    # Rank the records of every stratum in the database, reading back as many as the largest quota
+    # (at least one, so that every stratum and its population is seen)
+    generator = random.Random(seed)
+    hash_keys = [generator.randrange(1, db_helpers.SAMPLE_HASH_MODULUS) for _ in range(4)]
+    limit = max([quota] if quotas is None else list(quotas.values()) + [1])
+    samples, populations = {}, {}
+    for stratum_value, i, population in db_helpers.table_sample_ids(table_name, hash_keys, limit,
+                                                                    stratum=stratum, joins=joins):
+        samples.setdefault(stratum_value, []).append(i)
+        populations[stratum_value] = population
+    samples = {stratum_value: ids[:stratum_quota(stratum_value)] for stratum_value, ids in samples.items()}
+
+    # Spread the strata evenly over the sample
+    sample_ids = sampling_sessions.interleave(samples, generator)
+    if mode == "reservoir":
+        return sample_ids, None
+    return sample_ids, [{"stratum": stratum_value, "population": populations[stratum_value],
+                         "quota": stratum_quota(stratum_value), "sampled": len(ids)}
+                        for stratum_value, ids in sorted(samples.items(), key=lambda item: str(item[0]))]
+
+@metrics.timed("controller")
+def session_querying(table_name="patient", batch_size=1000, cursor=None,
+                     seed=None, user_id=None, columns_to_drop=["name"],
+                     mode="uniform", strata=None, allocation="proportional",
+                     sample_size=None, quota=None, columns=None):
+    """
+    Perform online querying of records from the specified table through a server-side sampling session.
+    Without a cursor, a new session is opened: pinned to the current id range of the table ("uniform" mode),
+    or to a sample of its ids drawn by the database ("reservoir" and "stratified" modes, see draw_sample);
+    with a cursor, the batch following the cursor's position in the session is returned.
+
+    Args:
+        table_name (str, optional): The name of the table to query. Defaults to "patient".
+        batch_size (int, optional): The number of records to retrieve in each batch. Defaults to 1000.
+        cursor (str, optional): The cursor returned by the previous batch. Defaults to None (new session).
+        seed (int, optional): The seed of a new session, for reproducible samples. Defaults to None.
+        user_id (int, optional): The id of the user owning the session. Defaults to None.
+        columns_to_drop (list, optional): A list of column names to drop from the DataFrame. Defaults to ["name"].
+        mode (str, optional): The sampling mode of a new session: "uniform", "reservoir" or "stratified".
+                              Defaults to "uniform".
+        strata (str, optional): The strata of a new stratified session. Defaults to None.
+        allocation (str, optional): The allocation of a new stratified session ("proportional" or "fixed").
+                                    Defaults to "proportional".
+        sample_size (int, optional): The sample size of a new reservoir or proportional session. Defaults to None.
+        quota (int or dict, optional): The quotas of a new fixed stratified session. Defaults to None.
+        columns (list, optional): The requested columns. Defaults to None (all columns).
+
+    Returns:
+        dict: A dictionary containing query response details including the DataFrame of queried records,
+              the table length when the session was opened, the number of samples returned,
+              the returned indexes, the cursor of the next batch (None once the table or sample is exhausted),
+              the strata of a stratified session and the status code.
+    """
+    # Check that the batch size is a positive integer
+    if not isinstance(batch_size, int) or batch_size <= 0:
+        return {"response": "batch_size must be a positive integer", "status": 400}
+
+    if cursor is None:
+        # Draw the sample of a reservoir or stratified session
+        seed = sampling_sessions.draw_seed(seed)
+        sample_ids, sample_strata = None, None
+        if mode != "uniform":
+            try:
+                sample_ids, sample_strata = draw_sample(table_name, mode, seed, strata=strata,
+                                                        allocation=allocation, sample_size=sample_size,
+                                                        quota=quota)
+            except ValueError as e:
+                return {"response": str(e), "status": 400}
+
+        # Pin the id range and size of the table (and the sample) to a new session
+        last_id = db_helpers.table_last_id(table_name)
+        table_size = db_helpers.count_table_size(table_name)
+        session = sampling_sessions.open_session(table_name=table_name, user_id=user_id,
+                                                 last_id=-1 if last_id is None else last_id,
+                                                 table_size=table_size, seed=seed,
+                                                 sample_ids=sample_ids, strata=sample_strata)
+        position = 0
+    else:
+        # Resume the session the cursor belongs to
+        session_id, position = sampling_sessions.decode_cursor(cursor)
+        session = sampling_sessions.get_session(session_id, table_name=table_name, user_id=user_id)
+        if session is None:
+            return {"response": "sampling session not found or expired",
+                    "status": 404}
+
+    # Select the requested columns and the id of the records
+    sql_columns, hidden_columns = query_columns(table_name, projection(table_name, columns, columns_to_drop), ["id"])
+
+    # Walk the permutation until the batch is full, skipping ids that were deleted
+    rows = []
+    while len(rows) < batch_size and position < sampling_sessions.session_size(session):
+        ids = sampling_sessions.candidate_ids(session, position, batch_size - len(rows))
+        position += len(ids)
+        order = {index: rank for rank, index in enumerate(ids)}
+        rows += sorted(db_helpers.table_ids_filter(ids, table_name=table_name, columns=sql_columns),
+                       key=lambda row: order[row["id"]])
+
+    # Convert the query response into a DataFrame
+    response_df = pd.DataFrame(rows)
+
+    # Determine which columns to drop from the DataFrame
+    columns_to_drop = list(set(response_df.columns) & set(hidden_columns))
+
+    # Drop the columns only read for the sampling from the DataFrame
+    response_df = response_df.drop(columns=columns_to_drop)
+
+    # Return a dictionary containing query response details
+    return {"data": response_df,
+            "original_table_length": session["table_size"],
+            "number_of_samples": len(response_df),
+            "returned_indexes": [row["id"] for row in rows],
+            "seed": session["seed"],
+            "cursor": sampling_sessions.encode_cursor(session, position),
+            "strata": session["strata"],
+            "status": 200
+            }
+
+@metrics.timed("controller")
 def create_resource(resource_table_name, details_dict):
     """
     Create a new resource in the specified database table using the provided details.
@@ -184,45 +676,205 @@ def create_resource(resource_table_name, details_dict):
     Returns:
         None
     """
-    # Generate a new ID for the resource by incrementing the last ID in the specified table
-    new_id = db_helpers.table_last_id(resource_table_name) + 1
+    # Allocate a new ID for the resource
+    new_id = id_allocation.allocate_ids(resource_table_name)[0]
     
     # Add the new ID to the details dictionary
     details_dict.update({"id": new_id})
 
+    # Store users' passwords as hashes
+    if resource_table_name == "user" and details_dict.get("password") is not None:
+        details_dict["password"] = authentication.hash_password(details_dict["password"])
+
     # Get the database model class for the specified resource table
     db_model = getattr(db_models, str.capitalize(resource_table_name))
     
     # Condition to handle specific resource creation process for "malaria_results" table
     if resource_table_name == "malaria_results":
-        # Create a new resource object
-        new_resource = db_model(**details_dict)
-        
-        # Add the new resource to the database session and commit the transaction
-        db_models.db.session.add(new_resource)
-        db_models.db.session.commit()
-
         # Get the patient ID associated with the blood test
-        patient_id = db_models.Blood_test.query.filter_by(id=details_dict["blood_test_id"]).first().patient_id
+        patient_id = db_models.db.session.query(db_models.Blood_test.patient_id) \
+            .filter_by(id=details_dict["blood_test_id"]).scalar()
         
         # Query the patient details based on the patient ID
-        current_patient = db_helpers.table_column_filter(key=patient_id, table_name="patient", key_column="id")
-        current_patient_dict = pd.DataFrame(current_patient).to_dict('records')[0]
+        current_patient = db_models.Patient.query.filter_by(id=patient_id).first()
+        current_patient_dict = {column.name: getattr(current_patient, column.name)
+                                for column in db_models.Patient.__table__.columns}
         
         # Update the patient ID field and create a new resource for Case_cache
         current_patient_dict["patient_id"] = current_patient_dict.pop('id')
         case_cache_dict = details_dict.copy()
         case_cache_dict.update({"date": datetime.datetime.now()})
         case_cache_dict.update(current_patient_dict)
+
+        # Add the new malaria result to the database session
+        db_models.db.session.add(db_model(**details_dict))
         new_resource = db_models.Case_cache(**case_cache_dict)
     else:
         # Create a new resource object
         new_resource = db_model(**details_dict)
+        case_cache_dict = details_dict if resource_table_name == "case_cache" else None
 
-    # Add the new resource to the database session and commit the transaction
+    # Add the new resource to the database session
     db_models.db.session.add(new_resource)
+
+    # Count the new case in the rollup
+    if case_cache_dict is not None:
+        rollup.record_cases(added=[case_cache_dict])
+
+    # Move the written tables to new versions (new ETags, cached responses unreachable)
+    result_cache.record_writes([resource_table_name] + (["case_cache"] if case_cache_dict is not None else []))
+
+    # Commit the whole creation in a single transaction
     db_models.db.session.commit()
+    result_cache.forget_versions()
+
+    # Reload the administrative hierarchy if it was modified
+    if resource_table_name in admin_hierarchy.LEVELS:
+        admin_hierarchy.invalidate()
+
+def validate_record(db_model, record):
+    """
+    Check a record against the columns of a database model and convert its dates.
+
+    Args:
+        db_model: The database model class the record is meant for.
+        record (dict): The record's details, as sent by the client.
+
+    Returns:
+        tuple: The record with its dates converted to datetimes and without "id" (ids are generated),
+               and an error message (None if the record is valid).
+    """
+    if not isinstance(record, dict):
+        return None, "a record must be a JSON object"
+    columns = db_model.__table__.columns
+    unknown_columns = sorted(set(record) - set(columns.keys()))
+    if unknown_columns:
+        return None, f"unknown columns {unknown_columns}"
+
+    row = {}
+    for column_name, value in record.items():
+        # The ids are generated at insertion
+        if column_name == "id" or value is None:
+            continue
+        column_type = columns[column_name].type
+        if isinstance(column_type, db_models.db.Integer):
+            if isinstance(value, bool) or not isinstance(value, int):
+                return None, f"{column_name} must be an integer"
+        elif isinstance(column_type, db_models.db.DateTime):
+            try:
+                value = datetime.datetime.fromisoformat(str(value))
+            except ValueError:
+                return None, f"{column_name} must be an ISO 8601 date"
+        elif isinstance(column_type, db_models.db.String):
+            if not isinstance(value, str):
+                return None, f"{column_name} must be a string"
+            if column_type.length is not None and len(value) > column_type.length:
+                return None, f"{column_name} is longer than {column_type.length} characters"
+        row[column_name] = value
+    return row, None
+
+@metrics.timed("controller")
+def bulk_create_resources(resource_table_name, records):
+    """
+    Create several new resources in the specified database table, all or none of them:
+    every record is validated first, the related blood tests and patients are fetched in one query each,
+    and the rows (plus the derived "case_cache" rows of malaria results) are inserted with batched
+    statements in a single transaction.
+
+    Args:
+        resource_table_name (str): The name of the table where the new resources will be created.
+        records (list): The list of dictionaries containing the details of the new resources.
+
+    Returns:
+        dict: The "ids" of the created resources, or the per-record "errors" (a list of dictionaries
+              with the "index" of the record in the list and the "error" message) if none was created.
+    """
+    # Get the database model class for the specified resource table
+    db_model = getattr(db_models, str.capitalize(resource_table_name))
 
+    # Validate every record before writing anything
+    rows, errors = [], []
+    for index, record in enumerate(records):
+        row, error = validate_record(db_model, record)
+        if error is not None:
+            errors.append({"index": index, "error": error})
+        rows.append(row)
+
+    # Fetch the blood tests of the malaria results, and their patients, in one query each
+    if resource_table_name == "malaria_results":
+        blood_test_ids = {row.get("blood_test_id") for row in rows if row is not None} - {None}
+        blood_tests = dict(db_models.db.session.query(db_models.Blood_test.id, db_models.Blood_test.patient_id)
+                           .filter(db_models.Blood_test.id.in_(blood_test_ids)).all()) if blood_test_ids else {}
+        patient_ids = set(blood_tests.values()) - {None}
+        patients = {patient.id: patient for patient in
+                    db_models.Patient.query.filter(db_models.Patient.id.in_(patient_ids)).all()} if patient_ids else {}
+        for index, row in enumerate(rows):
+            if row is None:
+                continue
+            if row.get("blood_test_id") not in blood_tests:
+                errors.append({"index": index, "error": f"blood test {row.get('blood_test_id')} not found"})
+            elif blood_tests[row["blood_test_id"]] not in patients:
+                errors.append({"index": index, "error": f"patient of blood test {row['blood_test_id']} not found"})
+
+    if errors:
+        return {"errors": sorted(errors, key=lambda error: error["index"])}
+
+    # Allocate the new IDs of the whole batch at once
+    for new_id, row in zip(id_allocation.allocate_ids(resource_table_name, len(rows)), rows):
+        row["id"] = new_id
+
+        # Store users' passwords as hashes
+        if resource_table_name == "user" and row.get("password") is not None:
+            row["password"] = authentication.hash_password(row["password"])
+
+    try:
+        # Insert the rows with one batched statement
+        if rows:
+            db_models.db.session.execute(db_model.__table__.insert(), rows)
+
+        # Derive the "case_cache" rows of the malaria results from their patients' details
+        if resource_table_name == "malaria_results" and rows:
+            now = datetime.datetime.now()
+            case_cache_rows = []
+            for row in rows:
+                patient = patients[blood_tests[row["blood_test_id"]]]
+                case_cache_rows.append({"id": row["id"],
+                                        "date": now,
+                                        "patient_id": patient.id,
+                                        "name": patient.name,
+                                        "date_of_birth": patient.date_of_birth,
+                                        "gender": patient.gender,
+                                        "village_id": patient.village_id,
+                                        "health_center_id": patient.health_center_id,
+                                        "malaria_status": row.get("malaria_status"),
+                                        "parasite_type": row.get("parasite_type"),
+                                        "blood_test_id": row["blood_test_id"]})
+            db_models.db.session.execute(db_models.Case_cache.__table__.insert(), case_cache_rows)
+        elif resource_table_name == "case_cache":
+            case_cache_rows = rows
+        else:
+            case_cache_rows = []
+
+        # Count the new cases in the rollup, with one batched upsert
+        rollup.record_cases(added=case_cache_rows)
+
+        # Move the written tables to new versions (new ETags, cached responses unreachable)
+        result_cache.record_writes([resource_table_name] + (["case_cache"] if case_cache_rows else []))
+
+        # Commit the whole batch at once
+        db_models.db.session.commit()
+    except Exception:
+        db_models.db.session.rollback()
+        raise
+    result_cache.forget_versions()
+
+    # Reload the administrative hierarchy if it was modified
+    if resource_table_name in admin_hierarchy.LEVELS:
+        admin_hierarchy.invalidate()
+
+    return {"ids": [row["id"] for row in rows]}
+
+@metrics.timed("controller")
 def update_resource(resource_table_name, id, details_dict):
     """
     Update an existing resource in the specified database table with the provided details.
@@ -240,13 +892,43 @@ def update_resource(resource_table_name, id, details_dict):
     
     # Query the resource to be updated based on the provided ID
     resource = db_model.query.filter_by(id=id).first()
+
+    # Store users' passwords as hashes
+    if resource_table_name == "user" and details_dict.get("password") is not None:
+        details_dict["password"] = authentication.hash_password(details_dict["password"])
+
+    # Keep the case's values before the update, to move it in the rollup
+    if resource_table_name == "case_cache":
+        old_case = {column.name: getattr(resource, column.name) for column in db_model.__table__.columns}
     
     # Iterate through the details dictionary and set the updated attributes for the resource
     [setattr(resource, attr, val) for attr, val in details_dict.items()]
+
+    # Revoke the session tokens issued to the user before the update
+    if resource_table_name == "user":
+        resource.token_version = (resource.token_version or 0) + 1
+
+    # Move the case in the rollup
+    if resource_table_name == "case_cache":
+        new_case = {column.name: getattr(resource, column.name) for column in db_model.__table__.columns}
+        rollup.record_cases(added=[new_case], removed=[old_case])
     
+    # Move the table to a new version (new ETags, cached responses unreachable)
+    result_cache.record_writes([resource_table_name])
+
     # Commit the transaction to save the changes to the resource
     db_models.db.session.commit()
+    result_cache.forget_versions()
 
+    # Forget cached authentications if a user was modified
+    if resource_table_name == "user":
+        authentication.invalidate_credentials_cache()
+
+    # Reload the administrative hierarchy if it was modified
+    if resource_table_name in admin_hierarchy.LEVELS:
+        admin_hierarchy.invalidate()
+
+@metrics.timed("controller")
 def delete_resource(resource_table_name, id):
     """
     Delete an existing resource from the specified database table based on the provided ID.
@@ -263,11 +945,28 @@ def delete_resource(resource_table_name, id):
     
     # Query the resource to be deleted based on the provided ID
     resource = db_model.query.filter_by(id=id).first()
+
+    # Remove the case from the rollup
+    if resource_table_name == "case_cache":
+        rollup.record_cases(removed=[{column.name: getattr(resource, column.name)
+                                      for column in db_model.__table__.columns}])
     
     # Delete the queried resource from the database
     db_models.db.session.delete(resource)
     
+    # Move the table to a new version (new ETags, cached responses unreachable)
+    result_cache.record_writes([resource_table_name])
+
     # Commit the transaction to remove the resource from the database
     db_models.db.session.commit()
+    result_cache.forget_versions()
+
+    # Forget cached authentications if a user was deleted
+    if resource_table_name == "user":
+        authentication.invalidate_credentials_cache()
+
+    # Reload the administrative hierarchy if it was modified
+    if resource_table_name in admin_hierarchy.LEVELS:
+        admin_hierarchy.invalidate()
 
      
\ No newline at end of file
@@ -6,46 +6,106 @@ This file contains the helper functions used in the controllers.py file.
 """
 
 from db_models import db
+import metrics
 
-def table_querying(table_name="case_cache"):
+def select_list(columns=None):
+    """
+    Build the select list of a query.
+
+    Args:
+        columns (list, optional): The columns to select, in order (names checked against the models
+                                  by the caller). Defaults to None (all columns).
+
+    Returns:
+        str: The SQL select list.
+    """
+    return "*" if columns is None else ", ".join(columns)
+
+def village_ranges_filter(village_ranges):
+    """
+    Build the SQL condition selecting the records whose "village_id" lies in one of the given ranges
+    (a range scan on the indexed "village_id" column per range).
+
+    Args:
+        village_ranges (list): The (first, last) village ids of the ranges, both inclusive.
+
+    Returns:
+        tuple: The SQL condition and its bind parameters (an always false condition if there is no range).
+    """
+    if not village_ranges:
+        return "1 = 0", {}
+    conditions = [f"village_id between :village_first_{i} and :village_last_{i}" for i in range(len(village_ranges))]
+    params = {}
+    for i, (first, last) in enumerate(village_ranges):
+        params.update({f"village_first_{i}": int(first), f"village_last_{i}": int(last)})
+    return "(" + " or ".join(conditions) + ")", params
+
+def table_querying(table_name="case_cache", village_ranges=None, columns=None):
     """
     Execute a SQL query to retrieve all records from the specified table.
 
     Args:
         table_name (str, optional): The name of the table to query. Defaults to "case_cache".
+        village_ranges (list, optional): If provided, only the records whose "village_id" lies in one of
+                                         these (first, last) ranges are retrieved. Defaults to None.
+        columns (list, optional): The columns to select, in order. Defaults to None (all columns).
 
     Returns:
         sqlalchemy.engine.ResultProxy: The query response containing the retrieved records.
     """
+    if village_ranges is None:
+        where_sql_str, params = "", {}
+    else:
+        where_sql_str, params = village_ranges_filter(village_ranges)
+        where_sql_str = f"where {where_sql_str}"
     response = db.engine.execute(
-        f"""
-        select * 
-        from {table_name}
-        """
+        db.text(
+            f"""
+            select {select_list(columns)} 
+            from {table_name}
+            {where_sql_str}
+            """
+        ),
+        **params
     )
     return response
 
-def datetime_index_detector(datetime_str):
+def table_date_range_filter(early_date, late_date, table_name="case_cache", village_ranges=None, columns=None):
     """
-    Detect the index of the first record in the "blood_test" table with a date greater than or equal to the given datetime.
+    Execute a bounded range query on the indexed "date" column of the specified table.
 
     Args:
-        datetime_str (str): The datetime string to compare against the "date" column in the "blood_test" table.
+        early_date (str): The inclusive lower bound of the datetime range.
+        late_date (str): The exclusive upper bound of the datetime range.
+        table_name (str, optional): The name of the table to query. Defaults to "case_cache".
+        village_ranges (list, optional): If provided, only the records whose "village_id" lies in one of
+                                         these (first, last) ranges are retrieved. Defaults to None.
+        columns (list, optional): The columns to select, in order. Defaults to None (all columns).
 
     Returns:
-        int: The index of the first record meeting the condition, or None if no such record is found.
+        sqlalchemy.engine.ResultProxy: The query response containing the records dated within
+                                       [early_date, late_date), ordered by date.
     """
+    if village_ranges is None:
+        village_sql_str, params = "", {}
+    else:
+        village_sql_str, params = village_ranges_filter(village_ranges)
+        village_sql_str = f"and {village_sql_str}"
     response = db.engine.execute(
-        f"""
-        select *    
-        from blood_test
-        where date >= '{datetime_str}'
-        limit 1
-        """
+        db.text(
+            f"""
+            select {select_list(columns)} 
+            from {table_name}
+            where date >= :early_date and date < :late_date
+            {village_sql_str}
+            order by date, id
+            """
+        ),
+        early_date=early_date, late_date=late_date, **params
     )
-    return [i for i in response][0][0]
+    return response
 
-def table_column_filter(key,table_name="patient",key_column="name",is_num=False):
+def table_column_filter(key,table_name="patient",key_column="name",is_num=False,columns=None):
     """
     Filter records from the specified table based on the provided key value.
 
@@ -54,6 +114,7 @@ def table_column_filter(key,table_name="patient",key_column="name",is_num=False)
         table_name (str, optional): The name of the table to filter. Defaults to "patient".
         key_column (str, optional): The name of the column to use for filtering. Defaults to "name".
         is_num (bool, optional): Whether the key is a numeric value. Defaults to False.
+        columns (list, optional): The columns to select, in order. Defaults to None (all columns).
 
     Returns:
         sqlalchemy.engine.ResultProxy: The query response containing the filtered records.
@@ -61,7 +122,7 @@ def table_column_filter(key,table_name="patient",key_column="name",is_num=False)
     if is_num:
         response = db.engine.execute(
             f"""
-            select * 
+            select {select_list(columns)} 
             from {table_name}
             where {key_column} = {key}
             """
@@ -69,7 +130,7 @@ def table_column_filter(key,table_name="patient",key_column="name",is_num=False)
         return response
     response = db.engine.execute(
         f"""
-        select * 
+        select {select_list(columns)} 
         from {table_name}
         where {key_column} = '{key}'
         """
@@ -109,7 +170,7 @@ def table_last_id(table_name):
     global table_size_dict
     response = db.engine.execute(
         f"""
-        select * 
+        select id 
         from {table_name}
         order by id desc limit 1
         """
@@ -117,3 +178,239 @@ def table_last_id(table_name):
     for i in response:
         return i[0]
     
+
+def table_ids_filter(ids, table_name="patient", columns=None):
+    """
+    Retrieve the records of the specified table whose id is in the provided list.
+
+    Args:
+        ids (list): The integer ids of the records to retrieve.
+        table_name (str, optional): The name of the table to filter. Defaults to "patient".
+        columns (list, optional): The columns to select, in order. Defaults to None (all columns).
+
+    Returns:
+        list: The retrieved records (an empty list if no id was provided).
+    """
+    if len(ids) == 0:
+        return []
+    ids_sql_str = ", ".join([str(int(i)) for i in ids])
+    response = db.engine.execute(
+        f"""
+        select {select_list(columns)} 
+        from {table_name}
+        where id in ({ids_sql_str})
+        """
+    )
+    return [i for i in response]
+
+# Modulus of the seeded hash ranking the records of a sample (the largest prime below 2**31)
+SAMPLE_HASH_MODULUS = 2147483647
+
+@metrics.timed("sql")
+def table_sample_ids(table_name, hash_keys, limit, stratum=None, joins=[]):
+    """
+    Draw a sample of the ids of the specified table in the database: the records of every stratum are ranked
+    by a seeded hash of their id, and the first records of each stratum are read back.
+    The database hashes and ranks every record of the table (one scan and a sort per stratum),
+    but only the sampled ids are sent back.
+
+    Args:
+        table_name (str): The name of the table to sample.
+        hash_keys (list): The 4 keys seeding the hash (integers below SAMPLE_HASH_MODULUS).
+        limit (int): The number of records read per stratum.
+        stratum (str, optional): The SQL expression of the records' stratum. Defaults to None (a single stratum).
+        joins (list, optional): The SQL join clauses needed by the stratum. Defaults to [].
+
+    Returns:
+        sqlalchemy.engine.ResultProxy: The query response containing the stratum, the id and the population
+                                       of the stratum of each record read, ordered by stratum and rank.
+    """
+    # Hash the id with two seeded affine maps multiplied together (every product fits in 64 bits)
+    integer_type = "signed" if db.engine.dialect.name == "mysql" else "bigint"
+    value_sql_str = f"(cast({table_name}.id as {integer_type}) % :modulus)"
+    hash_sql_str = f"((({value_sql_str} * :key_0 + :key_1) % :modulus) * " \
+                   f"(({value_sql_str} * :key_2 + :key_3) % :modulus)) % :modulus"
+    partition_sql_str = "" if stratum is None else f"partition by {stratum}"
+    joins_sql_str = "\n".join(joins)
+    order_by_sql_str = "position" if stratum is None else "stratum, position"
+    response = db.engine.execute(
+        db.text(
+            f"""
+            select stratum, id, population
+            from (
+                select {stratum or 'null'} as stratum, {table_name}.id as id,
+                       row_number() over ({partition_sql_str} order by {hash_sql_str}, {table_name}.id) as position,
+                       count(*) over ({partition_sql_str}) as population
+                from {table_name}
+                {joins_sql_str}
+            ) as ranked
+            where position <= :limit
+            order by {order_by_sql_str}
+            """
+        ),
+        modulus=SAMPLE_HASH_MODULUS, limit=limit, **{f"key_{i}": key for i, key in enumerate(hash_keys)}
+    )
+    return response
+
+@metrics.timed("sql")
+def table_streaming(table_name="case_cache", chunk_size=1000, columns=None,
+                    early_date=None, late_date=None, village_ranges=None):
+    """
+    Read records from the specified table through a server-side cursor, chunk by chunk.
+
+    Args:
+        table_name (str, optional): The name of the table to query. Defaults to "case_cache".
+        chunk_size (int, optional): The number of records fetched per chunk. Defaults to 1000.
+        columns (list, optional): The columns to select, in order. Defaults to None (all columns).
+        early_date (str, optional): If provided with late_date, only the records dated within
+                                    [early_date, late_date) are read, ordered by date. Defaults to None.
+        late_date (str, optional): The exclusive upper bound of the datetime range. Defaults to None.
+        village_ranges (list, optional): If provided, only the records whose "village_id" lies in one of
+                                         these (first, last) ranges are read. Defaults to None.
+
+    Yields:
+        list: The next chunk of at most chunk_size records.
+    """
+    conditions, params = [], {}
+    if early_date is not None:
+        conditions.append("date >= :early_date and date < :late_date")
+    if village_ranges is not None:
+        village_sql_str, params = village_ranges_filter(village_ranges)
+        conditions.append(village_sql_str)
+    filter_sql_str = "" if not conditions else f"where {' and '.join(conditions)}"
+    if early_date is not None:
+        filter_sql_str += " order by date, id"
+    with db.engine.connect() as connection:
+        response = connection.execution_options(stream_results=True).execute(
+            db.text(
+                f"""
+                select {select_list(columns)} 
+                from {table_name}
+                {filter_sql_str}
+                """
+            ),
+            early_date=early_date, late_date=late_date, **params
+        )
+        while True:
+            rows = response.fetchmany(chunk_size)
+            if not rows:
+                break
+            metrics.count_rows(len(rows))
+            yield rows
+
+def table_page(table_name="case_cache", after_id=None, limit=1000, village_ranges=None, columns=None):
+    """
+    Execute a keyset (seek) query retrieving the page of records following a given id.
+    The primary key index makes the cost of a page independent of its depth, unlike OFFSET.
+
+    Args:
+        table_name (str, optional): The name of the table to query. Defaults to "case_cache".
+        after_id (int, optional): The id after which the page starts. Defaults to None (first page).
+        limit (int, optional): The maximum number of records in the page. Defaults to 1000.
+        village_ranges (list, optional): If provided, only the records whose "village_id" lies in one of
+                                         these (first, last) ranges are retrieved. Defaults to None.
+        columns (list, optional): The columns to select, in order. Defaults to None (all columns).
+
+    Returns:
+        sqlalchemy.engine.ResultProxy: The query response containing the records of the page, ordered by id.
+    """
+    conditions, params = [], {}
+    if after_id is not None:
+        conditions.append("id > :after_id")
+    if village_ranges is not None:
+        village_sql_str, params = village_ranges_filter(village_ranges)
+        conditions.append(village_sql_str)
+    where_sql_str = "" if not conditions else f"where {' and '.join(conditions)}"
+    response = db.engine.execute(
+        db.text(
+            f"""
+            select {select_list(columns)} 
+            from {table_name}
+            {where_sql_str}
+            order by id
+            limit :limit
+            """
+        ),
+        after_id=after_id, limit=limit, **params
+    )
+    return response
+
+def table_aggregating(table_name, select, group_by, joins=[], having=None,
+                      early_date=None, late_date=None, date_column="date"):
+    """
+    Execute a single GROUP BY query over the specified table.
+
+    Args:
+        table_name (str): The name of the table to aggregate.
+        select (list): The SQL expressions (with their aliases) of the grouped columns and metrics.
+        group_by (list): The SQL expressions to group by (none for a single overall row).
+        joins (list, optional): The SQL join clauses needed by the expressions. Defaults to [].
+        having (str, optional): The SQL condition the groups must meet. Defaults to None.
+        early_date (str, optional): If provided with late_date, only the records dated within
+                                    [early_date, late_date) are aggregated. Defaults to None.
+        late_date (str, optional): The exclusive upper bound of the datetime range. Defaults to None.
+        date_column (str, optional): The column the datetime range applies to. Defaults to "date".
+
+    Returns:
+        sqlalchemy.engine.ResultProxy: The query response containing one record per group, ordered by group.
+    """
+    joins_sql_str = "\n".join(joins)
+    where_sql_str = "" if early_date is None else \
+        f"where {table_name}.{date_column} >= :early_date and {table_name}.{date_column} < :late_date"
+    group_by_sql_str = "" if not group_by else f"group by {', '.join(group_by)}"
+    having_sql_str = "" if having is None else f"having {having}"
+    order_by_sql_str = "" if not group_by else f"order by {', '.join(group_by)}"
+    response = db.engine.execute(
+        db.text(
+            f"""
+            select {', '.join(select)}
+            from {table_name}
+            {joins_sql_str}
+            {where_sql_str}
+            {group_by_sql_str}
+            {having_sql_str}
+            {order_by_sql_str}
+            """
+        ),
+        early_date=early_date, late_date=late_date
+    )
+    return response
+
+def table_versions():
+    """
+    Retrieve the write version of every table written to so far.
+
+    Returns:
+        sqlalchemy.engine.ResultProxy: The query response containing each table name and its version.
+    """
+    response = db.engine.execute(
+        """
+        select table_name, version 
+        from table_version
+        """
+    )
+    return response
+
+def village_ancestors(village_ids):
+    """
+    Retrieve the cell, sector, district and province of each of the specified villages.
+
+    Args:
+        village_ids (iterable): The ids of the villages.
+
+    Returns:
+        sqlalchemy.engine.ResultProxy: The query response containing, for each village found,
+                                       its id, cell_id, sector_id, district_id and province_id.
+    """
+    village_ids_sql_str = ", ".join([str(int(i)) for i in village_ids]) or "null"
+    response = db.engine.execute(
+        f"""
+        select village.id, village.cell_id, cell.sector_id, sector.district_id, district.province_id
+        from village
+        left join cell on cell.id = village.cell_id
+        left join sector on sector.id = cell.sector_id
+        left join district on district.id = sector.district_id
+        where village.id in ({village_ids_sql_str})
+        """
+    )
+    return response
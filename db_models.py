@@ -66,14 +66,14 @@ class Patient(db.Model):
     name = db.Column(db.String(200))
     date_of_birth = db.Column(db.DateTime)
     gender = db.Column(db.String(200))
-    village_id = db.Column(db.Integer, db.ForeignKey('village.id'))
+    village_id = db.Column(db.Integer, db.ForeignKey('village.id'), index=True)
     health_center_id = db.Column(db.Integer, db.ForeignKey('health_center.id'))
     blood_tests = db.relationship('Blood_test', backref='patient')
 
 # Define Blood Test table model
 class Blood_test(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime)
+    date = db.Column(db.DateTime, index=True)
     image_url = db.Column(db.String(20000))
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'))
     malaria_results = db.relationship('Malaria_results', backref='blood_test')
@@ -88,12 +88,12 @@ class Malaria_results(db.Model):
 # Define Case Cache table model
 class Case_cache(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.DateTime)
+    date = db.Column(db.DateTime, index=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'))
     name = db.Column(db.String(200))
     date_of_birth = db.Column(db.DateTime)
     gender = db.Column(db.String(200))
-    village_id = db.Column(db.Integer, db.ForeignKey('village.id'))
+    village_id = db.Column(db.Integer, db.ForeignKey('village.id'), index=True)
     health_center_id = db.Column(db.Integer, db.ForeignKey('health_center.id'))
     malaria_status = db.Column(db.String(200))
     parasite_type = db.Column(db.String(200))
@@ -112,3 +112,28 @@ class User(db.Model):
     password = db.Column(db.String(200))
     role = db.Column(db.String(200))
     health_center_id = db.Column(db.Integer, db.ForeignKey('health_center.id'))
+    # Version of the user's session tokens, incremented when the user is updated (NULL reads as 0)
+    token_version = db.Column(db.Integer, default=0)
+
+# Define Id_block table model (high-water marks of the ids reserved per table, see id_allocation.py)
+class Id_block(db.Model):
+    table_name = db.Column(db.String(200), primary_key=True)
+    next_id = db.Column(db.Integer)
+
+# Define Table_version table model (write version of each table, see result_cache.py)
+class Table_version(db.Model):
+    table_name = db.Column(db.String(200), primary_key=True)
+    version = db.Column(db.BigInteger)
+
+# Define Case_rollup table model (case counts per village, day, malaria status, parasite type and gender, see rollup.py)
+class Case_rollup(db.Model):
+    village_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    day = db.Column(db.Date, primary_key=True, index=True)
+    malaria_status = db.Column(db.String(200), primary_key=True)
+    parasite_type = db.Column(db.String(200), primary_key=True)
+    gender = db.Column(db.String(200), primary_key=True)
+    cell_id = db.Column(db.Integer)
+    sector_id = db.Column(db.Integer)
+    district_id = db.Column(db.Integer)
+    province_id = db.Column(db.Integer)
+    count = db.Column(db.Integer)
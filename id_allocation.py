@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""The ID allocator
+DESCRIPTION:
+------------
+This file contains the allocator of the primary keys given to the resources created through the API.
+Ids are reserved by blocks of ID_BLOCK_SIZE and handed out from memory, so most inserts cost no extra query:
+    - on PostgreSQL, a block is drawn from the table's id sequence ("nextval" over "generate_series"),
+    - on the other dialects (or tables without a sequence), a block is reserved in the "id_block" table
+      (HiLo) with one atomic "update".
+Both are safe with concurrent writers, threads or processes alike: an id is never handed out twice.
+The ids left in a block when a process stops are skipped, so ids may have gaps but never repeat.
+"case_cache" rows share the ids of their "malaria_results" rows, so they draw from its allocator.
+After rows are loaded with explicit ids (migrate.py), sync_id_sequences moves the allocators past them.
+"""
+
+import threading
+import db_models
+from db_models import db
+from config import cfg
+import sqlalchemy as sa
+
+# Tables whose ids are drawn from another table's allocator
+ID_SOURCES = {"case_cache": "malaria_results"}
+
+# Ids reserved by this process and not handed out yet, per table
+_reserved_ids = {}
+_reserved_ids_lock = threading.Lock()
+
+# Tables found without an id sequence on PostgreSQL (they fall back on the "id_block" table)
+_tables_without_sequence = set()
+
+def allocate_ids(table_name, count=1):
+    """
+    Allocate new primary keys for the specified table.
+
+    Args:
+        table_name (str): The name of the table the resources will be created in.
+        count (int, optional): The number of ids to allocate. Defaults to 1.
+
+    Returns:
+        list: The allocated ids, in increasing order, that no other caller will receive.
+    """
+    table_name = ID_SOURCES.get(table_name, table_name)
+    with _reserved_ids_lock:
+        reserved_ids = _reserved_ids.setdefault(table_name, [])
+
+        # Reserve a new block when the ids left are not enough
+        if len(reserved_ids) < count:
+            reserved_ids.extend(_reserve_block(table_name, max(count - len(reserved_ids), cfg["ID_BLOCK_SIZE"])))
+
+        ids = reserved_ids[:count]
+        del reserved_ids[:count]
+    return ids
+
+def _reserve_block(table_name, count):
+    """
+    Reserve a block of ids in the database.
+
+    Args:
+        table_name (str): The name of the table.
+        count (int): The number of ids to reserve.
+
+    Returns:
+        list: The reserved ids.
+    """
+    if db.engine.dialect.name == "postgresql" and table_name not in _tables_without_sequence:
+        ids = _reserve_sequence_block(table_name, count)
+        if ids is not None:
+            return ids
+        _tables_without_sequence.add(table_name)
+    return _reserve_hilo_block(table_name, count)
+
+def _reserve_sequence_block(table_name, count):
+    """
+    Draw a block of ids from the table's id sequence (PostgreSQL), in a single query.
+
+    Args:
+        table_name (str): The name of the table.
+        count (int): The number of ids to draw.
+
+    Returns:
+        list: The drawn ids, or None if the table's id column has no sequence.
+    """
+    response = db.engine.execute(
+        db.text(
+            """
+            select nextval(pg_get_serial_sequence(:table_name, 'id'))
+            from generate_series(1, :count)
+            """
+        ),
+        table_name=f'"{table_name}"', count=count
+    )
+    ids = sorted([i[0] for i in response])
+    if not ids or ids[0] is None:
+        return None
+    return ids
+
+def _reserve_hilo_block(table_name, count):
+    """
+    Reserve a block of ids by moving the table's high-water mark in the "id_block" table.
+    The "update" locks the table's row until the transaction commits, so concurrent reservations never overlap.
+
+    Args:
+        table_name (str): The name of the table.
+        count (int): The number of ids to reserve.
+
+    Returns:
+        list: The reserved ids.
+    """
+    while True:
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                db.text("update id_block set next_id = next_id + :count where table_name = :table_name"),
+                count=count, table_name=table_name
+            ).rowcount
+            if updated:
+                next_id = connection.execute(
+                    db.text("select next_id from id_block where table_name = :table_name"),
+                    table_name=table_name
+                ).scalar()
+                return list(range(next_id - count, next_id))
+
+        # First reservation for this table: start the high-water mark after its last id
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    db.text("insert into id_block (table_name, next_id) values (:table_name, :next_id)"),
+                    table_name=table_name, next_id=_last_id(connection, table_name) + 1
+                )
+        except sa.exc.IntegrityError:
+            # Another writer created the row first, reserve from it
+            pass
+
+def _last_id(connection, table_name):
+    """
+    Retrieve the last (maximum) id handed out by the specified table's allocator,
+    in the table itself and in the tables drawing their ids from it (ID_SOURCES).
+
+    Args:
+        connection (sqlalchemy.engine.Connection): The connection to use.
+        table_name (str): The name of the table.
+
+    Returns:
+        int: The last id, or 0 if the tables are empty.
+    """
+    table_names = [table_name] + [name for name, source in ID_SOURCES.items() if source == table_name]
+    last_ids = [connection.execute(sa.select([sa.func.max(db.metadata.tables[name].c.id)])).scalar() or 0
+                for name in table_names]
+    return max(last_ids)
+
+def sync_id_sequences():
+    """
+    Move every table's id allocator past the ids already in the table
+    (to be called after rows were inserted with explicit ids, e.g. by migrate.py).
+    Allocators are only moved forward, so the ids reserved by running processes stay unique.
+
+    Returns:
+        None
+    """
+    with _reserved_ids_lock:
+        _reserved_ids.clear()
+        _tables_without_sequence.clear()
+
+    # Tables drawing from another table's allocator are synced with it
+    tables = [table for table in db.metadata.sorted_tables
+              if "id" in table.c and table.name != db_models.Id_block.__tablename__ and table.name not in ID_SOURCES]
+    with db.engine.begin() as connection:
+        for table in tables:
+            next_id = _last_id(connection, table.name) + 1
+
+            if db.engine.dialect.name == "postgresql":
+                # Only move the sequence forward (tables without a sequence are skipped)
+                connection.execute(
+                    db.text(
+                        """
+                        select setval(sequence_name,
+                                      greatest(:next_id, coalesce(pg_sequence_last_value(sequence_name::regclass) + 1, 1)),
+                                      false)
+                        from (select pg_get_serial_sequence(:table_name, 'id') as sequence_name) as sequence
+                        where sequence_name is not null
+                        """
+                    ),
+                    table_name=f'"{table.name}"', next_id=next_id
+                )
+
+            # Move the HiLo high-water mark forward, creating it if needed
+            updated = connection.execute(
+                db.text("update id_block set next_id = :next_id where table_name = :table_name and next_id < :next_id"),
+                table_name=table.name, next_id=next_id
+            ).rowcount
+            exists = connection.execute(
+                db.text("select count(*) from id_block where table_name = :table_name"),
+                table_name=table.name
+            ).scalar()
+            if not updated and not exists:
+                connection.execute(
+                    db.text("insert into id_block (table_name, next_id) values (:table_name, :next_id)"),
+                    table_name=table.name, next_id=next_id
+                )
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""The Request logs archive
+DESCRIPTION:
+------------
+This file contains the compaction job and the query tool of the request logs archive.
+The compaction folds the sealed JSONL segments (and the per-request JSON files of older versions)
+found in REQUEST_LOGS_PATH into one compressed archive per day, "<archive path>/YYYY-MM-DD.jsonl.gz".
+An archive is a sequence of independently compressed blocks of records sorted by time (a block never
+spans two hours), and its sidecar index "YYYY-MM-DD.idx.json" lists the blocks holding each user id,
+table name and hour, so that audit queries only read and decompress the relevant blocks.
+Retention is enforced by deleting whole archives.
+
+USAGE:
+------
+python log_archive.py compact [--retention-days 365]
+python log_archive.py query --user-id 3 --since 2023-08-01 --until 2023-09-01 [--table patient] [--summary]
+"""
+
+import argparse
+import collections
+import datetime
+import glob
+import gzip
+import json
+import os
+import re
+import sys
+import config
+
+# Default locations of the raw logs and of the archive
+REQUEST_LOGS_PATH = config.cfg["REQUEST_LOGS_PATH"]
+REQUEST_LOGS_ARCHIVE_PATH = config.cfg["REQUEST_LOGS_ARCHIVE_PATH"]
+
+# Maximum number of records per compressed block
+BLOCK_RECORDS = 1000
+
+# Pattern of the table name in the requests' paths
+TABLE_PATH_PATTERN = re.compile(r"^/tables/([^/]+)")
+
+def normalize_record(raw_record):
+    """
+    Convert a log record to the JSONL segments' format (records of older versions are converted).
+
+    Args:
+        raw_record: A record read from a JSONL segment (dict) or an older per-request JSON file (list).
+
+    Returns:
+        dict: The record, in the JSONL segments' format.
+    """
+    if isinstance(raw_record, dict):
+        return raw_record
+    parts = {}
+    for part in raw_record:
+        parts.update(part)
+    request = parts.get("request", {})
+    table = TABLE_PATH_PATTERN.match(request.get("path", ""))
+    user_details = parts.get("user_details", {})
+    return {"timestamp": parts["timestamp"],
+            "user": {key: user_details[key] for key in ["id", "email", "role", "health_center_id"]
+                     if key in user_details},
+            "method": request.get("method"),
+            "path": request.get("path"),
+            "table": table.group(1) if table else None,
+            "remote_addr": request.get("remote_addr"),
+            "columns_to_drop": parts.get("columns_to_drop")}
+
+def read_log_file(path):
+    """
+    Read the records of a raw log file.
+
+    Args:
+        path (str): The path of a JSONL segment or of an older per-request JSON file.
+
+    Returns:
+        list: The records of the file, in the JSONL segments' format.
+
+    Raises:
+        OSError: If the file cannot be read.
+        ValueError: If the file is not valid JSON (e.g. truncated).
+    """
+    with open(path, encoding="utf-8") as infile:
+        if path.endswith(".jsonl"):
+            return [normalize_record(json.loads(line)) for line in infile if line.strip()]
+        return [normalize_record(json.load(infile))]
+
+def index_keys(record):
+    """
+    List the index entries of a record.
+
+    Args:
+        record (dict): A log record.
+
+    Returns:
+        dict: The record's user id, table name and hour, as strings.
+    """
+    return {"user_id": str(record.get("user", {}).get("id")),
+            "table": str(record.get("table")),
+            "hour": record["timestamp"][11:13]}
+
+def archive_paths(archive_path, day):
+    """
+    Build the paths of a day's archive and of its sidecar index.
+
+    Args:
+        archive_path (str): The folder of the archive.
+        day (str): The day, as YYYY-MM-DD.
+
+    Returns:
+        tuple: The path of the archive and the path of its index.
+    """
+    return os.path.join(archive_path, f"{day}.jsonl.gz"), os.path.join(archive_path, f"{day}.idx.json")
+
+def read_blocks(archive_file, index, block_ids):
+    """
+    Read and decompress some blocks of an archive.
+
+    Args:
+        archive_file (str): The path of the archive.
+        index (dict): The sidecar index of the archive.
+        block_ids (iterable): The ids of the blocks to read.
+
+    Yields:
+        dict: The records of the blocks, in order.
+    """
+    with open(archive_file, "rb") as infile:
+        for block_id in sorted(block_ids):
+            block = index["blocks"][block_id]
+            infile.seek(block["offset"])
+            for line in gzip.decompress(infile.read(block["length"])).splitlines():
+                yield json.loads(line)
+
+def write_archive(archive_path, day, records):
+    """
+    Write a day's records as an archive of compressed blocks, with its sidecar index.
+    Both files are written under temporary names and then renamed over the previous ones.
+
+    Args:
+        archive_path (str): The folder of the archive.
+        day (str): The day, as YYYY-MM-DD.
+        records (list): The records of the day, sorted by timestamp.
+
+    Returns:
+        None
+    """
+    archive_file, index_file = archive_paths(archive_path, day)
+    index = {"day": day, "blocks": [], "user_id": {}, "table": {}, "hour": {}}
+    with open(archive_file + ".tmp", "wb") as outfile:
+        block_start = 0
+        while block_start < len(records):
+            # A block stops at BLOCK_RECORDS records or at the end of the hour
+            hour = records[block_start]["timestamp"][:13]
+            block_end = block_start
+            while block_end < len(records) and block_end - block_start < BLOCK_RECORDS \
+                    and records[block_end]["timestamp"][:13] == hour:
+                block_end += 1
+            block_records = records[block_start:block_end]
+
+            # Compress the block and register its position and index entries
+            data = gzip.compress("".join([json.dumps(record, separators=(",", ":")) + "\n"
+                                          for record in block_records]).encode())
+            block_id = len(index["blocks"])
+            index["blocks"].append({"offset": outfile.tell(), "length": len(data),
+                                    "records": len(block_records),
+                                    "first": block_records[0]["timestamp"],
+                                    "last": block_records[-1]["timestamp"]})
+            outfile.write(data)
+            for record in block_records:
+                for key, value in index_keys(record).items():
+                    block_ids = index[key].setdefault(value, [])
+                    if not block_ids or block_ids[-1] != block_id:
+                        block_ids.append(block_id)
+            block_start = block_end
+        index["bytes"] = outfile.tell()
+    with open(index_file + ".tmp", "w", encoding="utf-8") as outfile:
+        json.dump(index, outfile, separators=(",", ":"))
+    os.replace(archive_file + ".tmp", archive_file)
+    os.replace(index_file + ".tmp", index_file)
+
+def load_index(archive_path, day):
+    """
+    Load the sidecar index of a day's archive.
+
+    Args:
+        archive_path (str): The folder of the archive.
+        day (str): The day, as YYYY-MM-DD.
+
+    Returns:
+        dict: The index, or None if the day has no archive.
+    """
+    archive_file, index_file = archive_paths(archive_path, day)
+    if not os.path.exists(index_file) or not os.path.exists(archive_file):
+        return None
+    with open(index_file, encoding="utf-8") as infile:
+        return json.load(infile)
+
+def archived_days(archive_path):
+    """
+    List the days that have an archive.
+
+    Args:
+        archive_path (str): The folder of the archive.
+
+    Returns:
+        list: The days (YYYY-MM-DD), sorted.
+    """
+    return sorted([os.path.basename(path)[:10]
+                   for path in glob.glob(os.path.join(archive_path, "*.jsonl.gz"))])
+
+def compact(logs_path=REQUEST_LOGS_PATH, archive_path=REQUEST_LOGS_ARCHIVE_PATH, retention_days=None):
+    """
+    Fold the sealed raw log files into the daily archives, delete them, and enforce the retention.
+
+    Args:
+        logs_path (str, optional): The folder of the raw logs. Defaults to REQUEST_LOGS_PATH.
+        archive_path (str, optional): The folder of the archive. Defaults to REQUEST_LOGS_ARCHIVE_PATH.
+        retention_days (int, optional): The number of days archives are kept. Defaults to None (forever).
+
+    Returns:
+        dict: The number of raw files and records compacted, of days written and of archives deleted,
+              and the raw files skipped because they could not be read (left in place).
+    """
+    os.makedirs(archive_path, exist_ok=True)
+
+    # Read the sealed segments and the older per-request files ("*.jsonl.part" are still being written)
+    source_files = sorted(glob.glob(os.path.join(logs_path, "*.jsonl")) + glob.glob(os.path.join(logs_path, "*.json")))
+    records_by_day = collections.defaultdict(list)
+    compacted_files, skipped_files = [], []
+    for path in source_files:
+        # Skip the unreadable or truncated files, so that they do not block the compaction of the others
+        try:
+            records = read_log_file(path)
+        except (OSError, ValueError):
+            skipped_files.append(path)
+            continue
+        for record in records:
+            records_by_day[record["timestamp"][:10]].append(record)
+        compacted_files.append(path)
+
+    # Merge the records into each day's archive
+    for day, records in records_by_day.items():
+        index = load_index(archive_path, day)
+        if index is not None:
+            records += list(read_blocks(archive_paths(archive_path, day)[0], index, range(len(index["blocks"]))))
+        # Identical records come from raw files already merged by an interrupted compaction
+        records = list({json.dumps(record, sort_keys=True): record for record in records}.values())
+        records.sort(key=lambda record: record["timestamp"])
+        write_archive(archive_path, day, records)
+
+    # Delete the raw files once every day they contributed to is archived
+    for path in compacted_files:
+        os.remove(path)
+
+    # Delete the archives older than the retention period
+    deleted_archives = 0
+    if retention_days is not None:
+        oldest_day = str(datetime.date.today() - datetime.timedelta(days=retention_days))
+        for day in archived_days(archive_path):
+            if day < oldest_day:
+                for path in archive_paths(archive_path, day):
+                    if os.path.exists(path):
+                        os.remove(path)
+                deleted_archives += 1
+
+    return {"files": len(compacted_files),
+            "records": sum([len(records) for records in records_by_day.values()]),
+            "days": len(records_by_day),
+            "deleted_archives": deleted_archives,
+            "skipped_files": skipped_files}
+
+def query(archive_path=REQUEST_LOGS_ARCHIVE_PATH, user_id=None, table=None, since=None, until=None):
+    """
+    Retrieve the archived records matching an audit query, reading only the blocks the indexes point to.
+
+    Args:
+        archive_path (str, optional): The folder of the archive. Defaults to REQUEST_LOGS_ARCHIVE_PATH.
+        user_id (int, optional): Only keep the records of this user. Defaults to None.
+        table (str, optional): Only keep the records of requests on this table. Defaults to None.
+        since (str, optional): Only keep the records timestamped at or after this datetime. Defaults to None.
+        until (str, optional): Only keep the records timestamped before this datetime. Defaults to None.
+
+    Yields:
+        dict: The matching records, sorted by timestamp.
+    """
+    for day in archived_days(archive_path):
+        if (since is not None and day < since[:10]) or (until is not None and day > until[:10]):
+            continue
+        index = load_index(archive_path, day)
+        if index is None:
+            continue
+
+        # Intersect the blocks holding the user, the table and the hours of the queried period
+        block_ids = set(range(len(index["blocks"])))
+        if user_id is not None:
+            block_ids &= set(index["user_id"].get(str(user_id), []))
+        if table is not None:
+            block_ids &= set(index["table"].get(table, []))
+        hours = [hour for hour in index["hour"]
+                 if (since is None or f"{day} {hour}" >= since[:13].replace("T", " "))
+                 and (until is None or f"{day} {hour}" <= until[:13].replace("T", " "))]
+        block_ids &= set([block_id for hour in hours for block_id in index["hour"][hour]])
+
+        # Read the candidate blocks and filter their records exactly
+        for record in read_blocks(archive_paths(archive_path, day)[0], index, block_ids):
+            if (user_id is None or str(record.get("user", {}).get("id")) == str(user_id)) \
+                    and (table is None or record.get("table") == table) \
+                    and (since is None or record["timestamp"] >= since.replace("T", " ")) \
+                    and (until is None or record["timestamp"] < until.replace("T", " ")):
+                yield record
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact and query the request logs archive.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compact_parser = subparsers.add_parser("compact", help="fold the raw request logs into the daily archives")
+    compact_parser.add_argument("--logs-path", default=REQUEST_LOGS_PATH)
+    compact_parser.add_argument("--archive-path", default=REQUEST_LOGS_ARCHIVE_PATH)
+    compact_parser.add_argument("--retention-days", type=int, default=config.cfg["REQUEST_LOGS_RETENTION_DAYS"],
+                                help="delete the archives older than this number of days")
+
+    query_parser = subparsers.add_parser("query", help="print the archived records matching the filters (JSONL)")
+    query_parser.add_argument("--archive-path", default=REQUEST_LOGS_ARCHIVE_PATH)
+    query_parser.add_argument("--user-id", type=int)
+    query_parser.add_argument("--table")
+    query_parser.add_argument("--since", help="inclusive lower bound, e.g. 2023-08-01 or 2023-08-01T09:00")
+    query_parser.add_argument("--until", help="exclusive upper bound, e.g. 2023-09-01")
+    query_parser.add_argument("--summary", action="store_true",
+                              help="print the number of matching records per user and table instead")
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        print(json.dumps(compact(args.logs_path, args.archive_path, args.retention_days)))
+        return
+
+    records = query(args.archive_path, user_id=args.user_id, table=args.table, since=args.since, until=args.until)
+    if args.summary:
+        counts = collections.Counter([(record.get("user", {}).get("id"), record.get("table")) for record in records])
+        for (user_id, table), count in sorted(counts.items(), key=lambda item: -item[1]):
+            print(f"user {user_id}\ttable {table}\t{count}")
+        return
+    for record in records:
+        sys.stdout.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+if __name__ == '__main__':
+    main()
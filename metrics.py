@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""The Request metrics
+DESCRIPTION:
+------------
+This file contains the instrumentation of the requests' hot path and the Prometheus exposition of its measures.
+Each request's time is split into phases: "auth" (authentication), "sql" (statements executed by the database
+and streamed fetches), "controller" (building the records, DataFrames), "serialize" (JSON encoding), "compress",
+"log" (request logging) and "other" (the rest of the request). Phases are timed exclusively: the time of a phase
+nested in another (e.g. the SQL of a controller) only counts for the inner one.
+The phases' durations, the request's total duration, the number of records returned and the response bytes are
+aggregated into in-process histograms labeled by endpoint (the route's rule) and table, rendered
+in the Prometheus text format by render() (the "/metrics" endpoint).
+When SERVER_TIMING is enabled, responses carry a "Server-Timing" header with the phases of the request
+(streamed responses only report the phases timed before their body is sent).
+"""
+
+import contextlib
+import functools
+import inspect
+import threading
+import time
+from flask import g, has_app_context, json, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import cfg
+from db_models import db
+
+# Phases of a request, in the order they are reported
+PHASES = ["auth", "sql", "controller", "serialize", "compress", "log", "other"]
+
+# Upper bounds of the histograms' buckets
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+ROWS_BUCKETS = [1, 10, 100, 1000, 10000, 100000, 1000000]
+BYTES_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864]
+
+# Histograms and counters, indexed by metric name and label values
+_histograms = {}
+_counters = {}
+_metrics_lock = threading.Lock()
+
+class RequestTimings:
+    """
+    The measures of a request in progress.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases = {}
+        self.rows = 0
+        # Time spent in the phases nested in each running phase (innermost last)
+        self.nested = []
+
+def _current():
+    """
+    Get the measures of the current request.
+
+    Returns:
+        RequestTimings: The measures, or None outside of an instrumented request.
+    """
+    if not has_app_context():
+        return None
+    return g.get("request_timings")
+
+def _start(timings):
+    """
+    Start timing a phase of a request.
+
+    Args:
+        timings (RequestTimings): The measures of the request.
+
+    Returns:
+        float: The start time of the phase.
+    """
+    timings.nested.append(0.0)
+    return time.perf_counter()
+
+def _stop(timings, name, started_at):
+    """
+    Stop timing a phase of a request, adding its exclusive time to the phase.
+
+    Args:
+        timings (RequestTimings): The measures of the request.
+        name (str): The name of the phase.
+        started_at (float): The start time of the phase (as returned by _start).
+
+    Returns:
+        None
+    """
+    elapsed = time.perf_counter() - started_at
+    timings.phases[name] = timings.phases.get(name, 0.0) + elapsed - timings.nested.pop()
+    if timings.nested:
+        timings.nested[-1] += elapsed
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Time a block of code as a phase of the current request (does nothing outside of a request).
+
+    Args:
+        name (str): The name of the phase.
+
+    Yields:
+        None
+    """
+    timings = _current()
+    if timings is None:
+        yield
+        return
+    started_at = _start(timings)
+    try:
+        yield
+    finally:
+        _stop(timings, name, started_at)
+
+def timed(name):
+    """
+    Decorate a function so that its calls are timed as a phase of the current request.
+    The items of generator functions are timed one by one, as they are produced.
+
+    Args:
+        name (str): The name of the phase.
+
+    Returns:
+        callable: The decorator.
+    """
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                try:
+                    while True:
+                        with phase(name):
+                            try:
+                                item = next(generator)
+                            except StopIteration:
+                                return
+                        yield item
+                finally:
+                    generator.close()
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count_rows(count):
+    """
+    Add to the number of records returned by the current request (does nothing outside of a request).
+
+    Args:
+        count (int): The number of rows.
+
+    Returns:
+        None
+    """
+    timings = _current()
+    if timings is not None:
+        timings.rows += count
+
+class TimedJSONEncoder(json.JSONEncoder):
+    """
+    The JSON encoder of the application (jsonify), timing its work as the "serialize" phase.
+    """
+
+    def encode(self, o):
+        with phase("serialize"):
+            return super().encode(o)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _current()
+    if timings is not None:
+        conn.info.setdefault("request_timings_started_at", []).append((timings, _start(timings)))
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("request_timings_started_at")
+    if started:
+        timings, started_at = started.pop()
+        _stop(timings, "sql", started_at)
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    started = connection.info.get("request_timings_started_at") if connection is not None else None
+    if started:
+        timings, started_at = started.pop()
+        _stop(timings, "sql", started_at)
+
+def start_request():
+    """
+    Start measuring the current request.
+
+    Returns:
+        None
+    """
+    g.request_timings = RequestTimings()
+
+def finish_request(response):
+    """
+    Add the "Server-Timing" header to the current request's response (if SERVER_TIMING is enabled),
+    and record the request's measures (those of streamed responses once their body is sent).
+
+    Args:
+        response (flask.Response): The response.
+
+    Returns:
+        flask.Response: The response.
+    """
+    timings = _current()
+    if timings is None:
+        return response
+    table_name = (request.view_args or {}).get("table_name", "")
+    labels = (request.url_rule.rule if request.url_rule is not None else "unmatched",
+              table_name if table_name in db.metadata.tables or not table_name else "unknown")
+    status = str(response.status_code)
+    method = request.method
+
+    if cfg["SERVER_TIMING"]:
+        total = time.perf_counter() - timings.started_at
+        response.headers["Server-Timing"] = ", ".join(
+            [f"{name};dur={duration * 1000:.3f}" for name, duration in _phase_durations(timings, total)]
+            + [f"total;dur={total * 1000:.3f}"])
+
+    # Record streamed responses once their body is sent, the others right away
+    if response.is_streamed:
+        response.response = _counted_chunks(response.response, timings, labels + (method, status))
+    else:
+        _record(timings, labels + (method, status), len(response.get_data()))
+    return response
+
+def _record(timings, labels, response_bytes):
+    """
+    Add the measures of a finished request to the metrics.
+
+    Args:
+        timings (RequestTimings): The measures of the request.
+        labels (tuple): The endpoint, table, method and status of the request.
+        response_bytes (int): The number of bytes of the response body.
+
+    Returns:
+        None
+    """
+    total = time.perf_counter() - timings.started_at
+    with _metrics_lock:
+        _increment("api_requests_total", labels)
+        _observe("api_request_duration_seconds", labels[:2], total, SECONDS_BUCKETS)
+        for name, duration in _phase_durations(timings, total):
+            _observe("api_request_phase_seconds", labels[:2] + (name,), duration, SECONDS_BUCKETS)
+        _observe("api_response_rows", labels[:2], timings.rows, ROWS_BUCKETS)
+        _observe("api_response_bytes", labels[:2], response_bytes, BYTES_BUCKETS)
+
+def _phase_durations(timings, total):
+    """
+    List the durations of a request's phases, the time outside of the timed phases being "other".
+
+    Args:
+        timings (RequestTimings): The measures of the request.
+        total (float): The duration of the request so far.
+
+    Returns:
+        list: The (phase name, duration in seconds) of the phases, in the order of PHASES.
+    """
+    durations = dict(timings.phases, other=max(total - sum(timings.phases.values()), 0.0))
+    return [(name, durations[name]) for name in PHASES if name in durations]
+
+def _counted_chunks(chunks, timings, labels):
+    """
+    Count the bytes of a streamed response body as it is sent, and record the request's measures
+    once it is sent (or the client went away).
+
+    Args:
+        chunks (iterable): The chunks of the body (bytes or str).
+        timings (RequestTimings): The measures of the request.
+        labels (tuple): The endpoint, table, method and status of the request.
+
+    Yields:
+        The chunks, unchanged.
+    """
+    response_bytes = 0
+    try:
+        for chunk in chunks:
+            response_bytes += len(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+        _record(timings, labels, response_bytes)
+
+def _increment(name, labels):
+    """
+    Increment a counter (the caller holds the metrics lock).
+
+    Args:
+        name (str): The name of the metric.
+        labels (tuple): The label values.
+
+    Returns:
+        None
+    """
+    key = (name, labels)
+    _counters[key] = _counters.get(key, 0) + 1
+
+def _observe(name, labels, value, buckets):
+    """
+    Add an observation to a histogram (the caller holds the metrics lock).
+
+    Args:
+        name (str): The name of the metric.
+        labels (tuple): The label values.
+        value (float): The observed value.
+        buckets (list): The upper bounds of the histogram's buckets.
+
+    Returns:
+        None
+    """
+    histogram = _histograms.get((name, labels))
+    if histogram is None:
+        histogram = _histograms[(name, labels)] = {"buckets": buckets, "counts": [0] * len(buckets),
+                                                   "sum": 0.0, "count": 0}
+    for position, bound in enumerate(buckets):
+        if value <= bound:
+            histogram["counts"][position] += 1
+            break
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+# Descriptions and label names of the metrics
+METRICS = {
+    "api_requests_total": ("counter", "Requests answered.", ["endpoint", "table", "method", "status"]),
+    "api_request_duration_seconds": ("histogram", "Duration of the requests.", ["endpoint", "table"]),
+    "api_request_phase_seconds": ("histogram", "Time spent in each phase of the requests (exclusive).",
+                                  ["endpoint", "table", "phase"]),
+    "api_response_rows": ("histogram", "Records returned per request.", ["endpoint", "table"]),
+    "api_response_bytes": ("histogram", "Bytes of the response bodies (as sent).", ["endpoint", "table"]),
+}
+
+def _format_labels(names, values):
+    """
+    Format the labels of a sample in the Prometheus text format.
+
+    Args:
+        names (list): The label names.
+        values (tuple): The label values.
+
+    Returns:
+        str: The labels, between braces.
+    """
+    escaped = [str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in values]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+def render():
+    """
+    Render the metrics in the Prometheus text exposition format (version 0.0.4).
+
+    Returns:
+        str: The metrics.
+    """
+    lines = []
+    with _metrics_lock:
+        for name, (metric_type, description, label_names) in METRICS.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+            if metric_type == "counter":
+                for (metric_name, labels), value in sorted(_counters.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{_format_labels(label_names, labels)} {value}")
+                continue
+            for (metric_name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0]):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram["buckets"] + ["+Inf"], histogram["counts"] + [None]):
+                    cumulative = histogram["count"] if count is None else cumulative + count
+                    lines.append(f"{name}_bucket{_format_labels(label_names + ['le'], labels + (bound,))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(label_names, labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_format_labels(label_names, labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
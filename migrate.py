@@ -3,11 +3,24 @@
 DESCRIPTION:
 ------------
 This file contains the migration script, which initializes the database.
+In development, the tables are recreated and loaded with the CSV datasets of the "datasets" folder,
+or of the folder given with "--datasets" (e.g. a synthetic dataset made by synthetic_data.py).
 """
 
+import argparse
+import os
 from db_models import *  # Import your database models here
-import pandas as pd
 from config import cfg  # Import your configuration settings here
+from bulk_loader import load_datasets
+from authentication import hash_password
+from id_allocation import sync_id_sequences
+from rollup import rebuild as rebuild_rollup
+from result_cache import record_writes
+
+# Read the command line options
+parser = argparse.ArgumentParser(description="Initialize the database.")
+parser.add_argument("--datasets", default="datasets/", help="folder of the CSV datasets loaded in development")
+args, _ = parser.parse_known_args()
 
 # Create all tables in the database schema
 db.create_all()
@@ -18,19 +31,40 @@ if cfg["APP_ENVIRONMENT"] == "DEVELOPMENT":
     db.create_all()
 
     # Define the location of dataset CSV files and their filenames
-    datasets_folder_location = "datasets/"
+    datasets_folder_location = os.path.join(args.datasets, "")
     csv_filenames = ["provinces", "districts", "sectors",
                      "cells", "villages", "health_centers",
                      "patients", "blood_tests", "malaria_results", "users", "case_caches"]
 
-    # Loop through the CSV filenames and read and import them into respective tables
-    for i in csv_filenames:
-        df = pd.read_csv(datasets_folder_location + i + ".csv")
-        if i == "malaria_results":
-            df.to_sql(con=db.engine, name=i, if_exists='append', index=False)
-        else:
-            df.to_sql(con=db.engine, name=i[:-1], if_exists='append', index=False)
+    # Load the CSV files into their tables (independent tables in parallel, in the order of their foreign keys)
+    report = load_datasets(
+        {i if i == "malaria_results" else i[:-1]: datasets_folder_location + i + ".csv" for i in csv_filenames},
+        # Store the users' passwords as hashes
+        transforms={"user": lambda record: dict(record, password=hash_password(record["password"]))}
+    )
+    for table_name, table_report in report.items():
+        print(table_name, table_report)
 
 if cfg["APP_ENVIRONMENT"] == "PRODUCTION":
     # Create all tables if in production environment
     db.create_all()
+
+    # Add the token version column to the user table of older versions (create_all skips existing tables)
+    if "token_version" not in [column["name"] for column in db.inspect(db.engine).get_columns("user")]:
+        db.engine.execute(db.text(f"alter table {db.engine.dialect.identifier_preparer.quote('user')} "
+                                  f"add column token_version integer"))
+
+    # Create the indexes declared on tables that already existed (create_all skips them)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+# Move the id allocators past the ids already in the tables
+sync_id_sequences()
+
+# Rebuild the case rollup from the cases already in the database
+rebuild_rollup()
+
+# Move every table to a new version, so that no ETag issued before the migration matches
+record_writes([table.name for table in db.metadata.sorted_tables])
+db.session.commit()
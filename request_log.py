@@ -3,16 +3,42 @@
 DESCRIPTION:
 ------------
 This file contains the scripts that logs incomming requests.
+Handlers only build a compact record (a fixed whitelist of fields) and put it on a bounded queue;
+a background thread writes the records in batches to append-only JSONL segments, one record per line.
+A segment is written as "<name>.jsonl.part" and renamed to "<name>.jsonl" (sealed) once it reaches
+REQUEST_LOG_SEGMENT_MAX_BYTES bytes or REQUEST_LOG_SEGMENT_MAX_SECONDS seconds, and at shutdown,
+when every queued record is flushed first.
+When the queue is full, REQUEST_LOG_OVERFLOW_POLICY decides whether the record is dropped ("drop")
+or the handler waits up to REQUEST_LOG_BLOCK_TIMEOUT seconds for room ("block").
 """
 
+import atexit
 import datetime
 import json
+import os
+import queue
 import re
+import threading
+import time
 import config
+import metrics
 
 # Declaration of the path to where logs are stored
 REQUEST_LOGS_PATH = config.cfg["REQUEST_LOGS_PATH"]
 
+# Fields of the user details kept in the log records
+USER_FIELDS = ["id", "email", "role", "health_center_id"]
+
+# Queue of the records waiting to be written, and the writer thread draining it
+_records_queue = queue.Queue(maxsize=config.cfg["REQUEST_LOG_QUEUE_SIZE"])
+_writer_thread = None
+_writer_lock = threading.Lock()
+_stop_event = threading.Event()
+
+# Counters of the records written, dropped (queue full) and lost (write errors)
+_counters = {"written": 0, "dropped": 0, "errors": 0}
+_counters_lock = threading.Lock()
+
 def replace_non_numbers_with_underscore(input_string):
     """
     Replace non-digit characters in the input string with underscores.
@@ -31,9 +57,10 @@ def replace_non_numbers_with_underscore(input_string):
 
     return output_string
 
+@metrics.timed("log")
 def log(user_details_dict, request, columns_to_drop):
     """
-    Log user activity and request details into a JSON file.
+    Queue a log record of user activity and request details, to be written by the background writer.
 
     Args:
         user_details_dict (dict): Dictionary containing user details.
@@ -43,27 +70,166 @@ def log(user_details_dict, request, columns_to_drop):
     Returns:
         None
     """
-    # Remove unnecessary attribute from user_details_dict
-    user_details_dict.pop('_sa_instance_state')
+    # Copy the whitelisted fields while the request is still available
+    record = {
+        "timestamp": str(datetime.datetime.now()),
+        "user": {key: user_details_dict[key] for key in USER_FIELDS if key in user_details_dict},
+        "method": request.method,
+        "path": request.path,
+        "query_string": request.query_string.decode("latin-1"),
+        "endpoint": request.endpoint,
+        "table": (request.view_args or {}).get("table_name"),
+        "remote_addr": request.remote_addr,
+        "user_agent": request.headers.get("User-Agent"),
+        "content_length": request.content_length,
+        "columns_to_drop": columns_to_drop,
+    }
+
+    # Start the background writer on first use
+    _start_writer()
+
+    # Queue the record, applying the overflow policy if the queue is full
+    try:
+        if config.cfg["REQUEST_LOG_OVERFLOW_POLICY"] == "block":
+            _records_queue.put(record, timeout=config.cfg["REQUEST_LOG_BLOCK_TIMEOUT"])
+        else:
+            _records_queue.put_nowait(record)
+    except queue.Full:
+        with _counters_lock:
+            _counters["dropped"] += 1
+
+def stats():
+    """
+    Report the logger's counters.
+
+    Returns:
+        dict: The number of records queued, written, dropped because the queue was full,
+              and lost because of write errors.
+    """
+    with _counters_lock:
+        return {"queued": _records_queue.qsize(), **_counters}
+
+def _start_writer():
+    """
+    Start the background writer thread if it is not running yet.
+
+    Returns:
+        None
+    """
+    global _writer_thread
+    if _writer_thread is not None:
+        return
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_writer_loop, name="request-log-writer", daemon=True)
+            _writer_thread.start()
+            atexit.register(shutdown)
+
+def shutdown(timeout=10.0):
+    """
+    Flush every queued record, seal the current segment and stop the background writer.
+
+    Args:
+        timeout (float, optional): The maximum number of seconds to wait for the writer. Defaults to 10.0.
+
+    Returns:
+        None
+    """
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            return
+        _stop_event.set()
+        _writer_thread.join(timeout)
+        _writer_thread = None
+        _stop_event.clear()
 
-    # Convert request object attributes to a dictionary of strings
-    request_dictionary = vars(request).copy()
-    request_dictionary = {key: str(val) for key, val in request_dictionary.items()}
+def _open_segment():
+    """
+    Open a new segment, named after the current timestamp and the process id.
 
-    # Get the current timestamp
+    Returns:
+        dict: The segment's path, file, opening time and size in bytes.
+    """
+    os.makedirs(REQUEST_LOGS_PATH, exist_ok=True)
     timestamp = str(datetime.datetime.now())
+    path = f"{REQUEST_LOGS_PATH}{replace_non_numbers_with_underscore(timestamp)}_{os.getpid()}.jsonl"
+    return {"path": path,
+            "file": open(path + ".part", "a", encoding="utf-8"),
+            "opened_at": time.monotonic(),
+            "bytes": 0}
+
+def _seal_segment(segment):
+    """
+    Close a segment and rename it to its final name.
+
+    Args:
+        segment (dict): The segment to seal.
+
+    Returns:
+        None
+    """
+    segment["file"].close()
+    os.replace(segment["path"] + ".part", segment["path"])
+
+def _writer_loop():
+    """
+    Drain the records queue in batches into the current segment, rotating segments by size and age,
+    until shutdown is requested and the queue is empty.
+
+    Returns:
+        None
+    """
+    segment = None
+    while True:
+        # Wait for a record (or for the flush interval to elapse), then take the rest of the batch
+        batch = []
+        try:
+            batch.append(_records_queue.get(timeout=config.cfg["REQUEST_LOG_FLUSH_INTERVAL"]))
+            while len(batch) < config.cfg["REQUEST_LOG_BATCH_SIZE"]:
+                batch.append(_records_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        written = False
+        try:
+            # Append the batch to the current segment
+            if batch:
+                if segment is None:
+                    segment = _open_segment()
+                lines = "".join([json.dumps(record, separators=(",", ":"), default=str) + "\n"
+                                 for record in batch])
+                segment["file"].write(lines)
+                segment["file"].flush()
+                segment["bytes"] += len(lines.encode("utf-8"))
+                with _counters_lock:
+                    _counters["written"] += len(batch)
+                written = True
 
-    # Create a JSON structure with timestamp, user details, request, and columns to drop
-    json_log_data = json.dumps([
-        {"timestamp": timestamp},
-        {"user_details": user_details_dict},
-        {"request": request_dictionary},
-        {"columns_to_drop": columns_to_drop}
-    ], indent=8)
+            # Seal the segment when it is full, old enough, or at shutdown
+            if segment is not None and (
+                    segment["bytes"] >= config.cfg["REQUEST_LOG_SEGMENT_MAX_BYTES"]
+                    or time.monotonic() - segment["opened_at"] >= config.cfg["REQUEST_LOG_SEGMENT_MAX_SECONDS"]
+                    or (_stop_event.is_set() and _records_queue.empty())):
+                _seal_segment(segment)
+                segment = None
+        except OSError:
+            # Count the batch as lost once, unless it reached the segment before the error
+            if not written:
+                with _counters_lock:
+                    _counters["errors"] += len(batch)
 
-    # Specify the path for the JSON log file
-    json_file_path = f"{REQUEST_LOGS_PATH}{replace_non_numbers_with_underscore(timestamp)}{'.json'}"
+            # Close and seal what was written to the segment, so that the compaction picks it up
+            if segment is not None:
+                try:
+                    segment["file"].close()
+                except OSError:
+                    pass
+                try:
+                    os.replace(segment["path"] + ".part", segment["path"])
+                except OSError:
+                    pass
+            segment = None
 
-    # Write the JSON log data to the specified file
-    with open(json_file_path, "a+") as outfile:
-        outfile.write(json_log_data)
+        if _stop_event.is_set() and _records_queue.empty():
+            return
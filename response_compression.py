@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""The Response compression
+DESCRIPTION:
+------------
+This file contains the content-coding negotiation and the compressors of the read endpoints' responses.
+The coding is picked from the request's "Accept-Encoding" header among "zstd" (requires the optional zstandard
+package, pip install zstandard) and "gzip"; responses smaller than COMPRESSION_MIN_BYTES are sent as they are.
+Streamed responses are compressed incrementally, chunk by chunk as the body is produced: only the first
+COMPRESSION_MIN_BYTES are buffered to decide whether compressing is worth it.
+The compression levels are set by GZIP_LEVEL and ZSTD_LEVEL, and the counters of each coding (responses,
+bytes before and after compression, CPU time spent compressing) are reported by stats().
+"""
+
+import threading
+import time
+import zlib
+import columnar_export
+import metrics
+from config import cfg
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Media types worth compressing (Parquet files are compressed already)
+COMPRESSIBLE_MIMETYPES = ["application/json", "application/x-ndjson", columnar_export.ARROW_MIMETYPE]
+
+# Size below which responses are not compressed
+MIN_BYTES = cfg["COMPRESSION_MIN_BYTES"]
+
+# Counters of each content-coding, and of the responses left uncompressed because of their size
+_counters = {"gzip": {"responses": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0},
+             "zstd": {"responses": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0},
+             "below_min_bytes": 0}
+_counters_lock = threading.Lock()
+
+def available_encodings():
+    """
+    List the content-codings this server can produce, in order of preference.
+
+    Returns:
+        list: The names of the content-codings.
+    """
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+def negotiate(accept_encodings):
+    """
+    Pick the content-coding of a response from the request's "Accept-Encoding" header.
+
+    Args:
+        accept_encodings (werkzeug.datastructures.Accept): The parsed "Accept-Encoding" header.
+
+    Returns:
+        str: The name of the content-coding, or None if the response is to be sent uncompressed.
+    """
+    return accept_encodings.best_match(available_encodings())
+
+def _compressor(encoding):
+    """
+    Create an incremental compressor for a content-coding.
+
+    Args:
+        encoding (str): The name of the content-coding ("gzip" or "zstd").
+
+    Returns:
+        object: The compressor, with "compress(data)" and "flush()" methods returning bytes.
+    """
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=cfg["ZSTD_LEVEL"]).compressobj()
+    return zlib.compressobj(cfg["GZIP_LEVEL"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def _count(encoding, bytes_in, bytes_out, cpu_seconds, responses=0):
+    """
+    Add to the counters of a content-coding.
+
+    Args:
+        encoding (str): The name of the content-coding.
+        bytes_in (int): The number of bytes compressed.
+        bytes_out (int): The number of bytes produced.
+        cpu_seconds (float): The CPU time spent compressing.
+        responses (int, optional): The number of responses completed. Defaults to 0.
+
+    Returns:
+        None
+    """
+    with _counters_lock:
+        counters = _counters[encoding]
+        counters["responses"] += responses
+        counters["bytes_in"] += bytes_in
+        counters["bytes_out"] += bytes_out
+        counters["cpu_seconds"] += cpu_seconds
+
+def count_below_min_bytes():
+    """
+    Count a response left uncompressed because it is smaller than COMPRESSION_MIN_BYTES.
+
+    Returns:
+        None
+    """
+    with _counters_lock:
+        _counters["below_min_bytes"] += 1
+
+@metrics.timed("compress")
+def compress(body, encoding):
+    """
+    Compress a whole response body.
+
+    Args:
+        body (bytes): The response body.
+        encoding (str): The name of the content-coding.
+
+    Returns:
+        bytes: The compressed body.
+    """
+    started_at = time.thread_time()
+    compressor = _compressor(encoding)
+    compressed = compressor.compress(body) + compressor.flush()
+    _count(encoding, len(body), len(compressed), time.thread_time() - started_at, responses=1)
+    return compressed
+
+def compress_stream(chunks, encoding):
+    """
+    Decide whether a streamed response body is compressed, and compress it incrementally if so.
+    The first chunks are read until COMPRESSION_MIN_BYTES bytes were produced (or the body ended),
+    so this is to be called while the request context is still available.
+
+    Args:
+        chunks (iterable): The chunks of the body (bytes or str).
+        encoding (str): The name of the negotiated content-coding.
+
+    Returns:
+        tuple: The content-coding actually used (None if the body is too small to be compressed)
+               and the iterator of the chunks to send.
+    """
+    chunks = iter(chunks)
+    head = []
+    head_size = 0
+    for chunk in chunks:
+        chunk = chunk.encode() if isinstance(chunk, str) else chunk
+        head.append(chunk)
+        head_size += len(chunk)
+        if head_size >= MIN_BYTES:
+            return encoding, _compressed_chunks(head, chunks, encoding)
+
+    # The whole body was read and is smaller than the threshold
+    count_below_min_bytes()
+    return None, iter(head)
+
+def _compressed_chunks(head, chunks, encoding):
+    """
+    Compress the chunks of a streamed response body as they are produced.
+
+    Args:
+        head (list): The chunks read already (bytes).
+        chunks (iterator): The remaining chunks (bytes or str).
+        encoding (str): The name of the content-coding.
+
+    Yields:
+        bytes: The compressed chunks (only the non-empty outputs of the compressor).
+    """
+    compressor = _compressor(encoding)
+    try:
+        for chunks_part in [head, chunks]:
+            for chunk in chunks_part:
+                chunk = chunk.encode() if isinstance(chunk, str) else chunk
+                started_at = time.thread_time()
+                with metrics.phase("compress"):
+                    compressed = compressor.compress(chunk)
+                _count(encoding, len(chunk), len(compressed), time.thread_time() - started_at)
+                if compressed:
+                    yield compressed
+        started_at = time.thread_time()
+        with metrics.phase("compress"):
+            compressed = compressor.flush()
+        _count(encoding, 0, len(compressed), time.thread_time() - started_at, responses=1)
+        yield compressed
+    finally:
+        # Release the source of the chunks (database cursor, request context) even if the client went away
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+def stats():
+    """
+    Report the compression counters.
+
+    Returns:
+        dict: For each content-coding, the number of compressed responses, the bytes before and after compression,
+              the bytes saved and the CPU time spent compressing; and the number of responses left uncompressed
+              because of their size.
+    """
+    with _counters_lock:
+        report = {"below_min_bytes": _counters["below_min_bytes"]}
+        for encoding in ["gzip", "zstd"]:
+            report[encoding] = dict(_counters[encoding],
+                                    bytes_saved=_counters[encoding]["bytes_in"] - _counters[encoding]["bytes_out"])
+        return report
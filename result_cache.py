@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""The Query result cache
+DESCRIPTION:
+------------
+This file contains the per-table write versions and the cache of the serialized responses of the read endpoints.
+Every table has a write version, stored in the "table_version" table and incremented by the controllers inside
+the transaction of each write to it (so a version and the data it stands for are committed together).
+Workers keep a snapshot of the versions, read again from the database once it is TABLE_VERSION_TTL seconds old
+(or right after their own writes).
+A read response is identified by a tag hashing the versions of the tables it reads, the role projection and the
+request's filter parameters: the tag is sent as the response's strong ETag (answering conditional requests
+without running the query) and keys the cache of the responses' final bytes, so a hit skips the query, the
+DataFrame conversion and the serialization. A write gives its tables new tags, making their previous entries
+unreachable (they are then evicted by the LRU policy) without scanning the cache.
+The cache is bounded by the total size of its entries (RESULT_CACHE_MAX_BYTES).
+"""
+
+import hashlib
+import random
+import threading
+import time
+import cache
+import db_helpers
+import db_models
+from config import cfg
+from db_models import db
+
+# Serialized responses, indexed by their tag
+response_cache = cache.LRUCache(max_size=cfg["RESULT_CACHE_MAX_BYTES"])
+
+# Number of seconds a snapshot of the versions is used before being read again
+VERSION_TTL = cfg["TABLE_VERSION_TTL"]
+
+# Snapshot of the write version of each table (tables never written to are at version 0)
+_versions = {}
+_versions_read_at = None
+_versions_lock = threading.Lock()
+
+def table_version(table_name):
+    """
+    Get the write version of a table, from the snapshot of the versions (read again if it expired).
+
+    Args:
+        table_name (str): The name of the table.
+
+    Returns:
+        int: The version.
+    """
+    global _versions, _versions_read_at
+    with _versions_lock:
+        if _versions_read_at is None or time.monotonic() - _versions_read_at >= VERSION_TTL:
+            _versions = {i[0]: i[1] for i in db_helpers.table_versions()}
+            _versions_read_at = time.monotonic()
+        return _versions.get(table_name, 0)
+
+def record_writes(table_names):
+    """
+    Increment the write versions of tables in the current database session's transaction
+    (committed by the caller along with the writes themselves).
+    A table's first version is drawn at random, so the tags issued before the database was recreated never match.
+
+    Args:
+        table_names (list): The names of the written tables.
+
+    Returns:
+        None
+    """
+    rows = [{"table_name": table_name, "version": random.getrandbits(48)}
+            for table_name in sorted(set(table_names))]
+    if rows:
+        db.session.execute(_upsert_statement(), rows)
+
+def forget_versions():
+    """
+    Forget the snapshot of the versions (called after this worker committed writes), it is read again on next use.
+
+    Returns:
+        None
+    """
+    global _versions_read_at
+    with _versions_lock:
+        _versions_read_at = None
+
+def _upsert_statement():
+    """
+    Build the statement inserting a table's version, or incrementing the existing one, for the current dialect.
+
+    Returns:
+        sqlalchemy.sql.expression.Insert: The upsert statement.
+    """
+    table = db_models.Table_version.__table__
+    dialect = db.engine.dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        return insert(table).on_duplicate_key_update(version=table.c.version + 1)
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table).on_conflict_do_update(index_elements=["table_name"],
+                                               set_={"version": table.c.version + 1})
+
+def response_tag(table_names, columns_to_drop, params):
+    """
+    Compute the tag of a read response (its ETag and cache key).
+
+    Args:
+        table_names (list): The names of the tables the response is read from.
+        columns_to_drop (list): The columns removed from the response for the user's role.
+        params (dict): The parameters (filters, options, format) the response depends on.
+
+    Returns:
+        str: The tag, changing whenever one of the tables is written to.
+    """
+    versions = [(table_name, table_version(table_name)) for table_name in table_names]
+    description = repr((versions, sorted(columns_to_drop), sorted((key, repr(value)) for key, value in params.items())))
+    return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+def get(tag):
+    """
+    Retrieve a cached response.
+
+    Args:
+        tag (str): The tag of the response.
+
+    Returns:
+        bytes: The serialized response, or None if it is not cached.
+    """
+    return response_cache.get(tag)
+
+def put(tag, body):
+    """
+    Cache a serialized response (responses larger than the cache are not kept).
+
+    Args:
+        tag (str): The tag of the response.
+        body (bytes): The serialized response.
+
+    Returns:
+        None
+    """
+    response_cache.set(tag, body, size=len(body))
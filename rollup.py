@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""The case rollup
+DESCRIPTION:
+------------
+This file contains the maintenance of the "case_rollup" table, a pre-aggregated cube of the "case_cache" table:
+one row per (village, day, malaria_status, parasite_type, gender), holding its number of cases and the
+ids of the village's cell, sector, district and province.
+The rollup is updated incrementally by the controllers, with one batched upsert inside the transaction
+writing the cases ("record_cases"), and can be rebuilt from scratch from "case_cache" ("rebuild").
+The aggregation endpoint answers "case_cache" requests from it whenever it can, touching only the pre-aggregated rows.
+Missing values are stored as "" (strings) and 0 (village_id) since they are part of the primary key;
+cases without a date are kept under a day no date range reaches (aggregation.ROLLUP_UNDATED_DAY),
+so that the rollup's totals are those of "case_cache".
+
+USAGE:
+------
+python rollup.py rebuild
+"""
+
+import argparse
+import datetime
+import aggregation
+import db_models
+import db_helpers
+from db_models import db
+
+# Columns identifying a row of the rollup
+KEY_COLUMNS = ["village_id", "day", "malaria_status", "parasite_type", "gender"]
+
+def _day(value):
+    """
+    Get the day of a case's date.
+
+    Args:
+        value (datetime.datetime or str): The date of the case.
+
+    Returns:
+        datetime.date: The day, or the rollup's undated day if the case has no date.
+    """
+    if value is None:
+        return aggregation.ROLLUP_UNDATED_DAY
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+def record_cases(added=[], removed=[]):
+    """
+    Add cases to the rollup and remove others from it, with one batched upsert in the current
+    database session's transaction (committed by the caller along with the cases themselves).
+
+    Args:
+        added (list, optional): The cases written to "case_cache", as dictionaries of its columns. Defaults to [].
+        removed (list, optional): The cases removed from "case_cache" (or their values before an update). Defaults to [].
+
+    Returns:
+        None
+    """
+    # Sum the changes of the counts, per rollup row
+    deltas = {}
+    for cases, sign in [(added, 1), (removed, -1)]:
+        for case in cases:
+            key = (case.get("village_id") or 0, _day(case.get("date")), case.get("malaria_status") or "",
+                   case.get("parasite_type") or "", case.get("gender") or "")
+            deltas[key] = deltas.get(key, 0) + sign
+    deltas = {key: delta for key, delta in deltas.items() if delta != 0}
+    if not deltas:
+        return
+
+    # Look the villages' ancestors up, in one query
+    ancestors = {i[0]: i for i in db_helpers.village_ancestors({key[0] for key in deltas} - {0})}
+
+    rows = []
+    for key, delta in deltas.items():
+        row = dict(zip(KEY_COLUMNS, key))
+        village = ancestors.get(key[0])
+        row.update({"cell_id": village[1] if village else None,
+                    "sector_id": village[2] if village else None,
+                    "district_id": village[3] if village else None,
+                    "province_id": village[4] if village else None,
+                    "count": delta})
+        rows.append(row)
+
+    db.session.execute(_upsert_statement(), rows)
+
+def _upsert_statement():
+    """
+    Build the statement inserting a rollup row, or adding its count to the existing row, for the current dialect.
+
+    Returns:
+        sqlalchemy.sql.expression.Insert: The upsert statement.
+    """
+    table = db_models.Case_rollup.__table__
+    dialect = db.engine.dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table)
+        return statement.on_duplicate_key_update(count=table.c.count + statement.inserted["count"])
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    statement = insert(table)
+    return statement.on_conflict_do_update(index_elements=KEY_COLUMNS,
+                                           set_={"count": table.c.count + statement.excluded["count"]})
+
+def rebuild():
+    """
+    Rebuild the rollup from scratch from the "case_cache" table, in one transaction.
+
+    Returns:
+        int: The number of rows of the rebuilt rollup.
+    """
+    day_sql_str = "cast(case_cache.date as date)" if db.engine.dialect.name == "postgresql" \
+        else "date(case_cache.date)"
+    with db.engine.begin() as connection:
+        connection.execute("delete from case_rollup")
+        connection.execute(db.text(
+            f"""
+            insert into case_rollup (village_id, day, malaria_status, parasite_type, gender,
+                                     cell_id, sector_id, district_id, province_id, count)
+            select coalesce(case_cache.village_id, 0), coalesce({day_sql_str}, :undated_day),
+                   coalesce(case_cache.malaria_status, ''), coalesce(case_cache.parasite_type, ''),
+                   coalesce(case_cache.gender, ''),
+                   village.cell_id, cell.sector_id, sector.district_id, district.province_id, count(*)
+            from case_cache
+            left join village on village.id = case_cache.village_id
+            left join cell on cell.id = village.cell_id
+            left join sector on sector.id = cell.sector_id
+            left join district on district.id = sector.district_id
+            group by 1, 2, 3, 4, 5, 6, 7, 8, 9
+            """),
+            undated_day=aggregation.ROLLUP_UNDATED_DAY
+        )
+        return connection.execute("select count(*) from case_rollup").scalar()
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the case rollup.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild", help="rebuild the rollup from the case_cache table")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        print(f"{rebuild()} rollup rows")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""The Sampling sessions
+DESCRIPTION:
+------------
+This file contains the server-side sampling sessions used by the sampling endpoint.
+A uniform session pins the id range of the table it was opened against and walks a seeded,
+lazily generated permutation of that range, so serving a batch costs O(batch_size)
+instead of materializing every id that has not been served yet.
+A stratified or reservoir session pins the ids of a sample drawn by the database when it is opened
+(the first records of each stratum ranked by a seeded hash of their id, see controllers.draw_sample);
+its batches are then read from the sample, whose strata are interleaved so that every batch
+keeps their proportions.
+Sessions live in the memory of the worker that opened them and are evicted once
+they have not been used for SAMPLING_SESSION_TTL seconds.
+"""
+
+import math
+import random
+import secrets
+import threading
+import time
+import config
+
+# Number of seconds an unused sampling session is kept in memory
+SESSION_TTL = config.cfg["SAMPLING_SESSION_TTL"]
+
+# Open sampling sessions, indexed by their session id
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _round_function(value, key):
+    """
+    Mix an integer with a round key (splitmix64 finalizer).
+
+    Args:
+        value (int): The value to mix.
+        key (int): The 64 bits round key.
+
+    Returns:
+        int: The mixed 64 bits value.
+    """
+    value = ((value ^ key) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+def permuted_index(position, domain_size, round_keys):
+    """
+    Map a position to its image in a seeded permutation of range(domain_size).
+
+    A balanced Feistel network gives a bijection over the smallest even power of two
+    covering the domain; images falling outside the domain are walked again until they
+    land inside it (cycle walking), which keeps the mapping a permutation of the domain.
+
+    Args:
+        position (int): The position in the permutation, between 0 and domain_size - 1.
+        domain_size (int): The number of elements being permuted.
+        round_keys (list): The Feistel round keys derived from the session seed.
+
+    Returns:
+        int: The element found at the given position of the permutation.
+    """
+    half_bits = max(1, ((domain_size - 1).bit_length() + 1) // 2)
+    half_mask = (1 << half_bits) - 1
+    value = position
+    while True:
+        left, right = value >> half_bits, value & half_mask
+        for key in round_keys:
+            left, right = right, left ^ (_round_function(right, key) & half_mask)
+        value = (left << half_bits) | right
+        if value < domain_size:
+            return value
+
+def proportional_quotas(populations, sample_size):
+    """
+    Share a sample size between strata in proportion to their populations (largest remainder method).
+
+    Args:
+        populations (dict): The number of records of each stratum, indexed by stratum.
+        sample_size (int): The total size of the sample (capped at the total population).
+
+    Returns:
+        dict: The number of records to draw from each stratum, indexed by stratum.
+    """
+    total = sum(populations.values())
+    sample_size = min(sample_size, total)
+    if total == 0:
+        return {stratum: 0 for stratum in populations}
+    shares = {stratum: sample_size * population / total for stratum, population in populations.items()}
+    quotas = {stratum: math.floor(share) for stratum, share in shares.items()}
+    remainders = sorted(populations, key=lambda stratum: (quotas[stratum] - shares[stratum], str(stratum)))
+    for stratum in remainders[:sample_size - sum(quotas.values())]:
+        quotas[stratum] += 1
+    return quotas
+
+def interleave(samples, generator):
+    """
+    Shuffle the samples of every stratum and merge them into one sequence in which the strata are evenly spread,
+    so that any prefix of the sequence keeps (up to one record per stratum) the proportions of the whole sample.
+
+    Args:
+        samples (dict): The sampled ids of each stratum, indexed by stratum.
+        generator (random.Random): The seeded random generator shuffling the samples.
+
+    Returns:
+        list: The interleaved ids.
+    """
+    keyed_ids = []
+    for rank, (stratum, ids) in enumerate(sorted(samples.items(), key=lambda item: str(item[0]))):
+        ids = list(ids)
+        generator.shuffle(ids)
+        keyed_ids += [((position + 0.5) / len(ids), rank, i) for position, i in enumerate(ids)]
+    return [i for _, _, i in sorted(keyed_ids)]
+
+def _evict_expired_sessions(now):
+    """
+    Remove every session whose TTL has elapsed. The caller must hold the sessions lock.
+
+    Args:
+        now (float): The current monotonic time.
+
+    Returns:
+        None
+    """
+    expired_session_ids = [session_id for session_id, session in _sessions.items()
+                           if session["expires_at"] <= now]
+    for session_id in expired_session_ids:
+        del _sessions[session_id]
+
+def draw_seed(seed=None):
+    """
+    Draw the seed of a new session, unless one was provided.
+
+    Args:
+        seed (int, optional): The seed requested by the client. Defaults to None.
+
+    Returns:
+        int: The seed.
+    """
+    return secrets.randbits(63) if seed is None else seed
+
+def draw_round_keys(seed):
+    """
+    Derive the Feistel round keys of a permutation from its seed.
+
+    Args:
+        seed (int): The seed of the permutation.
+
+    Returns:
+        list: The round keys.
+    """
+    seeded_generator = random.Random(seed)
+    return [seeded_generator.getrandbits(64) for _ in range(4)]
+
+def open_session(table_name, user_id, last_id, table_size, seed=None, sample_ids=None, strata=None):
+    """
+    Open a sampling session pinned to the current id range of a table, or to a sample drawn from it.
+
+    Args:
+        table_name (str): The name of the sampled table.
+        user_id (int): The id of the user opening the session.
+        last_id (int): The last (maximum) id of the table when the session is opened.
+        table_size (int): The number of records in the table when the session is opened.
+        seed (int, optional): The seed of the permutation. A random seed is drawn if None.
+        sample_ids (list, optional): The ids of a drawn sample, served in this order instead of
+                                     a permutation of the id range. Defaults to None.
+        strata (list, optional): The description of the sample's strata, returned with every batch. Defaults to None.
+
+    Returns:
+        dict: The opened session.
+    """
+    seed = draw_seed(seed)
+    now = time.monotonic()
+    session = {"session_id": secrets.token_urlsafe(16),
+               "table_name": table_name,
+               "user_id": user_id,
+               "seed": seed,
+               "round_keys": draw_round_keys(seed),
+               "last_id": last_id,
+               "table_size": table_size,
+               "sample_ids": sample_ids,
+               "strata": strata,
+               "expires_at": now + SESSION_TTL}
+    with _sessions_lock:
+        _evict_expired_sessions(now)
+        _sessions[session["session_id"]] = session
+    return session
+
+def get_session(session_id, table_name, user_id):
+    """
+    Retrieve an open session and extend its TTL.
+
+    Args:
+        session_id (str): The id of the session.
+        table_name (str): The name of the table the session must belong to.
+        user_id (int): The id of the user the session must belong to.
+
+    Returns:
+        dict: The session, or None if it does not exist, expired or belongs to another table or user.
+    """
+    now = time.monotonic()
+    with _sessions_lock:
+        _evict_expired_sessions(now)
+        session = _sessions.get(session_id)
+        if session is None or session["table_name"] != table_name or session["user_id"] != user_id:
+            return None
+        session["expires_at"] = now + SESSION_TTL
+        return session
+
+def session_size(session):
+    """
+    Count the positions of a session: the size of its sample, or of its id range.
+
+    Args:
+        session (dict): The sampling session.
+
+    Returns:
+        int: The number of positions.
+    """
+    if session["sample_ids"] is not None:
+        return len(session["sample_ids"])
+    return session["last_id"] + 1
+
+def encode_cursor(session, position):
+    """
+    Build the opaque cursor handed to the client.
+
+    Args:
+        session (dict): The sampling session.
+        position (int): The next position to read from the session's permutation.
+
+    Returns:
+        str: The cursor, or None if the permutation has been fully consumed.
+    """
+    if position >= session_size(session):
+        return None
+    return f"{session['session_id']}.{position}"
+
+def decode_cursor(cursor):
+    """
+    Split a cursor into its session id and position.
+
+    Args:
+        cursor (str): The cursor sent by the client.
+
+    Returns:
+        tuple: The session id and the position, or (None, None) if the cursor is malformed.
+    """
+    try:
+        session_id, position = str(cursor).rsplit(".", 1)
+        position = int(position)
+    except ValueError:
+        return None, None
+    if position < 0:
+        return None, None
+    return session_id, position
+
+def candidate_ids(session, position, count):
+    """
+    Read the next ids of a session's permutation (or sample).
+
+    Args:
+        session (dict): The sampling session.
+        position (int): The position to start reading from.
+        count (int): The maximum number of ids to read.
+
+    Returns:
+        list: The ids found between position and position + count in the permutation (or sample).
+    """
+    if session["sample_ids"] is not None:
+        return session["sample_ids"][position:position + count]
+    domain_size = session["last_id"] + 1
+    return [permuted_index(i, domain_size, session["round_keys"])
+            for i in range(position, min(position + count, domain_size))]
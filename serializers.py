@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""The JSON serializers
+DESCRIPTION:
+------------
+This file contains the serializer encoding the records read from the database straight into the JSON bytes
+of the read endpoints, without building a DataFrame or going through jsonify's generic encoder.
+Outside of debug mode, the output is byte-compatible with the former
+"jsonify(pd.DataFrame(rows).drop(...).to_dict('index'))" path (compact separators, sorted keys, ASCII escapes,
+HTTP dates; jsonify indents its output when app.debug or JSONIFY_PRETTYPRINT_REGULAR is set, this serializer
+never does), including the way pandas stores the columns:
+    - an integer column holding NULLs becomes a float column (values "3.0", NULLs "NaN"),
+    - a column made only of NULLs stays null.
+Each table gets a precomputed plan per projection (the kept columns in key order, their encoded keys and value
+encoders, derived from the column types of the models in db_models.py), so encoding a record is a single pass
+over its values; unlike the former path, NULL dates are encoded as null instead of failing.
+"""
+
+import datetime
+import json
+from json.encoder import encode_basestring_ascii
+import db_models
+import metrics
+
+# Encoding plans, indexed by (table name, columns of the rows, dropped columns, extra columns)
+_plans = {}
+
+# Names of the days and months of the HTTP dates
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+def encode_string(value):
+    """
+    Encode a string value (or any value through its JSON representation).
+
+    Args:
+        value: The value.
+
+    Returns:
+        str: The JSON representation of the value.
+    """
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    if value is None:
+        return "null"
+    return json.dumps(value)
+
+def encode_integer(value):
+    """
+    Encode an integer value.
+
+    Args:
+        value (int): The value.
+
+    Returns:
+        str: The JSON representation of the value.
+    """
+    return "null" if value is None else int.__repr__(value)
+
+def encode_integer_as_float(value):
+    """
+    Encode a value of an integer column holding NULLs, the way pandas stores it (as a float, NULLs as NaN).
+
+    Args:
+        value (int): The value.
+
+    Returns:
+        str: The JSON representation of the value.
+    """
+    return "NaN" if value is None else float.__repr__(float(value))
+
+def encode_datetime(value):
+    """
+    Encode a datetime value as an HTTP date (strings, returned by some drivers, are kept as-is).
+
+    Args:
+        value (datetime.datetime or str): The value.
+
+    Returns:
+        str: The JSON representation of the value.
+    """
+    if isinstance(value, datetime.datetime):
+        # Same output as werkzeug's http_date (naive datetimes are taken as UTC), without its generic path
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        return (f'"{WEEKDAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} {value.year:04d} '
+                f'{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT"')
+    if isinstance(value, datetime.date):
+        return encode_datetime(datetime.datetime.combine(value, datetime.time()))
+    return encode_string(value)
+
+def column_encoders(table_name):
+    """
+    Choose the encoder of each column of a table from its type.
+
+    Args:
+        table_name (str): The name of the table.
+
+    Returns:
+        dict: The encoder of each column, indexed by column name.
+    """
+    encoders = {}
+    for column in db_models.db.metadata.tables[table_name].columns:
+        if isinstance(column.type, db_models.db.Integer):
+            encoders[column.name] = encode_integer
+        elif isinstance(column.type, (db_models.db.DateTime, db_models.db.Date)):
+            encoders[column.name] = encode_datetime
+        else:
+            encoders[column.name] = encode_string
+    return encoders
+
+def _plan(table_name, row_columns, columns_to_drop, extra_columns):
+    """
+    Build (or reuse) the encoding plan of the records of a table.
+
+    Args:
+        table_name (str): The name of the table.
+        row_columns (tuple): The columns of the rows, in order.
+        columns_to_drop (tuple): The columns to leave out.
+        extra_columns (tuple): The names of the columns added to the rows.
+
+    Returns:
+        list: The (key, position, encoder) of the kept columns, in key order
+              (positions past the row's columns refer to the extra columns).
+    """
+    plan_key = (table_name, row_columns, columns_to_drop, extra_columns)
+    plan = _plans.get(plan_key)
+    if plan is None:
+        encoders = column_encoders(table_name)
+        positions = {column: position for position, column in enumerate(row_columns + extra_columns)}
+        plan = [(encode_basestring_ascii(column) + ":", positions[column], encoders.get(column, encode_string))
+                for column in sorted(positions) if column not in columns_to_drop]
+        _plans[plan_key] = plan
+    return plan
+
+@metrics.timed("serialize")
+def encode_records(rows, table_name, columns_to_drop=[], extra_columns=None):
+    """
+    Encode records as the JSON object of the read endpoints ({"0": record, "1": record, ...}).
+
+    Args:
+        rows (list): The records, as rows of the database driver.
+        table_name (str): The name of the table the records are read from.
+        columns_to_drop (list, optional): The columns to leave out (the role projection). Defaults to [].
+        extra_columns (dict, optional): The values of columns added to the records (lists, one value per record),
+                                        indexed by column name. Defaults to None.
+
+    Returns:
+        str: The JSON object.
+    """
+    metrics.count_rows(len(rows))
+    if not rows:
+        return "{}"
+    extra_columns = extra_columns or {}
+    row_columns = tuple(rows[0].keys())
+    plan = _plan(table_name, row_columns, tuple(sorted(columns_to_drop)), tuple(extra_columns))
+
+    # Read the values column by column, and pick the encoder matching the NULLs of each column
+    columns = list(zip(*rows)) + [list(values) for values in extra_columns.values()]
+    encoded_columns = []
+    for key, position, encoder in plan:
+        values = columns[position]
+        has_null = None in values
+        if has_null and all(value is None for value in values):
+            encoded_columns.append([key + "null"] * len(values))
+            continue
+        if encoder is encode_integer and has_null:
+            encoder = encode_integer_as_float
+        elif encoder is encode_string and not has_null and all(type(value) is str for value in values):
+            encoder = encode_basestring_ascii
+        encoded_columns.append([key + encoder(value) for value in values])
+
+    # Assemble the records, indexed by their position
+    records = zip(*encoded_columns) if encoded_columns else [[]] * len(rows)
+    return "{" + ",".join(f'"{index}":{{' + ",".join(record) + "}" for index, record in enumerate(records)) + "}"
+
+def encode_value(value):
+    """
+    Encode a single value the way jsonify does (compact, sorted keys, ASCII escapes).
+
+    Args:
+        value: The value.
+
+    Returns:
+        str: The JSON representation of the value.
+    """
+    return json.dumps(value, separators=(",", ":"), sort_keys=True)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""The Synthetic dataset generator
+DESCRIPTION:
+------------
+This file contains the generator of synthetic datasets for scale testing: CSV files laid out like the ones of
+the datasets folder (one per table, columns of the models in db_models.py), loaded with "python migrate.py
+--datasets <folder>" (or straight away with the "--load" option).
+    - the administrative hierarchy (province to village) and the users are copied from the datasets folder,
+      so the generated records lie in real villages and the test accounts keep working,
+    - health centers are generated, each village being served by one of them,
+    - patients live in villages drawn with skewed (log-normal) populations, are a bit more often female, and
+      mostly young (exponential ages); each patient's fields are a function of the seed and its id only
+      (counter-based hashing), so the patients of the cases are known without keeping the patients in memory,
+    - blood tests are dated in order between the start and end dates, each taken by a random patient,
+    - each blood test has its malaria result (positive with the rate of the patient's village, mostly
+      P. falciparum) and its case in "case_cache", holding the same values as the patient, test and result.
+Everything is vectorized with NumPy and written in chunks of --chunk-size rows, so memory stays bounded
+whatever the number of rows; a given seed (and chunk size) always produces the same files.
+
+USAGE:
+------
+python synthetic_data.py --out datasets/synthetic --patients 1000000 --blood-tests 10000000 --seed 0 --load
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+from db_models import db
+
+# Folder of the shipped datasets (administrative hierarchy and users)
+DATASETS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "datasets")
+
+# Files copied from the shipped datasets
+COPIED_FILES = ["provinces", "districts", "sectors", "cells", "villages", "users"]
+
+# Parasite types of the positive results, and their frequencies
+PARASITE_TYPES = ["pf", "pm", "po", "pv"]
+PARASITE_FREQUENCIES = [0.9, 0.05, 0.03, 0.02]
+
+# Characters of the generated names and image URLs
+LETTERS = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", dtype=np.uint8)
+URL_CHARACTERS = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789", dtype=np.uint8)
+
+# Fields of the patients, drawn from their own hash streams
+PATIENT_FIELDS = {"name": 1, "date_of_birth": 2, "gender": 3, "village": 4}
+
+# Mean and maximum age of the patients (in years)
+MEAN_AGE = 25
+MAX_AGE = 90
+
+def _mix(values):
+    """
+    Hash 64-bit integers (the "splitmix64" finalizer), element-wise.
+
+    Args:
+        values (numpy.ndarray): The integers (uint64).
+
+    Returns:
+        numpy.ndarray: Their hashes (uint64).
+    """
+    with np.errstate(over="ignore"):
+        values = values + np.uint64(0x9E3779B97F4A7C15)
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+def _hashes(ids, seed, field):
+    """
+    Draw 64-bit hashes of ids, for one field of the records and a seed.
+
+    Args:
+        ids (numpy.ndarray): The ids of the records.
+        seed (int): The seed of the dataset.
+        field (int): The number of the field.
+
+    Returns:
+        numpy.ndarray: One hash per id (uint64).
+    """
+    key = _mix(np.array([seed * 64 + field], dtype=np.uint64))[0]
+    return _mix(ids.astype(np.uint64) ^ key)
+
+def _uniforms(ids, seed, field):
+    """
+    Draw uniform numbers in [0, 1) from the hashes of ids.
+
+    Args:
+        ids (numpy.ndarray): The ids of the records.
+        seed (int): The seed of the dataset.
+        field (int): The number of the field.
+
+    Returns:
+        numpy.ndarray: One number per id.
+    """
+    return (_hashes(ids, seed, field) >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+def _letters(hashes, length):
+    """
+    Turn hashes into strings of capital letters (the base-26 digits of the hashes).
+
+    Args:
+        hashes (numpy.ndarray): The hashes (uint64).
+        length (int): The number of letters (at most 13).
+
+    Returns:
+        numpy.ndarray: The strings.
+    """
+    digits = (hashes[:, None] // (np.uint64(26) ** np.arange(length, dtype=np.uint64))) % np.uint64(26)
+    return LETTERS[digits].view(f"S{length}").ravel().astype(str)
+
+def _random_strings(generator, count, length):
+    """
+    Draw random alphanumeric strings.
+
+    Args:
+        generator (numpy.random.Generator): The random generator.
+        count (int): The number of strings.
+        length (int): The length of the strings.
+
+    Returns:
+        numpy.ndarray: The strings.
+    """
+    return URL_CHARACTERS[generator.integers(len(URL_CHARACTERS), size=(count, length))] \
+        .view(f"S{length}").ravel().astype(str)
+
+class Population:
+    """
+    The villages, health centers and patients of a synthetic dataset.
+
+    Args:
+        seed (int): The seed of the dataset.
+        health_centers (int): The number of health centers.
+        start (numpy.datetime64): The date before which the patients are born.
+    """
+
+    def __init__(self, seed, health_centers, start):
+        generator = np.random.default_rng([seed, 0])
+        self.seed = seed
+        self.start = start
+        self.village_ids = pd.read_csv(os.path.join(DATASETS_PATH, "villages.csv"), usecols=["id"])["id"].to_numpy()
+
+        # Skewed village populations, the health center serving each village and its malaria positivity rate
+        populations = generator.lognormal(sigma=1.0, size=len(self.village_ids))
+        self.village_cdf = np.cumsum(populations) / populations.sum()
+        self.village_health_centers = generator.integers(health_centers, size=len(self.village_ids))
+        self.village_positivity = generator.beta(2, 5, size=len(self.village_ids))
+
+    def patient_columns(self, ids):
+        """
+        Compute the fields of patients from their ids.
+
+        Args:
+            ids (numpy.ndarray): The ids of the patients.
+
+        Returns:
+            dict: The fields of the patients (arrays indexed like ids), and the position of their
+                  village in village_ids ("village_index").
+        """
+        village_index = np.minimum(np.searchsorted(self.village_cdf, _uniforms(ids, self.seed, PATIENT_FIELDS["village"])),
+                                   len(self.village_ids) - 1)
+        ages = np.minimum(-MEAN_AGE * np.log1p(-_uniforms(ids, self.seed, PATIENT_FIELDS["date_of_birth"])), MAX_AGE)
+        return {"id": ids,
+                "name": _letters(_hashes(ids, self.seed, PATIENT_FIELDS["name"]), 10),
+                "date_of_birth": self.start - (ages * 365.25 * 86400).astype("timedelta64[s]"),
+                "gender": np.where(_uniforms(ids, self.seed, PATIENT_FIELDS["gender"]) < 0.51, "female", "male"),
+                "village_id": self.village_ids[village_index],
+                "health_center_id": self.village_health_centers[village_index],
+                "village_index": village_index}
+
+def _write(frame, path, first_chunk):
+    """
+    Append a chunk of records to a CSV file, with the columns of its table's model.
+
+    Args:
+        frame (pandas.DataFrame): The records.
+        path (str): The path of the CSV file.
+        first_chunk (bool): Whether the file is to be (re)created, with its header line.
+
+    Returns:
+        None
+    """
+    frame.to_csv(path, mode="w" if first_chunk else "a", header=first_chunk, index=False,
+                 date_format="%Y-%m-%d %H:%M:%S")
+
+def _table_columns(table_name):
+    """
+    List the columns of a table's model, in order.
+
+    Args:
+        table_name (str): The name of the table.
+
+    Returns:
+        list: The names of the columns.
+    """
+    return [column.name for column in db.metadata.tables[table_name].columns]
+
+def generate(out, patients=10000, blood_tests=12000, health_centers=1000, seed=0, chunk_size=100000,
+             start="2018-01-01", end="2024-01-01"):
+    """
+    Generate a synthetic dataset.
+
+    Args:
+        out (str): The folder the CSV files are written to.
+        patients (int, optional): The number of patients. Defaults to 10000.
+        blood_tests (int, optional): The number of blood tests (and of malaria results and cases). Defaults to 12000.
+        health_centers (int, optional): The number of health centers. Defaults to 1000.
+        seed (int, optional): The seed of the dataset. Defaults to 0.
+        chunk_size (int, optional): The number of records generated and written at once. Defaults to 100000.
+        start (str, optional): The date of the first blood tests. Defaults to "2018-01-01".
+        end (str, optional): The date after the last blood tests. Defaults to "2024-01-01".
+
+    Returns:
+        dict: The number of records written per table.
+
+    Raises:
+        ValueError: If a count is not positive, the dates are not ordered, or the users refer to health centers
+                    that are not generated.
+    """
+    if min(patients, blood_tests, health_centers, chunk_size) <= 0:
+        raise ValueError("the numbers of records and the chunk size must be positive")
+    start, end = np.datetime64(start, "s"), np.datetime64(end, "s")
+    if end <= start:
+        raise ValueError("the end date must follow the start date")
+    users = pd.read_csv(os.path.join(DATASETS_PATH, "users.csv"))
+    if users["health_center_id"].max() >= health_centers:
+        raise ValueError(f"the users refer to health centers up to {int(users['health_center_id'].max())}")
+    os.makedirs(out, exist_ok=True)
+
+    # Copy the administrative hierarchy and the users
+    for file_name in COPIED_FILES:
+        shutil.copyfile(os.path.join(DATASETS_PATH, file_name + ".csv"), os.path.join(out, file_name + ".csv"))
+    population = Population(seed, health_centers, start)
+
+    # Generate the health centers
+    generator = np.random.default_rng([seed, 1])
+    _write(pd.DataFrame({"id": np.arange(health_centers),
+                         "name": _random_strings(generator, health_centers, 10),
+                         "location": _random_strings(generator, health_centers, 10)})[_table_columns("health_center")],
+           os.path.join(out, "health_centers.csv"), True)
+
+    # Generate the patients, chunk by chunk
+    for first_id in range(0, patients, chunk_size):
+        columns = population.patient_columns(np.arange(first_id, min(first_id + chunk_size, patients)))
+        _write(pd.DataFrame(columns)[_table_columns("patient")], os.path.join(out, "patients.csv"), first_id == 0)
+
+    # Generate the blood tests, their malaria results and cases, chunk by chunk, in date order
+    span = (end - start).astype(np.int64)
+    for chunk_index, first_id in enumerate(range(0, blood_tests, chunk_size)):
+        generator = np.random.default_rng([seed, 2, chunk_index])
+        ids = np.arange(first_id, min(first_id + chunk_size, blood_tests))
+
+        # Dates sorted within the chunk's share of the period (so they are sorted across chunks too)
+        offsets = first_id + np.sort(generator.random(len(ids))) * len(ids)
+        dates = start + (offsets * span / blood_tests).astype("timedelta64[s]")
+
+        # Patients taking the tests, and the results (positivity rate of their village, mostly P. falciparum)
+        patient = population.patient_columns(generator.integers(patients, size=len(ids)))
+        positive = generator.random(len(ids)) < population.village_positivity[patient["village_index"]]
+        parasite_types = np.where(positive, generator.choice(PARASITE_TYPES, size=len(ids), p=PARASITE_FREQUENCIES),
+                                  None)
+        malaria_status = np.where(positive, "positive", "negative")
+
+        image_urls = pd.Series(_random_strings(generator, len(ids), 18))
+        image_urls = "https://" + image_urls + ".com/" + _random_strings(generator, len(ids), 10)
+        _write(pd.DataFrame({"id": ids, "date": dates, "image_url": image_urls, "patient_id": patient["id"]}
+                            )[_table_columns("blood_test")],
+               os.path.join(out, "blood_tests.csv"), chunk_index == 0)
+        _write(pd.DataFrame({"id": ids, "malaria_status": malaria_status, "parasite_type": parasite_types,
+                             "blood_test_id": ids})[_table_columns("malaria_results")],
+               os.path.join(out, "malaria_results.csv"), chunk_index == 0)
+        _write(pd.DataFrame({"id": ids, "date": dates, "patient_id": patient["id"], "name": patient["name"],
+                             "date_of_birth": patient["date_of_birth"], "gender": patient["gender"],
+                             "village_id": patient["village_id"], "health_center_id": patient["health_center_id"],
+                             "malaria_status": malaria_status, "parasite_type": parasite_types,
+                             "blood_test_id": ids})[_table_columns("case_cache")],
+               os.path.join(out, "case_caches.csv"), chunk_index == 0)
+
+    return {"health_center": health_centers, "patient": patients, "blood_test": blood_tests,
+            "malaria_results": blood_tests, "case_cache": blood_tests}
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset for scale testing.")
+    parser.add_argument("--out", default="datasets/synthetic", help="folder the CSV files are written to")
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--blood-tests", type=int, default=12000, help="number of blood tests, results and cases")
+    parser.add_argument("--health-centers", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=100000, help="records generated and written at once")
+    parser.add_argument("--start", default="2018-01-01", help="date of the first blood tests")
+    parser.add_argument("--end", default="2024-01-01", help="date after the last blood tests")
+    parser.add_argument("--load", action="store_true",
+                        help="load the dataset into the (development) database with migrate.py")
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
+    counts = generate(args.out, patients=args.patients, blood_tests=args.blood_tests,
+                      health_centers=args.health_centers, seed=args.seed, chunk_size=args.chunk_size,
+                      start=args.start, end=args.end)
+    duration = time.perf_counter() - started_at
+    print(f"{sum(counts.values())} records generated in {duration:.1f} s "
+          f"({sum(counts.values()) / duration:.0f} records/s): {counts}")
+
+    # Load the dataset through the migration's bulk loader
+    if args.load:
+        subprocess.run([sys.executable, "migrate.py", "--datasets", os.path.abspath(args.out)],
+                       cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+if __name__ == '__main__':
+    main()